@@ -1,11 +1,6 @@
-import logging
-import logging.handlers
 import os
 from functools import lru_cache
 
-import ecs_logging
-import openai
-from huggingface_hub import login
 from loguru import logger
 from pydantic_settings import BaseSettings
 
@@ -33,16 +28,57 @@ class Settings(BaseSettings):
     LOG_FORMAT: str = "{time:HH:mm:ss!UTC}\t|\t{file}:{module}:{line}\t|\t{message}"
     ECS_LOG_PATH: str = f"./logs/elastic-{os.getpid()}.log"
     PROFILE: bool = False
+    LOG_ASYNC: bool = True  # the caller only queues the records, a background thread writes them in batches
+    LOG_QUEUE_SIZE: int = 100_000  # records waiting to be written (the new ones are dropped when full)
+    LOG_BATCH_SIZE: int = 512  # max records written before a flush of the file
+    LOG_RATE_LIMIT: float = 0  # max records per second (below WARNING) from the same line of code, 0 for no limit
+    RELEASE: str = "0.0.1"  # ECS logs fields
+    PROJECT_NAME: str = "llms"
 
     # Models
     OPENAI_KEY: str = ""
     HUGGING_FACE_TOKEN: str = ""
-    MISTRAL_MODEL_PATH: str = os.path.join(os.path.abspath("./model"), "mistral", "7B-v0.3")
+    MODELS_PATH: str = os.path.abspath("./model")
+    MISTRAL_MODEL_PATH: str = os.path.join(MODELS_PATH, "mistral", "7B-v0.3")
+    EMBEDDING_BATCH_SIZE: int = 32
+    # Inference runtime: pytorch, onnx or onnx-int8 (exported with optimum, cached under the model path)
+    LLM_RUNTIME: str = "pytorch"
+    EMBEDDING_RUNTIME: str = "pytorch"
+    # Model manager: snapshots and index of the revisions in MODELS_PATH/hub
+    # local folder mirror (<repo id>/<commit>/files, <repo id>/refs/<name>) used instead of the hub
+    MODEL_MIRROR: str = ""
+    MODEL_DOWNLOAD_WORKERS: int = 4  # files downloaded in parallel
+    MODEL_DOWNLOAD_RETRIES: int = 5  # attempts for each file, every one resuming the partial download
+    MODEL_REVISIONS_KEPT: int = 1  # revisions kept by the garbage collection besides the ones pointed by a ref
+
+    # LLM server
+    LLM_SERVER_HOST: str = "127.0.0.1"
+    LLM_SERVER_PORT: int = 8000
+    LLM_MAX_BATCH_SIZE: int = 8  # concurrent requests generated together
+    LLM_BATCH_WAIT: float = 0.02  # seconds waited for other requests after the first one of a batch
+    LLM_MAX_NEW_TOKENS: int = 256  # default max_tokens of a request
+    LLM_MAX_CONTEXT: int = 4096  # tokens of conversation kept in the chat (the oldest turns are evicted)
+
+    # Conversation memory (experiments.llms.conversation)
+    CONVERSATION_MAX_TOKENS: int = 1500  # tokens of history in the prompt: summary, recalled turns and recent turns
+    CONVERSATION_SUMMARY_WORDS: int = 150  # max length asked for the running summary of the evicted turns
+    CONVERSATION_RECALL_TOKENS: int = 300  # part of the history budget for the old turns retrieved by similarity
+
+    # LLM response cache (experiments.llms.cache)
+    LLM_CACHE_PATH: str = "./data/llm_cache.sqlite"
+    LLM_CACHE_MAX_ENTRIES: int = 100_000  # answers kept (LRU eviction)
+    LLM_CACHE_TTL: float = 7 * 24 * 3600  # seconds, the cached answers older than this are generated again
+    LLM_CACHE_SEMANTIC: bool = False  # match also the similar prompts (embedding model), not only the identical ones
+    LLM_CACHE_SIMILARITY: float = 0.95  # min cosine similarity of a semantic match
 
     # Qdrant
     CACHE_PATH: str = "./data/qdrant/cache"
     USE_CACHE: bool = True  # if you want to load the cached parquet files with the embeddings from disk
     USE_VERSIONING: bool = True  # if you want to save on parquet files the dataset with the embeddings
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 1_000_000  # max number of embeddings kept in the cache (LRU eviction)
+    CACHE_VERSIONS_KEPT: int = 3  # number of cache snapshots kept on disk when versioning is enabled (at least 1)
+    EMBEDDING_CACHE_FLUSH_ENTRIES: int = 10_000  # new embeddings written to disk as a segment at once
+    EMBEDDING_CACHE_MAX_SEGMENTS: int = 16  # segments of a dimension compacted into a snapshot beyond this number
     # Debug mode: use into embedding function to reduce the number of articles to generate (remember to put on false before to deploy)
     DEBUG_MODE: bool = False
     ENV_LOAD: str = ""
@@ -50,67 +86,57 @@ class Settings(BaseSettings):
     # QDRANT VARIABLES
     QDRANT_HOST: str = "http://localhost"
     QDRANT_PORT: int = 6333
+    QDRANT_GRPC_PORT: int = 6334
+    QDRANT_PREFER_GRPC: bool = False  # use the gRPC port for the requests (faster bulk uploads)
+    QDRANT_BATCH_SIZE: int = 256  # number of points for each upsert request
+    QDRANT_PARALLEL: int = 4  # number of concurrent upsert requests
+    # "", "int8" (scalar) or "pq" (product): keep the quantized vectors in RAM and the originals on disk
+    QDRANT_QUANTIZATION: str = ""
+    QDRANT_OVERSAMPLING: float = 2.0  # candidates searched on the quantized vectors (x limit) before rescoring
     QDRANT_API_KEY: str = "dev"
     QDRANT_COLLECTION_NAME: str = "test"
 
+    # Retrieval caches (query -> embedding, query + filters -> results)
+    QUERY_EMBEDDING_CACHE_ENTRIES: int = 10_000
+    QUERY_EMBEDDING_CACHE_BYTES: int = 256 * 2**20
+    QUERY_EMBEDDING_CACHE_TTL: float = 24 * 3600  # seconds, the embedding of a text changes only with the model
+    SEARCH_RESULT_CACHE_ENTRIES: int = 50_000
+    SEARCH_RESULT_CACHE_BYTES: int = 128 * 2**20
+    SEARCH_RESULT_CACHE_TTL: float = 600  # seconds, bounds the staleness when another process writes the collection
+
+    # Speech to text
+    WHISPER_MODEL: str = "openai/whisper-tiny"
+    TRANSCRIPTION_WORKERS: int = 2  # chunks transcribed in parallel (threads sharing the model)
+    TRANSCRIPTION_CHUNK_SECONDS: float = 5.0  # audio of speech sent to whisper at once (less is lower latency)
+    TRANSCRIPTION_OVERLAP_SECONDS: float = 1.0  # audio repeated at the start of a chunk, to not cut the words
+    VAD_SILENCE_MS: int = 600  # silence closing a speech segment
+
     # Dataset
     MAX_ARTICLES: int = 10
 
+    # Text cleaning
+    TEXT_CLEAN_BATCH_SIZE: int = 256  # texts for each spaCy nlp.pipe batch
+    TEXT_CLEAN_PROCESSES: int = 1  # spaCy processes for the batch cleaning (-1 for all the cpus)
+    TEXT_CLEAN_CACHE_SIZE: int = 100_000  # cleaned texts kept in memory (memoization)
+
+    # The clients are imported only when they are configured, to keep the import of the settings cheap
     def _configure_openai(self, openai_key) -> bool:
+        import openai
+
         self.OPENAI_KEY = openai_key
         openai.api_key = self.OPENAI_KEY
 
     def _authenticate_hugging_face(self, hugging_face_token: str = None) -> bool:
+        from huggingface_hub import login
+
         if hugging_face_token:
             self.HUGGING_FACE_TOKEN = hugging_face_token
         login(token=self.HUGGING_FACE_TOKEN)
 
     def _setup_logger(self) -> bool:
-        # logger.remove() to remove default logging to StdErr
-        logger.add(
-            self.LOG_FILE_NAME,
-            rotation=self.LOG_ROTATION_SIZE,
-            retention=self.LOG_RETENTION,
-            colorize=True,
-            format=self.LOG_FORMAT,
-            level=self.LOG_VERBOSITY,
-            serialize=False,
-            catch=True,
-            backtrace=False,
-            diagnose=False,
-            encoding="utf8",
-        )
-
-        # Proxy loguru logs also to logging logger.
-        # The ecs logging formats all logs from the python logging system for elastic.
-        # It could be configured to read logs directly from loguru, but in that case it
-        # would miss all parts of the system that log directly to the python logging
-        # system.
-        class PropagateHandler(logging.Handler):
-            def emit(self, record):
-                logging.getLogger(record.name).handle(record)
-
-        logger.add(PropagateHandler(), format="{message}")
-
-        # Add ECS rotating files sink
-        pylogger = logging.getLogger()
-        ecs_handler = logging.handlers.RotatingFileHandler(
-            self.ECS_LOG_PATH,
-            maxBytes=100_000_000,
-            backupCount=2,
-            encoding="utf8",
-        )
-        ecs_handler.setFormatter(
-            ecs_logging.StdlibFormatter(
-                extra={
-                    "release": self.RELEASE,
-                    "project": self.PROJECT_NAME,
-                }
-            )
-        )
-        ecs_handler.setLevel(logging.INFO)
-        pylogger.addHandler(ecs_handler)
+        from experiments.logging_utils import setup_logging
 
+        setup_logging(self)
         return True
 
 
@@ -118,9 +144,7 @@ class Settings(BaseSettings):
 def get_settings() -> Settings:
     """Generate and get the settings."""
     try:
-        settings = Settings()
-        openai.api_key = settings.OPENAI_KEY
-        return settings
+        return Settings()
     except Exception as message:
         logger.error(f"Error: impossible to get the settings: {message}")
         return None
@@ -1,12 +1,201 @@
+import functools
 import json
+import operator
 import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
-from datasets import load_dataset
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
+try:
+    import orjson
 
-def manual_import(output_folder: str = "./data/arxiv/dataset", dataset_raw: str = "./data/arxiv/raw"):
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional, fallback to the standard library decoder
+    _json_loads = json.loads
+
+
+ARXIV_COLUMNS = ["id", "title", "abstract", "categories", "journal-ref", "submitter", "authors", "doi"]
+ARXIV_SCHEMA = pa.schema([(col, pa.string()) for col in ARXIV_COLUMNS])
+
+
+def _records_to_table(records: list) -> pa.Table:
+    """Convert a list of parsed arxiv records into an arrow table with the fixed arxiv schema."""
+    return pa.Table.from_pydict({col: [doc.get(col) for doc in records] for col in ARXIV_COLUMNS}, schema=ARXIV_SCHEMA)
+
+
+def _write_records(f, writer: pq.ParquetWriter, row_group_size: int, end: int = None, progress: tqdm = None) -> int:
+    """Parse the json lines of an open binary file and write them as parquet row groups.
+
+    Args:
+        f: the binary file object, positioned at the beginning of a line
+        writer (pq.ParquetWriter): the parquet writer
+        row_group_size (int): number of records for each parquet row group
+        end (int, optional): stop after the line starting before this byte offset. Defaults to None (end of file).
+        progress (tqdm, optional): progress bar updated with the bytes consumed. Defaults to None.
+
+    Returns:
+        int: the number of records written
+    """
+    total_records = 0
+    records = []
+    position = f.tell()
+    while end is None or position < end:
+        line = f.readline()
+        if not line:
+            break
+        position += len(line)
+        if progress is not None:
+            progress.update(len(line))
+        if not line.strip():
+            continue
+        records.append(_json_loads(line.decode("latin-1")))
+        if len(records) >= row_group_size:
+            writer.write_table(_records_to_table(records))
+            total_records += len(records)
+            records = []
+
+    if records:
+        writer.write_table(_records_to_table(records))
+        total_records += len(records)
+
+    return total_records
+
+
+def stream_import(
+    output_file: str = "./data/arxiv/dataset/dataset.parquet",
+    dataset_raw: str = "./data/arxiv/raw",
+    row_group_size: int = 100_000,
+) -> int:
+    """Stream the arxiv json snapshot into a parquet file, one row group at a time.
+
+    The snapshot is read only once: the progress bar is driven by the bytes consumed instead of a
+    line-count pre-pass. At most `row_group_size` records are kept in memory, so the memory ceiling
+    depends only on the row group size and not on the size of the snapshot.
+
+    Args:
+        output_file (str, optional): the parquet file to write. Defaults to "./data/arxiv/dataset/dataset.parquet".
+        dataset_raw (str, optional): the folder there the json is written and located. Defaults to "./data/arxiv/raw".
+        row_group_size (int, optional): number of records for each parquet row group. Defaults to 100_000.
+
+    Returns:
+        int: the number of records written
+    """
+    file_name = os.path.join(dataset_raw, "arxiv-metadata-oai-snapshot.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+
+    with open(file_name, "rb") as f, pq.ParquetWriter(output_file, ARXIV_SCHEMA) as writer:
+        with tqdm(total=os.path.getsize(file_name), unit="B", unit_scale=True) as progress:
+            return _write_records(f, writer, row_group_size, progress=progress)
+
+
+def _shard_ranges(file_name: str, shards: int) -> list:
+    """Split a file in `shards` contiguous byte ranges of (almost) the same size.
+
+    An empty file still gets one (empty) range: its part keeps the schema of the dataset.
+    """
+    size = os.path.getsize(file_name)
+    step = max(1, -(-size // shards))
+    return [(start, min(start + step, size)) for start in range(0, size, step)] or [(0, 0)]
+
+
+def _import_shard(file_name: str, start: int, end: int, output_file: str, row_group_size: int) -> int:
+    """Parse the lines starting inside the [start, end) byte range and write them into one parquet part.
+
+    A line belongs to the shard where it starts: if the range begins in the middle of a line,
+    that line is skipped because it is parsed by the previous shard.
+    """
+    with open(file_name, "rb") as f, pq.ParquetWriter(output_file, ARXIV_SCHEMA) as writer:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()  # align on the first line starting at or after `start`
+        return _write_records(f, writer, row_group_size, end=end)
+
+
+def _replace_folder(source: str, destination: str):
+    """Move the `source` folder to `destination`, removing the previous `destination` folder."""
+    previous = None
+    if os.path.exists(destination):
+        previous = f"{destination}.old-{os.getpid()}"
+        os.replace(destination, previous)
+    os.replace(source, destination)
+    if previous is not None:
+        shutil.rmtree(previous)
+
+
+def parallel_import(
+    output_folder: str = "./data/arxiv/dataset/parts",
+    dataset_raw: str = "./data/arxiv/raw",
+    workers: int = None,
+    row_group_size: int = 100_000,
+) -> int:
+    """Parse the arxiv json snapshot with a pool of processes, writing one parquet part for each shard.
+
+    The snapshot is split in byte ranges aligned on newlines and every range is parsed by a different
+    process (with orjson if it's installed). The output folder contains `part-xxxxx.parquet` files that
+    can be loaded back as a single dataset with `load_parquet_dataset(output_folder)`; the parts of a previous
+    import in the same folder are replaced only when all the shards are written.
+
+    Args:
+        output_folder (str, optional): the folder for the parquet parts. Defaults to "./data/arxiv/dataset/parts".
+        dataset_raw (str, optional): the folder there the json is written and located. Defaults to "./data/arxiv/raw".
+        workers (int, optional): number of processes (and shards). Defaults to None (number of cpus).
+        row_group_size (int, optional): number of records for each parquet row group. Defaults to 100_000.
+
+    Returns:
+        int: the number of records written
+    """
+    file_name = os.path.join(dataset_raw, "arxiv-metadata-oai-snapshot.json")
+    workers = workers or os.cpu_count() or 1
+    output_folder = os.path.abspath(output_folder)
+    # the parts are written in a sibling folder and swapped in at the end: the parts of a previous import
+    # (maybe with more shards) are never mixed with the new ones, and a failed import leaves the old dataset
+    partial_folder = f"{output_folder}.partial-{os.getpid()}"
+    shutil.rmtree(partial_folder, ignore_errors=True)
+    os.makedirs(partial_folder)
+
+    start_time = time.perf_counter()
+    total_records = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _import_shard,
+                    file_name,
+                    start,
+                    end,
+                    os.path.join(partial_folder, f"part-{index:05d}.parquet"),
+                    row_group_size,
+                )
+                for index, (start, end) in enumerate(_shard_ranges(file_name, workers))
+            ]
+            for future in tqdm(futures, unit="shard"):
+                total_records += future.result()
+    except BaseException:
+        shutil.rmtree(partial_folder, ignore_errors=True)
+        raise
+    _replace_folder(partial_folder, output_folder)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Imported {total_records} records in {elapsed:.1f}s ({total_records / elapsed:.0f} records/sec)")
+
+    return total_records
+
+
+def manual_import(
+    output_folder: str = "./data/arxiv/dataset",
+    dataset_raw: str = "./data/arxiv/raw",
+    streaming: bool = False,
+    row_group_size: int = 100_000,
+    workers: int = 1,
+):
     """Manual import the arxiv dataset from the json file.
 
     Columns:
@@ -27,12 +216,35 @@ def manual_import(output_folder: str = "./data/arxiv/dataset", dataset_raw: str
             https://arxiv.org/pdf/{id}: Direct link to download the PDF
 
     Args:
+        output_folder (str, optional): the folder where the parquet dataset is written. Defaults to "./data/arxiv/dataset".
         dataset_raw (str, optional): the folder there the json is written and located. Defaults to "./data/arxiv/raw".
+        streaming (bool, optional): write the parquet file incrementally with bounded memory (see `stream_import`)
+            and return the number of records written instead of the dataframe. Defaults to False (the whole
+            snapshot is loaded in memory and returned).
+        row_group_size (int, optional): number of records for each parquet row group in streaming mode.
+            Defaults to 100_000.
+        workers (int, optional): if greater than 1 the snapshot is parsed in parallel by this number of
+            processes and written as parquet parts into `output_folder/parts` (see `parallel_import`); the
+            dataframe is then read back from the parts. Defaults to 1.
 
     Returns:
-        pd.Dataframe: pandas dataframe
+        pd.Dataframe | int: pandas dataframe, or the number of records written in streaming mode
     """
-    cols = ["id", "title", "abstract", "categories", "journal-ref", "submitter", "authors", "doi"]
+    if workers > 1:
+        parts_folder = os.path.join(output_folder, "parts")
+        total_records = parallel_import(
+            output_folder=parts_folder, dataset_raw=dataset_raw, workers=workers, row_group_size=row_group_size
+        )
+        return total_records if streaming else load_parquet_dataset(parts_folder)
+
+    output_file = os.path.join(output_folder, "dataset.parquet")
+
+    if streaming:
+        total_records = stream_import(output_file=output_file, dataset_raw=dataset_raw, row_group_size=row_group_size)
+        print(f"Written {total_records} records into {output_file}")
+        return total_records
+
+    cols = ARXIV_COLUMNS
     data = []
     file_name = os.path.join(dataset_raw, "arxiv-metadata-oai-snapshot.json")
 
@@ -48,22 +260,161 @@ def manual_import(output_folder: str = "./data/arxiv/dataset", dataset_raw: str
 
     print(df_data.shape)
 
-    output_file = os.path.join(output_folder, "dataset.parquet")
+    os.makedirs(output_folder, exist_ok=True)
     df_data.to_parquet(output_file)
 
     return df_data
 
 
-def load_parquet_dataset(file_path: str):
+def _category_pattern(category: str) -> str:
+    """Regex matching a category inside the space separated arxiv `categories` field."""
+    return rf"(^| ){re.escape(category)}( |$)"
+
+
+def _arrow_expression(filters: list = None, category: str = None):
+    """Build the pyarrow dataset expression for the filters and the category."""
+    expressions, conditions = [], []
+    for column, op, value in filters or []:
+        if op in ("in", "not in") and not value:
+            # pyarrow can't infer the type of an empty list of values: nothing is in it
+            expressions.append(pc.scalar(op == "not in"))
+        else:
+            conditions.append((column, op, value))
+    if conditions:
+        expressions.append(pq.filters_to_expression(conditions))
+    if category:
+        expressions.append(pc.match_substring_regex(ds.field("categories"), _category_pattern(category)))
+    if not expressions:
+        return None
+    return functools.reduce(operator.and_, expressions)
+
+
+def _polars_expression(filters: list = None, category: str = None):
+    """Build the polars expression for the filters and the category."""
+    import polars as pl
+
+    operators = {
+        "==": operator.eq,
+        "=": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+    }
+    expressions = []
+    for column, op, value in filters or []:
+        if op == "in":
+            expressions.append(pl.col(column).is_in(list(value)))
+        elif op == "not in":
+            expressions.append(~pl.col(column).is_in(list(value)))
+        else:
+            expressions.append(operators[op](pl.col(column), value))
+    if category:
+        expressions.append(pl.col("categories").str.contains(_category_pattern(category)))
+    if not expressions:
+        return None
+    return functools.reduce(operator.and_, expressions)
+
+
+def _sql_literal(value) -> str:
+    """Render a python value as a duckdb sql literal."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _sql_identifier(name: str) -> str:
+    """Quote a column name as a duckdb sql identifier."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _duckdb_where(filters: list = None, category: str = None) -> str:
+    """Build the duckdb where clause for the filters and the category."""
+    conditions = []
+    for column, op, value in filters or []:
+        op = "=" if op == "==" else op
+        if op in ("in", "not in") and not value:
+            # an empty list is not valid sql: nothing is in it
+            conditions.append("FALSE" if op == "in" else "TRUE")
+        elif op in ("in", "not in"):
+            values = ", ".join(_sql_literal(item) for item in value)
+            conditions.append(f"{_sql_identifier(column)} {op.upper()} ({values})")
+        else:
+            conditions.append(f"{_sql_identifier(column)} {op} {_sql_literal(value)}")
+    if category:
+        conditions.append(f"regexp_matches(categories, {_sql_literal(_category_pattern(category))})")
+    return " AND ".join(conditions)
+
+
+def _parquet_glob(file_path: str) -> str:
+    """Return a glob over the parquet parts if the path is a folder (polars and duckdb don't read folders)."""
+    return os.path.join(file_path, "*.parquet") if os.path.isdir(file_path) else file_path
+
+
+def load_parquet_dataset(
+    file_path: str,
+    columns: list = None,
+    filters: list = None,
+    category: str = None,
+    limit: int = None,
+    lazy: str = None,
+):
     """Load the parquet dataset from the file path.
 
+    The columns projection, the filters and the limit are pushed down to the parquet reader, so only the
+    row groups and the columns needed are read from disk.
+
     Args:
-        file_path (str): the path to the parquet file
+        file_path (str): the path to the parquet file, or to a folder of parquet parts
+        columns (list, optional): the columns to read. Defaults to None (all the columns).
+        filters (list, optional): list of (column, op, value) conditions in AND, where op is one of
+            ==, !=, <, <=, >, >=, in, not in. Example: [("id", ">=", "0704.0001"), ("doi", "!=", "")].
+            Defaults to None.
+        category (str, optional): keep only the papers with this arxiv category (example: "cs.LG"). Defaults to None.
+        limit (int, optional): maximum number of rows to read (the arrow Scanner is returned without the limit,
+            use its `head`). Defaults to None (no limit).
+        lazy (str, optional): instead of a pandas dataframe return a lazy scan: "arrow" (pyarrow Scanner),
+            "polars" (polars LazyFrame) or "duckdb" (duckdb relation). Defaults to None.
 
     Returns:
-        pd.DataFrame: the dataframe
+        pd.DataFrame: the dataframe (or the lazy scan if `lazy` is specified)
     """
-    return pd.read_parquet(file_path)
+    if lazy == "polars":
+        import polars as pl
+
+        frame = pl.scan_parquet(_parquet_glob(file_path))
+        expression = _polars_expression(filters, category)
+        if expression is not None:
+            frame = frame.filter(expression)
+        if columns:
+            frame = frame.select(columns)
+        return frame.head(limit) if limit else frame
+
+    if lazy == "duckdb":
+        import duckdb
+
+        relation = duckdb.read_parquet(_parquet_glob(file_path))
+        where = _duckdb_where(filters, category)
+        if where:
+            relation = relation.filter(where)
+        if columns:
+            relation = relation.project(", ".join(_sql_identifier(col) for col in columns))
+        return relation.limit(limit) if limit else relation
+
+    if lazy is not None and lazy != "arrow":
+        raise ValueError(f"Unknown lazy engine: {lazy}")
+
+    scanner = ds.dataset(file_path, format="parquet").scanner(
+        columns=columns, filter=_arrow_expression(filters, category)
+    )
+    if lazy == "arrow":
+        return scanner
+
+    table = scanner.head(limit) if limit else scanner.to_table()
+    return table.to_pandas()
 
 
 def load_arxiv(output_folder: str = "./data/arxiv/dataset", dataset_raw: str = "./data/arxiv/raw"):
@@ -81,6 +432,8 @@ def load_arxiv(output_folder: str = "./data/arxiv/dataset", dataset_raw: str = "
     Returns:
         datasets: arxiv dataset un hugging face format
     """
+    from datasets import load_dataset
+
     # load the arXiv dataset from hugging face
     dataset = load_dataset("arxiv_dataset", data_dir=dataset_raw, trust_remote_code=True)
 
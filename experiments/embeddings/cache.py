@@ -0,0 +1,297 @@
+import atexit
+import glob
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+
+from experiments.config import settings
+
+
+class VectorSlab:
+    """Float32 matrix holding the vectors of one dimension: it grows by doubling and the rows freed by the
+    evictions are reused, so the cache doesn't keep an array object for every vector.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.matrix = np.empty((0, dim), dtype=np.float32)
+        self.size = 0  # rows used, free ones included
+        self.free = []
+
+    def add(self, vector: np.ndarray) -> int:
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.size == len(self.matrix):
+                grown = np.empty((max(2 * len(self.matrix), 1024), self.dim), dtype=np.float32)
+                grown[: self.size] = self.matrix[: self.size]
+                self.matrix = grown
+            row = self.size
+            self.size += 1
+        self.matrix[row] = vector
+        return row
+
+    def extend(self, matrix: np.ndarray) -> range:
+        """Append the rows of a matrix at once, returning their positions."""
+        start = self.size
+        if start + len(matrix) > len(self.matrix):
+            grown = np.empty((max(2 * len(self.matrix), start + len(matrix)), self.dim), dtype=np.float32)
+            grown[:start] = self.matrix[:start]
+            self.matrix = grown
+        self.matrix[start : start + len(matrix)] = matrix
+        self.size += len(matrix)
+        return range(start, self.size)
+
+
+def _stamp() -> str:
+    return f"{time.time_ns()}-{os.getpid()}"
+
+
+def _file_stamp(file_path: str) -> str:
+    """Stamp (time and process) of a segment, or of the newest segment merged into a snapshot."""
+    return "-".join(os.path.basename(file_path).split("-")[1:3]).replace(".parquet", "")
+
+
+def _read_table(file_path: str):
+    """Read a segment or snapshot as (keys, float32 matrix)."""
+    table = pq.read_table(file_path)
+    vectors = table.column("vector").combine_chunks()
+    matrix = vectors.flatten().to_numpy().reshape(len(vectors), vectors.type.list_size)
+    return table.column("key").to_numpy(), matrix
+
+
+def _write_table(file_path: str, keys: List[str], matrix: np.ndarray):
+    """Write the keys and the vectors as parquet (write and rename: a crash never leaves a truncated file)."""
+    vectors = pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1), type=pa.float32()), matrix.shape[1])
+    table = pa.Table.from_arrays([pa.array(keys, type=pa.string()), vectors], names=["key", "vector"])
+    pq.write_table(table, file_path + ".tmp")
+    os.replace(file_path + ".tmp", file_path)
+
+
+def _last_occurrences(keys: np.ndarray) -> np.ndarray:
+    """Positions of the last occurrence of every key, in the order of the keys."""
+    _, first_of_reversed = np.unique(keys[::-1], return_index=True)
+    return np.sort(len(keys) - 1 - first_of_reversed)
+
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by (model name, hash of the text).
+
+    The entries are kept in memory in LRU order (bounded by `max_entries`), with the vectors of every
+    dimension in a single matrix. On disk every dimension has a folder in `path` with append-only parquet
+    segments: `save` writes only the entries added since the last save (and it runs every `flush_entries`
+    new entries, not only at exit), so a crash loses at most the last ones and the processes sharing the
+    folder never overwrite each other. Beyond `max_segments` the segments are compacted into a snapshot;
+    with versioning the last `keep_versions` snapshots are kept, otherwise only the newest one.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.CACHE_PATH,
+        max_entries: int = settings.EMBEDDING_CACHE_MAX_ENTRIES,
+        versioning: bool = settings.USE_VERSIONING,
+        keep_versions: int = settings.CACHE_VERSIONS_KEPT,
+        flush_entries: int = settings.EMBEDDING_CACHE_FLUSH_ENTRIES,
+        max_segments: int = settings.EMBEDDING_CACHE_MAX_SEGMENTS,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.versioning = versioning
+        # the newest snapshot holds the compacted entries: it is always kept, whatever the setting
+        self.keep_versions = max(keep_versions, 1) if versioning else 1
+        self.flush_entries = flush_entries
+        self.max_segments = max_segments
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (dimension, row of the slab)
+        self._slabs = {}  # dimension -> VectorSlab
+        self._unsaved = OrderedDict()  # keys added since the last save
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf8")).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _folders(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.path, "dim-*")))
+
+    def snapshots(self, folder: str) -> List[str]:
+        """List the snapshot files of a dimension folder, from the oldest to the newest."""
+        return sorted(glob.glob(os.path.join(folder, "embeddings-*.parquet")))
+
+    def segments(self, folder: str) -> List[str]:
+        """List the segment files of a dimension folder, from the oldest to the newest."""
+        return sorted(glob.glob(os.path.join(folder, "segment-*.parquet")))
+
+    def _read_folder(self, folder: str, files: List[str] = None):
+        """Read the newest snapshot and the segments of a folder as (keys, matrix, files read), with the
+        duplicated keys removed (the last occurrence wins).
+        """
+        snapshots = self.snapshots(folder)
+        files = files if files is not None else snapshots[-1:] + self.segments(folder)
+        parts = []
+        for file_path in files:
+            try:
+                parts.append(_read_table(file_path))
+            except FileNotFoundError:  # compacted by another process meanwhile
+                continue
+        if not parts:
+            return np.empty(0, dtype=object), None, []
+        keys = np.concatenate([keys for keys, _ in parts])
+        matrix = np.concatenate([matrix for _, matrix in parts])
+        last = _last_occurrences(keys)
+        last = last[max(len(last) - self.max_entries, 0) :]
+        return keys[last], matrix[last], files
+
+    def load(self) -> int:
+        """Load the entries saved on disk, returning the number of entries loaded."""
+        for folder in self._folders():
+            keys, matrix, _ = self._read_folder(folder)
+            if matrix is None:
+                continue
+            with self._lock:
+                slab = self._slabs.setdefault(matrix.shape[1], VectorSlab(matrix.shape[1]))
+                for key, row in zip(keys, slab.extend(matrix)):
+                    previous = self._entries.pop(key, None)
+                    if previous is not None:
+                        self._slabs[previous[0]].free.append(previous[1])
+                    self._entries[key] = (slab.dim, row)
+                self._evict()
+        loaded = len(self._entries)
+        if loaded:
+            logger.info(f"Loaded {loaded} cached embeddings from {self.path}")
+        return loaded
+
+    def save(self) -> List[str]:
+        """Write the entries added since the last save as new segments (one for each dimension), compacting
+        the folders with too many segments. Returns the segments written.
+        """
+        with self._lock:
+            groups = {}
+            for key in self._unsaved:
+                entry = self._entries.get(key)
+                if entry is not None:  # not evicted meanwhile
+                    groups.setdefault(entry[0], []).append((key, entry[1]))
+            # the rows are copied now: after the lock is released they can be reused by new entries
+            batches = {
+                dim: ([key for key, _ in rows], self._slabs[dim].matrix[[row for _, row in rows]])
+                for dim, rows in groups.items()
+            }
+            self._unsaved.clear()
+
+        written = []
+        with self._save_lock:
+            for dim, (keys, matrix) in batches.items():
+                folder = os.path.join(self.path, f"dim-{dim}")
+                os.makedirs(folder, exist_ok=True)
+                segment = os.path.join(folder, f"segment-{_stamp()}.parquet")
+                _write_table(segment, keys, matrix)
+                written.append(segment)
+                if len(self.segments(folder)) > self.max_segments:
+                    self.compact(folder)
+        return written
+
+    def compact(self, folder: str) -> str:
+        """Merge the newest snapshot and the segments of a dimension folder into a new snapshot, removing the
+        merged segments and the snapshots beyond `keep_versions`. Returns the new snapshot.
+
+        The snapshot is named after the newest file merged, so a compaction running concurrently in another
+        process and merging more segments writes a newer snapshot.
+        """
+        segments = self.segments(folder)
+        if not segments:
+            return None
+        keys, matrix, files = self._read_folder(folder, self.snapshots(folder)[-1:] + segments)
+        if matrix is None:
+            return None
+        snapshot = os.path.join(folder, f"embeddings-{max(map(_file_stamp, files))}-{_stamp()}.parquet")
+        _write_table(snapshot, keys.tolist(), matrix)
+        for file_path in segments + self.snapshots(folder)[: -self.keep_versions]:
+            if file_path != snapshot:
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:  # removed by another process compacting the same segments
+                    pass
+        logger.debug(f"Compacted {len(files)} embedding cache files into {snapshot}")
+        return snapshot
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            _, (dim, row) = self._entries.popitem(last=False)
+            self._slabs[dim].free.append(row)
+
+    def get(self, model: str, text: str) -> np.ndarray:
+        key = self.key(model, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # a copy: the row is reused after an eviction
+            return self._slabs[entry[0]].matrix[entry[1]].copy()
+
+    def put(self, model: str, text: str, vector: np.ndarray):
+        key = self.key(model, text)
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._slabs[previous[0]].free.append(previous[1])
+            slab = self._slabs.setdefault(len(vector), VectorSlab(len(vector)))
+            self._entries[key] = (slab.dim, slab.add(vector))
+            self._unsaved[key] = None
+            self._evict()
+            flush = len(self._unsaved) >= self.flush_entries
+        if flush:
+            self.save()
+
+    def embed(self, model: str, input_data: List[str], embed_function: Callable) -> np.ndarray:
+        """Embed the texts calling `embed_function` only for the texts not in cache.
+
+        Args:
+            model (str): the model name, part of the cache key
+            input_data (List[str]): the texts to embed
+            embed_function (Callable): function embedding a list of texts into a float32 matrix
+
+        Returns:
+            np.ndarray: float32 matrix with the embeddings in the input order
+        """
+        cached = [self.get(model, text) for text in input_data]
+        missing = list(dict.fromkeys(text for text, vector in zip(input_data, cached) if vector is None))
+        computed = {}
+        if missing:
+            for text, vector in zip(missing, embed_function(missing)):
+                self.put(model, text, vector)
+                computed[text] = vector
+        if not input_data:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.vstack([vector if vector is not None else computed[text] for text, vector in zip(input_data, cached)])
+
+
+@lru_cache()
+def get_embedding_cache() -> EmbeddingCache:
+    """Get the process-wide embedding cache, saving on disk the entries still unsaved when the process exits."""
+    cache = EmbeddingCache()
+    atexit.register(cache.save)
+    return cache
@@ -1,70 +1,264 @@
-from typing import List
+import time
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, List
 
-import openai
-import torch
-from fastembed import TextEmbedding
-from transformers import AutoModel, AutoTokenizer
+import numpy as np
+from loguru import logger
 
 from experiments.config import settings
+from experiments.embeddings.cache import get_embedding_cache
 
-DEVICE = torch.device("cuda" if (torch.cuda.is_available()) else "cpu")
+# torch, transformers, fastembed and openai are imported on first use: importing this module is cheap
+FASTEMBED_MODEL = "BAAI/bge-large-en-v1.5"
+HUGGING_FACE_MODEL = "allenai/specter2_base"
 
 
-def generation_fastembed(input_data: List[str]):
+@lru_cache()
+def get_device() -> str:
+    """Get the default torch device (cuda if available)."""
+    import torch
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+@lru_cache(maxsize=None)
+def get_fastembed_model(model_name: str = FASTEMBED_MODEL):
+    """Load a fastembed model only once for each process."""
+    from fastembed import TextEmbedding
+
+    # This will trigger the model download and initialization
+    return TextEmbedding(model_name=model_name)
+
+
+@lru_cache(maxsize=None)
+def get_hugging_face_model(model_name: str = HUGGING_FACE_MODEL, device: str = None, runtime: str = "pytorch") -> tuple:
+    """Load a hugging face tokenizer and model only once for each (model, device, runtime) in the process.
+
+    With the onnx runtimes the model is exported with optimum on first use (see `experiments.onnx_runtime`)
+    and runs with onnxruntime on CPU.
+    """
+    from transformers import AutoModel, AutoTokenizer
+
+    from experiments.model_manager import resolve_model_path
+
+    # a model downloaded with the model manager is loaded from its snapshot, offline
+    model_name = resolve_model_path(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if runtime != "pytorch":
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+        from experiments.onnx_runtime import load_onnx_model
+
+        return tokenizer, load_onnx_model(model_name, ORTModelForFeatureExtraction, runtime)
+
+    device = device or get_device()
+    model = AutoModel.from_pretrained(model_name)
+    model.to(device)
+    model.eval()
+    return tokenizer, model
+
+
+class EmbeddingService:
+    """Generate embeddings in length-sorted batches with a model loaded once for each process.
+
+    Sorting the texts by length before batching minimises the padding inside every batch, the
+    embeddings are returned in the original order as a contiguous float32 numpy matrix.
+    The hugging face models can run on the pytorch, onnx or onnx-int8 `runtime` (fastembed is already
+    an onnxruntime model).
+    """
+
+    def __init__(
+        self,
+        backend: str = "hugging_face",
+        model_name: str = None,
+        device: str = None,
+        batch_size: int = settings.EMBEDDING_BATCH_SIZE,
+        sort_window: int = 64,
+        use_cache: bool = settings.USE_CACHE,
+        runtime: str = settings.EMBEDDING_RUNTIME,
+    ):
+        if backend not in ("hugging_face", "fastembed"):
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        self.backend = backend
+        self.model_name = model_name or (HUGGING_FACE_MODEL if backend == "hugging_face" else FASTEMBED_MODEL)
+        self.runtime = runtime if backend == "hugging_face" else "pytorch"
+        # onnxruntime runs on CPU
+        self.device = "cpu" if self.runtime != "pytorch" else device or get_device()
+        # the quantized models give (slightly) different embeddings: they are cached separately
+        self.cache_model = self.model_name if self.runtime == "pytorch" else f"{self.model_name}@{self.runtime}"
+        self.batch_size = batch_size
+        # number of batches sorted together when the input is streamed
+        self.sort_window = sort_window
+        self.cache = get_embedding_cache() if use_cache else None
+
+    def _embed_batch(self, batch: List[str]) -> np.ndarray:
+        if self.backend == "fastembed":
+            model = get_fastembed_model(self.model_name)
+            return np.asarray(list(model.embed(batch, batch_size=len(batch))), dtype=np.float32)
+
+        import torch
+
+        tokenizer, model = get_hugging_face_model(self.model_name, self.device, self.runtime)
+        encoded_input = tokenizer(batch, return_tensors="pt", padding=True, truncation=True).to(self.device)
+        with torch.inference_mode():
+            model_output = model(**encoded_input)
+        # Extract the embeddings from the [CLS] tokens
+        return model_output.last_hidden_state[:, 0, :].float().cpu().numpy()
+
+    def embed(self, input_data: List[str]) -> np.ndarray:
+        """Embed a list of texts, looking up the embedding cache first if it's enabled.
+
+        Args:
+            input_data (List[str]): the texts to embed
+
+        Returns:
+            np.ndarray: float32 matrix with one row for each text, in the input order
+        """
+        if self.cache is not None:
+            return self.cache.embed(self.cache_model, input_data, self._embed)
+        return self._embed(input_data)
+
+    def _embed(self, input_data: List[str]) -> np.ndarray:
+        order = np.argsort([len(text) for text in input_data], kind="stable")
+        embeddings = None
+        for start in range(0, len(order), self.batch_size):
+            indexes = order[start : start + self.batch_size]
+            vectors = self._embed_batch([input_data[index] for index in indexes])
+            if embeddings is None:
+                embeddings = np.empty((len(input_data), vectors.shape[1]), dtype=np.float32)
+            embeddings[indexes] = vectors
+
+        return embeddings if embeddings is not None else np.empty((0, 0), dtype=np.float32)
+
+    def embed_stream(self, input_data: Iterable[str]) -> Iterator[np.ndarray]:
+        """Embed a (possibly huge) stream of texts with bounded memory.
+
+        The texts are consumed in windows of `batch_size * sort_window` elements, sorted by length inside
+        each window.
+
+        Args:
+            input_data (Iterable[str]): the texts to embed
+
+        Yields:
+            np.ndarray: float32 matrix with the embeddings of each window, in the input order
+        """
+        iterator = iter(input_data)
+        while window := list(islice(iterator, self.batch_size * self.sort_window)):
+            yield self.embed(window)
+
+
+def generation_fastembed(input_data: List[str], model_name: str = FASTEMBED_MODEL) -> np.ndarray:
     """Generate fast embeddings for the input data using the specified model.
 
     Parameters:
     - input_data: List of strings to generate embeddings for.
+    - model_name: the fastembed model name.
 
     Returns:
-    - List of embeddings generated from the input data.
+    - float32 matrix with the embeddings generated from the input data (1024 dimensions for bge-large).
     """
-    # This will trigger the model download and initialization
-    embedding_model = TextEmbedding(model_name="BAAI/bge-large-en-v1.5")
+    return EmbeddingService(backend="fastembed", model_name=model_name).embed(input_data)
 
-    # embeddings_generator = embedding_model.embed(input_data)  # reminder this is a generator
-    embeddings_list = list(embedding_model.embed(input_data))
-    # you can also convert the generator to a list, and that to a numpy array
-    len(embeddings_list[0])  # Vector of 384 dimensions
 
-    return embeddings_list
+def generation_hugging_face(
+    input_data: List[str], model_name: str = HUGGING_FACE_MODEL, runtime: str = settings.EMBEDDING_RUNTIME
+) -> np.ndarray:
+    """Generate the [CLS] embeddings of a hugging face model (specter2 by default) for the input data.
 
+    Args:
+        input_data (List[str]): the texts to embed
+        model_name (str, optional): the hugging face model. Defaults to "allenai/specter2_base".
+        runtime (str, optional): pytorch, onnx or onnx-int8. Defaults to settings.EMBEDDING_RUNTIME.
 
-def generation_hugging_face(input_data: List[str]):
-    model_name = "allenai/specter2_base"
-    model = AutoModel.from_pretrained(model_name)
-    model.to(DEVICE)
-    model.eval()
-    # load model and tokenizer
-    # Load model and tokenizer
-    model = AutoModel.from_pretrained(model_name)
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    Returns:
+        np.ndarray: float32 matrix with the embeddings
+    """
+    return EmbeddingService(backend="hugging_face", model_name=model_name, runtime=runtime).embed(input_data)
 
-    # Tokenize the input data
-    encoded_input = tokenizer(input_data, return_tensors="pt", padding=True, truncation=True)
 
-    # Move the encoded input to the device (GPU if available)
-    encoded_input = encoded_input.to(DEVICE)
+def generate_openai(
+    input_data: List[str], model: str = "text-embedding-ada-002", use_cache: bool = settings.USE_CACHE, **kwargs
+) -> np.ndarray:
+    """Generate the OpenAI embeddings with batched and concurrent requests.
 
-    # Generate the embeddings
-    with torch.no_grad():
-        model_output = model(**encoded_input)
+    Args:
+        input_data (List[str]): the texts to embed
+        model (str, optional): the OpenAI embedding model. Defaults to "text-embedding-ada-002".
+        use_cache (bool, optional): look up the embedding cache before calling OpenAI. Defaults to settings.USE_CACHE.
+        **kwargs: other options of `OpenAIEmbeddingClient` (max_concurrency, max_batch_size, ...)
 
-    # Extract the embeddings from the [CLS] tokens
-    embeddings = model_output.last_hidden_state[:, 0, :]
+    Returns:
+        np.ndarray: float32 matrix with the embeddings
+    """
+    from experiments.embeddings.openai_client import OpenAIEmbeddingClient
 
-    # Convert the tensor to a list of lists of floats
-    return embeddings.cpu().numpy().tolist()
+    client = OpenAIEmbeddingClient(model=model, **kwargs)
+    if use_cache:
+        embeddings = get_embedding_cache().embed(model, input_data, client.embed)
+    else:
+        embeddings = client.embed(input_data)
+    logger.info(f"OpenAI embeddings: {client.stats}")
+    return embeddings
 
 
-def generate_openai(input_data: List[str], model: str = "text-embedding-ada-002"):
-    embeddings = []
-    for text in input_data:
-        response = openai.Embedding.create(model=model, input=text)
-        embedding_vector = response["data"][0]["embedding"]
-        embeddings.append(embedding_vector)
+def _benchmark_embeddings(runtime: str, model_name: str, texts: List[str], batch_size: int, repeat: int) -> dict:
+    from experiments.onnx_runtime import import_runtime, rss_bytes
 
-    return embeddings
+    import_runtime(runtime)
+    memory = rss_bytes()
+    service = EmbeddingService(
+        backend="hugging_face", model_name=model_name, batch_size=batch_size, use_cache=False, runtime=runtime
+    )
+    start = time.perf_counter()
+    reference = service.embed(texts[:batch_size])  # the model is loaded on the first batch
+    load = time.perf_counter() - start
+    memory = rss_bytes() - memory
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for index in range(0, len(texts), batch_size):
+            batch_start = time.perf_counter()
+            service.embed(texts[index : index + batch_size])
+            latencies.append(time.perf_counter() - batch_start)
+    elapsed = time.perf_counter() - start
+    return {
+        "runtime": runtime,
+        "load_s": load,
+        "memory_mb": memory / 2**20,
+        "batch_latency_ms": float(np.mean(latencies)) * 1000,
+        "batch_p95_ms": float(np.percentile(latencies, 95)) * 1000,
+        "texts_per_second": len(texts) * repeat / elapsed,
+        "embedding_norm": float(np.linalg.norm(reference[0])),
+    }
+
+
+def benchmark_runtimes(
+    model_name: str = HUGGING_FACE_MODEL,
+    texts: List[str] = None,
+    batch_size: int = 16,
+    repeat: int = 3,
+    runtimes: tuple = None,
+) -> List[dict]:
+    """Compare load time, memory, batch latency and throughput of the embedding model on the CPU runtimes.
+
+    The ONNX artifacts are exported before the measures, every runtime is measured in its own process.
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+    from experiments.onnx_runtime import RUNTIMES
+    from experiments.onnx_runtime import benchmark_runtimes as run_benchmark
+    from experiments.onnx_runtime import ensure_onnx
+
+    runtimes = runtimes or RUNTIMES
+    texts = texts or [f"Sentence number {index} about graph neural networks and molecules" for index in range(128)]
+    for runtime in runtimes:
+        if runtime != "pytorch":
+            ensure_onnx(model_name, ORTModelForFeatureExtraction, runtime)
+    return run_benchmark(
+        _benchmark_embeddings, runtimes, model_name=model_name, texts=texts, batch_size=batch_size, repeat=repeat
+    )
 
 
 if __name__ == "__main__":
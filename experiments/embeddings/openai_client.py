@@ -0,0 +1,191 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List
+
+import aiohttp
+import numpy as np
+import openai
+from loguru import logger
+
+from experiments.config import settings
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional, fallback to an approximate token count
+    tiktoken = None
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+@lru_cache()
+def configure_openai():
+    """Set the OpenAI key of the settings on the openai module, once, before the first request."""
+    if settings.OPENAI_KEY:
+        settings._configure_openai(settings.OPENAI_KEY)
+
+
+@dataclass
+class EmbeddingStats:
+    """Throughput and latency statistics of an embedding client."""
+
+    requests: int = 0
+    inputs: int = 0
+    tokens: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+
+    @property
+    def inputs_per_second(self) -> float:
+        return self.inputs / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return float(np.mean(self.latencies)) if self.latencies else 0.0
+
+    @property
+    def p95_latency(self) -> float:
+        return float(np.percentile(self.latencies, 95)) if self.latencies else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.inputs} inputs in {self.requests} requests ({self.retries} retries), {self.tokens} tokens, "
+            f"{self.inputs_per_second:.1f} inputs/sec, latency mean {self.mean_latency * 1000:.0f}ms "
+            f"p95 {self.p95_latency * 1000:.0f}ms"
+        )
+
+
+class OpenAIEmbeddingClient:
+    """Asynchronous OpenAI embedding client.
+
+    The inputs are packed in requests bounded by number of inputs and (estimated) tokens, a bounded number
+    of requests run concurrently and the requests that fail for rate limits or server errors are retried
+    with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        model: str = "text-embedding-ada-002",
+        max_concurrency: int = 8,
+        max_batch_size: int = 256,
+        max_batch_tokens: int = 100_000,
+        max_retries: int = 6,
+        backoff: float = 1.0,
+        api_base: str = None,
+        api_key: str = None,
+    ):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # api_base can point to a local server (tests, proxies, compatible services)
+        self.api_base = api_base
+        self.api_key = api_key or settings.OPENAI_KEY or openai.api_key
+        self.stats = EmbeddingStats()
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return len(text) // 4 + 1
+
+    def pack(self, input_data: List[str]) -> List[List[int]]:
+        """Group the input indexes in batches respecting the inputs and tokens limits of a request."""
+        batches = []
+        batch, batch_tokens = [], 0
+        for index, text in enumerate(input_data):
+            tokens = self.count_tokens(text)
+            if batch and (len(batch) >= self.max_batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(index)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("retry-after") or headers.get("Retry-After")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * 2**attempt * (0.5 + random.random())  # noqa: S311
+
+    async def _request(self, texts: List[str], semaphore: asyncio.Semaphore) -> List[List[float]]:
+        configure_openai()
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                start = time.perf_counter()
+                try:
+                    response = await openai.Embedding.acreate(
+                        model=self.model, input=texts, api_base=self.api_base, api_key=self.api_key
+                    )
+                except (*RETRYABLE_ERRORS, openai.error.APIError) as error:
+                    status = getattr(error, "http_status", None)
+                    retryable = isinstance(error, RETRYABLE_ERRORS) or status is None or status >= 500
+                    if not retryable or attempt == self.max_retries:
+                        raise
+                    delay = self._retry_delay(attempt, error)
+                    self.stats.retries += 1
+                    logger.warning(f"Embedding request failed ({error}), retry in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+
+                self.stats.latencies.append(time.perf_counter() - start)
+                self.stats.requests += 1
+                self.stats.inputs += len(texts)
+                self.stats.tokens += response.get("usage", {}).get("total_tokens", 0)
+                return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+    async def aembed(self, input_data: List[str]) -> np.ndarray:
+        """Embed a list of texts concurrently.
+
+        Args:
+            input_data (List[str]): the texts to embed
+
+        Returns:
+            np.ndarray: float32 matrix with one row for each text, in the input order
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        batches = self.pack(input_data)
+        start = time.perf_counter()
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency)) as session:
+            # share the same connection pool among all the requests
+            openai.aiosession.set(session)
+            try:
+                results = await asyncio.gather(
+                    *[self._request([input_data[index] for index in batch], semaphore) for batch in batches]
+                )
+            finally:
+                openai.aiosession.set(None)
+        self.stats.elapsed += time.perf_counter() - start
+
+        embeddings = None
+        for batch, vectors in zip(batches, results):
+            if embeddings is None:
+                embeddings = np.empty((len(input_data), len(vectors[0])), dtype=np.float32)
+            embeddings[batch] = vectors
+        return embeddings if embeddings is not None else np.empty((0, 0), dtype=np.float32)
+
+    def embed(self, input_data: List[str]) -> np.ndarray:
+        """Synchronous version of `aembed` (can't be called from a running event loop)."""
+        return asyncio.run(self.aembed(input_data))
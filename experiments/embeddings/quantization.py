@@ -0,0 +1,202 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+class Quantizer(ABC):
+    """Compress the (normalized) embeddings into uint8 codes and score the queries directly on the codes.
+
+    The scores are approximate inner products (cosine similarities for normalized vectors): they are used
+    to select the candidates that are rescored with the float vectors.
+    """
+
+    method = None
+
+    @property
+    @abstractmethod
+    def code_size(self) -> int:
+        """Bytes of the code of a vector."""
+
+    @abstractmethod
+    def fit(self, vectors: np.ndarray) -> "Quantizer":
+        """Learn the parameters of the codes from a sample of the vectors."""
+
+    @abstractmethod
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Encode the vectors into uint8 codes, shape (vectors, code_size)."""
+
+    @abstractmethod
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Approximate float32 vectors of the codes."""
+
+    @abstractmethod
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Approximate inner products between the queries and the encoded vectors, shape (queries, codes)."""
+
+    @abstractmethod
+    def state(self) -> dict:
+        """The parameters saved by `save` (the attributes restored by `load`)."""
+
+    def save(self, path: str):
+        np.savez(path, method=self.method, **self.state())
+
+    @staticmethod
+    def load(path: str) -> "Quantizer":
+        with np.load(path) as data:
+            state = {key: data[key] for key in data.files}
+        quantizer_class = QUANTIZERS[str(state.pop("method"))]
+        quantizer = quantizer_class.__new__(quantizer_class)
+        for key, value in state.items():
+            # the scalar parameters are saved as 0-d arrays
+            setattr(quantizer, key, value.item() if value.ndim == 0 else value)
+        return quantizer
+
+
+class ScalarQuantizer(Quantizer):
+    """int8 scalar quantization: every dimension is mapped linearly on 256 levels (4x smaller than float32).
+
+    The range of each dimension is clipped to the `quantile` of the training vectors, so a few outliers
+    don't waste the levels.
+    """
+
+    method = "int8"
+
+    def __init__(self, quantile: float = 0.99):
+        self.quantile = quantile
+        self.low = None
+        self.scale = None
+
+    @property
+    def code_size(self) -> int:
+        return len(self.low)
+
+    def fit(self, vectors: np.ndarray) -> "ScalarQuantizer":
+        vectors = np.asarray(vectors, dtype=np.float32)
+        tail = (1 - self.quantile) / 2
+        self.low, high = np.quantile(vectors, [tail, 1 - tail], axis=0).astype(np.float32)
+        self.scale = np.maximum(high - self.low, 1e-12) / 255
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.low) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.low + codes.astype(np.float32) * self.scale
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # q . (low + scale * c) = q . low + (q * scale) . c
+        return (queries * self.scale) @ codes.astype(np.float32).T + (queries @ self.low)[:, None]
+
+    def state(self) -> dict:
+        return {"quantile": self.quantile, "low": self.low, "scale": self.scale}
+
+
+class ProductQuantizer(Quantizer):
+    """Product quantization: the vector is split in `subspaces` slices, every slice is replaced by the id of
+    the nearest of 256 centroids learned with k-means (1 byte for each slice).
+
+    With the default `subspaces = dimension // 4` a float32 vector is 16x smaller. The queries are scored
+    with a lookup table of the inner products between the query slices and the centroids. The k-means runs
+    on at most `training_size` vectors (64 for each centroid are enough).
+    """
+
+    method = "pq"
+
+    def __init__(
+        self,
+        subspaces: int = None,
+        centroids: int = 256,
+        iterations: int = 20,
+        training_size: int = 16_384,
+        seed: int = 42,
+    ):
+        if centroids > 256:
+            raise ValueError("The codes are uint8: at most 256 centroids")
+        self.subspaces = subspaces
+        self.centroids = centroids
+        self.iterations = iterations
+        self.training_size = training_size
+        self.seed = seed
+        self.codebooks = None  # (subspaces, centroids, dimension // subspaces)
+
+    @property
+    def code_size(self) -> int:
+        return self.subspaces
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors.reshape(len(vectors), self.subspaces, -1)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        distances = (centroids**2).sum(axis=1)[None, :] - 2 * vectors @ centroids.T
+        return distances.argmin(axis=1)
+
+    def _kmeans(self, vectors: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        count = min(self.centroids, len(vectors))
+        centroids = vectors[rng.choice(len(vectors), count, replace=False)].copy()
+        for _ in range(self.iterations):
+            labels = self._assign(vectors, centroids)
+            sums = np.stack([np.bincount(labels, weights=column, minlength=count) for column in vectors.T], axis=1)
+            sizes = np.bincount(labels, minlength=count)
+            empty = sizes == 0
+            centroids[~empty] = sums[~empty] / sizes[~empty, None]
+            # restart the empty clusters from random points
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        if count < self.centroids:
+            centroids = np.concatenate([centroids, np.repeat(centroids[-1:], self.centroids - count, axis=0)])
+        return centroids
+
+    def fit(self, vectors: np.ndarray) -> "ProductQuantizer":
+        vectors = np.asarray(vectors, dtype=np.float32)
+        dimension = vectors.shape[1]
+        if self.subspaces is None:
+            self.subspaces = max(1, dimension // 4)
+        if dimension % self.subspaces:
+            raise ValueError(f"The dimension {dimension} is not divisible in {self.subspaces} subspaces")
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > self.training_size:
+            vectors = vectors[rng.choice(len(vectors), self.training_size, replace=False)]
+        slices = np.ascontiguousarray(self._split(vectors).transpose(1, 0, 2))
+        self.codebooks = np.stack([self._kmeans(slices[index], rng) for index in range(self.subspaces)])
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        slices = self._split(vectors)
+        codes = np.empty((len(slices), self.subspaces), dtype=np.uint8)
+        for index in range(self.subspaces):
+            codes[:, index] = self._assign(slices[:, index], self.codebooks[index])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        slices = [self.codebooks[index][codes[:, index]] for index in range(self.subspaces)]
+        return np.concatenate(slices, axis=1)
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # table[q, s, c]: inner product of the slice s of the query q with the centroid c
+        table = np.einsum("qsd,scd->qsc", self._split(queries), self.codebooks)
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for index in range(self.subspaces):
+            scores += table[:, index, codes[:, index]]
+        return scores
+
+    def state(self) -> dict:
+        return {
+            "subspaces": self.subspaces,
+            "centroids": self.centroids,
+            "iterations": self.iterations,
+            "training_size": self.training_size,
+            "seed": self.seed,
+            "codebooks": self.codebooks,
+        }
+
+
+QUANTIZERS = {quantizer.method: quantizer for quantizer in (ScalarQuantizer, ProductQuantizer)}
+
+
+def get_quantizer(method: str, **kwargs) -> Quantizer:
+    """Build an (untrained) quantizer by name: int8 (scalar) or pq (product)."""
+    if method not in QUANTIZERS:
+        raise ValueError(f"Unknown quantization {method}, use one of {', '.join(QUANTIZERS)}")
+    return QUANTIZERS[method](**kwargs)
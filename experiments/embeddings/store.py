@@ -0,0 +1,390 @@
+import json
+import os
+import time
+from typing import Iterator, List
+
+import numpy as np
+
+from experiments.embeddings.quantization import Quantizer, get_quantizer
+from experiments.vectordb.base import SearchResult, VectorStore
+
+
+class EmbeddingStore(VectorStore):
+    """Append-only on-disk embedding matrix, read through a memory map.
+
+    The folder contains `vectors.bin` (row-major matrix with a fixed dtype), `ids.txt` (one document id for
+    each row) and `meta.json` (dimension, dtype, committed rows, deleted ids). The vectors are L2 normalized
+    when appended, so the exact cosine top-k is a chunked matrix product over the memory map: the RAM used
+    depends on `chunk_size`, not on the number of vectors.
+
+    Only the rows committed by `save` are visible when the store is opened again: a crash during the
+    append leaves the store at the last commit. There must be a single writer, the readers can open the
+    store at any time.
+
+    After `quantize` the store keeps also the compressed codes of the vectors (`codes.bin`, int8 or product
+    quantization): the search scans the codes to select `limit * oversampling` candidates and rescores
+    them with the float vectors, so only the candidate rows of the float matrix are read.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dimension: int = None,
+        dtype: str = "float32",
+        chunk_size: int = 65_536,
+        oversampling: float = 4.0,
+    ):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.oversampling = oversampling
+        self.quantizer = None
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.ids = []  # row -> document id
+        self.rows = {}  # document id -> latest row
+        self.deleted = set()
+        self._matrix = None
+        self._codes = None
+        self._live = None
+        self._recovered = False
+        if os.path.exists(self._file("meta.json")):
+            self.load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Read-only memory map of the vectors (no copy in memory)."""
+        if self.count == 0:
+            return np.empty((0, self.dimension or 0), dtype=self.dtype)
+        if self._matrix is None or len(self._matrix) != self.count:
+            self._matrix = np.memmap(
+                self._file("vectors.bin"), dtype=self.dtype, mode="r", shape=(self.count, self.dimension)
+            )
+        return self._matrix
+
+    @property
+    def codes(self) -> np.ndarray:
+        """Read-only memory map of the quantized vectors."""
+        if self.count == 0:
+            return np.empty((0, self.quantizer.code_size), dtype=np.uint8)
+        if self._codes is None or len(self._codes) != self.count:
+            self._codes = np.memmap(
+                self._file("codes.bin"), dtype=np.uint8, mode="r", shape=(self.count, self.quantizer.code_size)
+            )
+        return self._codes
+
+    @property
+    def live(self) -> np.ndarray:
+        """Mask of the rows to search: the latest row of every id not deleted."""
+        if self._live is None:
+            self._live = np.zeros(self.count, dtype=bool)
+            self._live[list(self.rows.values())] = True
+        return self._live
+
+    def create(self, dimension: int):
+        os.makedirs(self.path, exist_ok=True)
+        for name in ("vectors.bin", "ids.txt"):
+            open(self._file(name), "wb").close()
+        self.dimension = dimension
+        self.count = 0
+        self.ids, self.rows, self.deleted = [], {}, set()
+        self._matrix = self._codes = self._live = None
+        self._recovered = True
+        self.quantizer = None
+        for name in ("codes.bin", "quantizer.npz"):
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+        self.save()
+        self._changed()
+
+    def load(self):
+        with open(self._file("meta.json")) as f:
+            meta = json.load(f)
+        self.dimension = meta["dimension"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.count = meta["count"]
+        self.deleted = set(meta["deleted"])
+        self.quantizer = Quantizer.load(self._file("quantizer.npz")) if meta.get("quantization") else None
+        with open(self._file("ids.txt"), encoding="utf8") as f:
+            self.ids = [line.rstrip("\n") for _, line in zip(range(self.count), f)]
+        self.rows = {identifier: row for row, identifier in enumerate(self.ids) if identifier not in self.deleted}
+        self._matrix = self._codes = self._live = None
+        self._changed()
+
+    def _recover(self):
+        """Drop the rows appended after the last commit (by a crashed writer) before appending new ones."""
+        with open(self._file("vectors.bin"), "r+b") as f:
+            f.truncate(self.count * self.dimension * self.dtype.itemsize)
+        if self.quantizer is not None:
+            with open(self._file("codes.bin"), "r+b") as f:
+                f.truncate(self.count * self.quantizer.code_size)
+        with open(self._file("ids.txt"), "w", encoding="utf8") as f:
+            f.writelines(f"{identifier}\n" for identifier in self.ids)
+        self._recovered = True
+
+    def save(self):
+        """Commit the appended rows: flush the files and write the metadata atomically."""
+        meta = {
+            "dimension": self.dimension,
+            "dtype": self.dtype.name,
+            "count": self.count,
+            "deleted": sorted(self.deleted),
+            "quantization": self.quantizer.method if self.quantizer is not None else None,
+        }
+        with open(self._file("meta.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(self._file("meta.json.tmp"), self._file("meta.json"))
+
+    def append(self, ids: List[str], vectors: np.ndarray) -> int:
+        """Append the vectors at the end of the matrix (an id appended again replaces the previous vector)."""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.dimension is None or not os.path.exists(self._file("meta.json")):
+            self.create(vectors.shape[1])
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected vectors of dimension {self.dimension}, got {vectors.shape[1]}")
+        if not self._recovered:
+            self._recover()
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = (vectors / np.where(norms == 0, 1, norms)).astype(self.dtype)
+
+        with open(self._file("vectors.bin"), "ab") as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        if self.quantizer is not None:
+            with open(self._file("codes.bin"), "ab") as f:
+                f.write(self.quantizer.encode(vectors).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        with open(self._file("ids.txt"), "a", encoding="utf8") as f:
+            f.writelines(f"{identifier}\n" for identifier in ids)
+
+        for offset, identifier in enumerate(ids):
+            self.rows[identifier] = self.count + offset
+            self.deleted.discard(identifier)
+        self.ids.extend(ids)
+        self.count += len(ids)
+        self._live = None
+        self._changed()
+        return len(ids)
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[dict] = None) -> int:
+        """Append the vectors (the payloads are not stored: use qdrant, lance or hnsw to filter on them)."""
+        return self.append(ids, vectors)
+
+    def delete(self, ids: List[str]) -> int:
+        deleted = 0
+        for identifier in ids:
+            if self.rows.pop(identifier, None) is not None:
+                self.deleted.add(identifier)
+                deleted += 1
+        self._live = None
+        self._changed()
+        return deleted
+
+    def get(self, ids: List[str]) -> np.ndarray:
+        """Get the (normalized) vectors of the ids."""
+        return np.asarray(self.matrix[[self.rows[identifier] for identifier in ids]], dtype=np.float32)
+
+    def iter_chunks(self, chunk_size: int = None) -> Iterator[tuple]:
+        """Iterate over (ids, vectors) chunks of the live rows, the vectors are slices of the memory map.
+
+        Useful to build another index (for example `HNSWStore.upsert`) without loading the whole matrix.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, self.count, chunk_size):
+            end = min(start + chunk_size, self.count)
+            live = self.live[start:end]
+            ids = [identifier for identifier, keep in zip(self.ids[start:end], live) if keep]
+            yield ids, self.matrix[start:end][live]
+
+    def quantize(self, method: str = "int8", sample_size: int = 65_536, seed: int = 42, **kwargs) -> Quantizer:
+        """Train a quantizer on a sample of the vectors and encode all the rows (the new rows are encoded on append).
+
+        Args:
+            method (str, optional): int8 (scalar, 4x smaller) or pq (product, 16x smaller by default). Defaults to "int8".
+            sample_size (int, optional): number of vectors used to train the quantizer. Defaults to 65_536.
+            seed (int, optional): seed of the training sample. Defaults to 42.
+            **kwargs: the parameters of the quantizer (see `experiments.embeddings.quantization`)
+
+        Returns:
+            Quantizer: the trained quantizer
+        """
+        rows = np.flatnonzero(self.live)
+        if len(rows) == 0:
+            raise ValueError("The store is empty: nothing to train the quantizer on")
+        sample = np.sort(np.random.default_rng(seed).choice(rows, min(sample_size, len(rows)), replace=False))
+        quantizer = get_quantizer(method, **kwargs).fit(np.asarray(self.matrix[sample], dtype=np.float32))
+
+        with open(self._file("codes.bin"), "wb") as f:
+            for start in range(0, self.count, self.chunk_size):
+                f.write(quantizer.encode(self.matrix[start : start + self.chunk_size]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        quantizer.save(self._file("quantizer.npz"))
+        self.quantizer = quantizer
+        self._codes = None
+        self.save()
+        return quantizer
+
+    def memory_usage(self) -> dict:
+        """Bytes of the float vectors and of the quantized codes."""
+        usage = {"vectors": self.count * (self.dimension or 0) * self.dtype.itemsize}
+        if self.quantizer is not None:
+            usage["codes"] = self.count * self.quantizer.code_size
+        return usage
+
+    def _exact_scores(self, queries: np.ndarray, start: int, end: int) -> np.ndarray:
+        return queries @ np.asarray(self.matrix[start:end], dtype=np.float32).T
+
+    def _approximate_scores(self, queries: np.ndarray, start: int, end: int) -> np.ndarray:
+        return self.quantizer.scores(queries, np.asarray(self.codes[start:end]))
+
+    def top_k(self, queries: np.ndarray, k: int = 10, approximate: bool = False) -> tuple:
+        """Top-k cosine similarities of many queries, scanning the memory map in chunks.
+
+        Args:
+            queries (np.ndarray): the query vectors, one for each row
+            k (int, optional): number of neighbours. Defaults to 10.
+            approximate (bool, optional): score the quantized codes instead of the float vectors. Defaults to False.
+
+        Returns:
+            tuple: (rows, scores) matrices of shape (queries, k), sorted by decreasing score
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        score_chunk = self._approximate_scores if approximate else self._exact_scores
+
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, self.count, self.chunk_size):
+            end = min(start + self.chunk_size, self.count)
+            scores = score_chunk(queries, start, end)
+            scores[:, ~self.live[start:end]] = -np.inf
+            top = min(k, end - start)
+            partition = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+            # merge the best of this chunk with the best so far, keeping k
+            rows = np.concatenate([best_rows, partition + start], axis=1)
+            candidates = np.concatenate([best_scores, np.take_along_axis(scores, partition, axis=1)], axis=1)
+            keep = np.argpartition(-candidates, min(k, candidates.shape[1]) - 1, axis=1)[:, :k]
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores = np.take_along_axis(candidates, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def rescore(self, queries: np.ndarray, rows: np.ndarray, k: int) -> tuple:
+        """Rescore the candidate rows of each query with the float vectors, keeping the best k."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.where((norms := np.linalg.norm(queries, axis=1, keepdims=True)) == 0, 1, norms)
+        # read every candidate row once, in file order
+        unique, inverse = np.unique(rows, return_inverse=True)
+        vectors = np.asarray(self.matrix[unique], dtype=np.float32)
+        scores = np.einsum("qd,qcd->qc", queries, vectors[inverse.reshape(rows.shape)])
+        scores[~self.live[rows]] = -np.inf
+        order = np.argsort(-scores, axis=1)[:, :k]
+        return np.take_along_axis(rows, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+    def search_batch(
+        self,
+        vectors: np.ndarray,
+        limit: int = 10,
+        filters: dict = None,
+        rescore: bool = True,
+        oversampling: float = None,
+    ) -> List[List[SearchResult]]:
+        """Search the nearest neighbours of many vectors.
+
+        Without quantization the search is exact. With quantization the codes select `limit * oversampling`
+        candidates, rescored with the float vectors when `rescore` (otherwise the approximate scores are returned).
+        """
+        if filters:
+            raise ValueError("The embedding store doesn't store payloads: filters are not supported")
+        if self.count == 0:
+            return [[] for _ in np.atleast_2d(vectors)]
+        if self.quantizer is None:
+            rows, scores = self.top_k(vectors, k=limit)
+        elif not rescore:
+            rows, scores = self.top_k(vectors, k=limit, approximate=True)
+        else:
+            candidates = max(limit, int(np.ceil(limit * (oversampling or self.oversampling))))
+            rows, _ = self.top_k(vectors, k=candidates, approximate=True)
+            rows, scores = self.rescore(vectors, rows, k=limit)
+        return [
+            [
+                SearchResult(id=self.ids[row], score=float(score))
+                for row, score in zip(query_rows, query_scores)
+                if np.isfinite(score)
+            ]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+
+    def search(self, vector: np.ndarray, limit: int = 10, filters: dict = None, **kwargs) -> List[SearchResult]:
+        return self.search_batch(vector, limit=limit, filters=filters, **kwargs)[0]
+
+
+def benchmark(
+    store: EmbeddingStore, queries: np.ndarray, k: int = 10, oversampling_values: tuple = (1, 2, 4, 8)
+) -> list:
+    """Measure the memory saved by the quantization of the store against the loss of recall@k.
+
+    Args:
+        store (EmbeddingStore): a quantized store
+        queries (np.ndarray): the query vectors
+        k (int, optional): number of neighbours. Defaults to 10.
+        oversampling_values (tuple, optional): oversampling factors of the rescored search. Defaults to (1, 2, 4, 8).
+
+    Returns:
+        list: one dict for each search mode with the recall, the latency in milliseconds and the memory ratio
+    """
+    usage = store.memory_usage()
+    ratio = usage["codes"] / usage["vectors"]
+    print(
+        f"{store.quantizer.method}: vectors {usage['vectors'] / 2**20:.1f}MB, codes {usage['codes'] / 2**20:.1f}MB "
+        f"({1 - ratio:.1%} saved)"
+    )
+
+    def run(**kwargs):
+        start = time.perf_counter()
+        results = store.search_batch(queries, limit=k, **kwargs)
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+        return [{hit.id for hit in hits} for hits in results], latency
+
+    rows, _ = store.top_k(queries, k=k)
+    exact = [{store.ids[row] for row in query_rows} for query_rows in rows]
+    modes = [("no rescore", {"rescore": False})]
+    modes += [(f"oversampling {value}", {"rescore": True, "oversampling": value}) for value in oversampling_values]
+
+    report = []
+    for name, kwargs in modes:
+        found, latency = run(**kwargs)
+        recall = np.mean([len(hits & expected) / len(expected) for hits, expected in zip(found, exact)])
+        report.append({"mode": name, "recall": float(recall), "latency_ms": latency, "memory_ratio": ratio})
+        print(f"{name}: recall@{k} {recall:.3f}, latency {latency:.2f}ms")
+    return report
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(100, 256))
+    data = (centers[rng.integers(0, 100, 50_000)] + rng.normal(scale=0.5, size=(50_000, 256))).astype(np.float32)
+    queries = data[rng.integers(0, len(data), 100)] + rng.normal(scale=0.1, size=(100, 256))
+
+    with tempfile.TemporaryDirectory() as folder:
+        store = EmbeddingStore(folder)
+        store.append([str(index) for index in range(len(data))], data)
+        store.save()
+        for method in ("int8", "pq"):
+            start = time.perf_counter()
+            store.quantize(method)
+            print(f"Quantizer {method} trained and applied in {time.perf_counter() - start:.1f}s")
+            benchmark(store, queries)
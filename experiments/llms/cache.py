@@ -0,0 +1,267 @@
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from experiments.config import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    scope TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    response TEXT NOT NULL,
+    vector BLOB,
+    embedding_model TEXT,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize a prompt for the cache keys: the spacing doesn't change the answer (the case can)."""
+    return " ".join(prompt.split())
+
+
+def scope_key(model: str, params: dict = None) -> str:
+    """Canonical string of the model and of the generation parameters: answers are reused only within a scope."""
+    return json.dumps({"model": model, **(params or {})}, sort_keys=True, default=str)
+
+
+class ResponseCache:
+    """Persistent cache of the LLM answers in a SQLite database, shared by the processes on the machine.
+
+    An answer is found by the exact normalized prompt within its scope (model and generation parameters);
+    with an `embed_function` (texts -> vectors) a missing prompt is also matched with the most similar
+    cached prompt of the same scope, when the cosine similarity is at least `similarity_threshold`: only the
+    vectors of the same `embedding_model` (the id of the model of `embed_function`) are compared.
+    The least recently used answers are evicted beyond `max_entries` and the ones older than `ttl`
+    seconds are not returned (and deleted).
+    """
+
+    def __init__(
+        self,
+        path: str = settings.LLM_CACHE_PATH,
+        max_entries: int = settings.LLM_CACHE_MAX_ENTRIES,
+        ttl: float = settings.LLM_CACHE_TTL,
+        embed_function: Callable = None,
+        similarity_threshold: float = settings.LLM_CACHE_SIMILARITY,
+        embedding_model: str = "",
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed_function = embed_function
+        self.similarity_threshold = similarity_threshold
+        self.embedding_model = embedding_model
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._vectors = {}  # scope -> (keys, normalized vectors matrix), loaded on the first semantic lookup
+        self._data_version = None
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # WAL: the readers of the other processes don't wait for the writers
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(responses)")}
+        if "embedding_model" not in columns:  # database of a previous version: its vectors are never compared
+            self._connection.execute("ALTER TABLE responses ADD COLUMN embedding_model TEXT")
+
+    @staticmethod
+    def key(prompt: str, scope: str) -> str:
+        return hashlib.sha256(f"{scope}\0{normalize_prompt(prompt)}".encode("utf8")).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _embed(self, prompt: str) -> np.ndarray:
+        vector = np.asarray(self.embed_function([normalize_prompt(prompt)]), dtype=np.float32)[0]
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _expired_before(self) -> float:
+        return time.time() - self.ttl if self.ttl else float("-inf")
+
+    def _scope_vectors(self, scope: str) -> Tuple[list, np.ndarray]:
+        """The cached vectors of a scope, reloaded when another connection changed the database."""
+        data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._vectors.clear()
+            self._data_version = data_version
+        if scope not in self._vectors:
+            rows = self._connection.execute(
+                "SELECT key, vector FROM responses "
+                "WHERE scope = ? AND embedding_model = ? AND vector IS NOT NULL AND created >= ?",
+                (scope, self.embedding_model, self._expired_before()),
+            ).fetchall()
+            keys = [key for key, _ in rows]
+            matrix = np.vstack([np.frombuffer(vector, dtype=np.float32) for _, vector in rows]) if rows else None
+            self._vectors[scope] = (keys, matrix)
+        return self._vectors[scope]
+
+    def lookup(self, prompt: str, model: str, params: dict = None) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """Find the answer of a prompt, returning (answer or None, vector of the prompt to pass to `put`)."""
+        scope = scope_key(model, params)
+        key = self.key(prompt, scope)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] < self._expired_before():
+                self._delete([key])
+                self.expirations += 1
+                row = None
+            if row is not None:
+                self._touch(key, now)
+                self.hits += 1
+                return row[0], None
+        if self.embed_function is None:
+            with self._lock:
+                self.misses += 1
+            return None, None
+
+        # the embedding is computed outside the lock, the other lookups don't wait for the model
+        vector = self._embed(prompt)
+        with self._lock:
+            keys, matrix = self._scope_vectors(scope)
+            if matrix is not None:
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    row = self._connection.execute(
+                        "SELECT response FROM responses WHERE key = ? AND created >= ?",
+                        (keys[best], self._expired_before()),
+                    ).fetchone()
+                    if row is not None:
+                        self._touch(keys[best], now)
+                        self.hits += 1
+                        self.semantic_hits += 1
+                        logger.debug(f"Semantic cache hit with similarity {scores[best]:.3f}")
+                        return row[0], vector
+            self.misses += 1
+        return None, vector
+
+    def get(self, prompt: str, model: str, params: dict = None) -> Optional[str]:
+        return self.lookup(prompt, model, params)[0]
+
+    def put(self, prompt: str, model: str, response: str, params: dict = None, vector: np.ndarray = None):
+        """Cache the answer of a prompt (`vector` is the one returned by `lookup`, computed if missing)."""
+        scope = scope_key(model, params)
+        if self.embed_function is not None and vector is None:
+            vector = self._embed(prompt)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, scope, prompt, response, vector, embedding_model, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.key(prompt, scope),
+                    scope,
+                    normalize_prompt(prompt),
+                    response,
+                    None if vector is None else np.asarray(vector, dtype=np.float32).tobytes(),
+                    None if vector is None else self.embedding_model,
+                    now,
+                    now,
+                ),
+            )
+            self._vectors.pop(scope, None)
+            self._evict()
+            self._connection.commit()
+
+    def cached(self, prompt: str, model: str, generate: Callable[[], str], params: dict = None) -> Tuple[str, bool]:
+        """Return (answer, True) from the cache, or (answer of `generate()`, False) caching it."""
+        response, vector = self.lookup(prompt, model, params)
+        if response is not None:
+            return response, True
+        response = generate()
+        self.put(prompt, model, response, params=params, vector=vector)
+        return response, False
+
+    def _touch(self, key: str, now: float):
+        self._connection.execute("UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        self._connection.commit()
+
+    def _delete(self, keys: list):
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+        self._connection.commit()
+        self._vectors.clear()
+
+    def _evict(self):
+        excess = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,)
+            )
+            self.evictions += excess
+            self._vectors.clear()
+
+    def expire(self) -> int:
+        """Delete the expired answers, returning how many."""
+        with self._lock:
+            cursor = self._connection.execute("DELETE FROM responses WHERE created < ?", (self._expired_before(),))
+            deleted = cursor.rowcount
+            self._connection.commit()
+            self._vectors.clear()
+            self.expirations += deleted
+            return deleted
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+            self._vectors.clear()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_response_cache(semantic: bool = settings.LLM_CACHE_SEMANTIC) -> ResponseCache:
+    """Get the process-wide response cache; with `semantic` the prompts are matched also by similarity,
+    with the embeddings of `experiments.embeddings.generate.EmbeddingService`.
+    """
+    embed_function, embedding_model = None, ""
+    if semantic:
+        from experiments.embeddings.generate import EmbeddingService
+
+        service = EmbeddingService(backend="hugging_face")
+        embed_function, embedding_model = service.embed, service.cache_model
+    cache = ResponseCache(embed_function=embed_function, embedding_model=embedding_model)
+    atexit.register(lambda: logger.info(f"LLM response cache: {cache.stats()}"))
+    return cache
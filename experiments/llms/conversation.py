@@ -0,0 +1,478 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import typer
+from langchain.chains import ConversationChain
+from langchain.memory.utils import get_prompt_input_key
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.memory import BaseMemory
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.pydantic_v1 import PrivateAttr
+from loguru import logger
+
+from experiments.config import settings
+from experiments.llms.cache import ResponseCache, get_response_cache
+
+app = typer.Typer()
+
+SUMMARY_PROMPT = """Progressively summarize the lines of conversation provided, adding onto the previous summary \
+and returning a new summary of at most {words} words. Keep names, facts, decisions and open questions.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+RECALL_HEADER = "Relevant earlier exchanges:\n"
+SECTION_SEPARATOR = "\n\n"
+
+
+def token_counter(model: str = "gpt-4") -> Callable[[str], int]:
+    """Return a function counting the tokens of a text: exact with tiktoken when installed, otherwise an
+    estimate of 4 characters per token (good enough to keep a budget, not to bill).
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        logger.debug("tiktoken not installed, estimating 4 characters per token")
+        return lambda text: (len(text) + 3) // 4
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class OpenAIChat(BaseChatModel):
+    """Chat model on the OpenAI chat completions API (openai 0.28 client), also usable with the local
+    server of `experiments.llms.server` through `api_base`. The token usage returned by the API is passed
+    to the callbacks in `llm_output["token_usage"]`.
+    """
+
+    model_name: str = "gpt-4"
+    temperature: float = 0.0
+    max_tokens: Optional[int] = None
+    api_base: Optional[str] = None
+    api_key: Optional[str] = None
+    request_timeout: float = 120.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "openai-chat"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name, "temperature": self.temperature, "api_base": self.api_base}
+
+    def _generate(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs
+    ) -> ChatResult:
+        import openai
+
+        roles = {"human": "user", "ai": "assistant", "system": "system"}
+        response = openai.ChatCompletion.create(
+            model=self.model_name,
+            messages=[{"role": roles.get(message.type, "user"), "content": message.content} for message in messages],
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stop=stop,
+            api_base=self.api_base,
+            api_key=self.api_key or settings.OPENAI_KEY or None,
+            request_timeout=self.request_timeout,
+            **kwargs,
+        )
+        generations = [
+            ChatGeneration(
+                message=AIMessage(content=choice["message"]["content"]),
+                generation_info={"finish_reason": choice.get("finish_reason")},
+            )
+            for choice in response["choices"]
+        ]
+        usage = dict(response.get("usage", {}))
+        return ChatResult(generations=generations, llm_output={"token_usage": usage, "model_name": self.model_name})
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """Keep the token usage reported by the last LLM call (if the model reports it)."""
+
+    def __init__(self):
+        self.last_usage = {}
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.last_usage = {}
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.last_usage = {}
+
+    def on_llm_end(self, response, **kwargs):
+        self.last_usage = dict((response.llm_output or {}).get("token_usage") or {})
+
+
+@dataclass
+class Turn:
+    """An exchange of the conversation and its size in tokens."""
+
+    human: str
+    ai: str
+    tokens: int
+    vector: Optional[np.ndarray] = None
+
+    def format(self, human_prefix: str = "Human", ai_prefix: str = "AI") -> str:
+        return f"{human_prefix}: {self.human}\n{ai_prefix}: {self.ai}"
+
+
+class SummaryBufferMemory(BaseMemory):
+    """Conversation memory with a fixed token budget, for the prompt not to grow with the conversation.
+
+    The history given to the prompt is made of:
+
+    - a running summary of the older turns, updated incrementally by `llm` in a background thread when the
+      turns are evicted from the buffer (the turn in progress doesn't wait for the summarization, it uses
+      the summary available at that moment),
+    - optionally, the old turns most similar to the new input (`embed_function` maps a list of texts to
+      their vectors), up to `recall_tokens`,
+    - the most recent turns verbatim, evicting the oldest ones until the whole history fits in `max_tokens`;
+      the evicted turns stay verbatim (the newest ones that fit, at least the last one) until the summary
+      includes them.
+
+    The history is computed once for every state of the memory and input: the chain and the response cache
+    key of `Conversation` share it.
+    """
+
+    llm: Any  # the model writing the summary (a langchain chat model or LLM)
+    max_tokens: int = settings.CONVERSATION_MAX_TOKENS
+    summary_words: int = settings.CONVERSATION_SUMMARY_WORDS
+    recall_tokens: int = settings.CONVERSATION_RECALL_TOKENS
+    recall_k: int = 3
+    recall_min_score: float = 0.3
+    embed_function: Optional[Callable[[List[str]], Any]] = None
+    count_tokens: Optional[Callable[[str], int]] = None
+    background: bool = True
+    memory_key: str = "history"
+    input_key: Optional[str] = None
+    output_key: Optional[str] = None
+    human_prefix: str = "Human"
+    ai_prefix: str = "AI"
+
+    _buffer: List[Turn] = PrivateAttr(default_factory=list)
+    _pending: List[Turn] = PrivateAttr(default_factory=list)  # evicted, not summarized yet
+    _archive: List[Turn] = PrivateAttr(default_factory=list)  # evicted, searchable for recall
+    _summary: str = PrivateAttr(default="")
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _executor: Any = PrivateAttr(default=None)
+    _future: Any = PrivateAttr(default=None)
+    _last: dict = PrivateAttr(default_factory=dict)
+    _version: int = PrivateAttr(default=0)  # changes of the memory, for the history memo
+    _memo: tuple = PrivateAttr(default=(None, None))  # ((version, input), memory variables)
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.count_tokens is None:
+            self.count_tokens = token_counter(getattr(self.llm, "model_name", "gpt-4"))
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    @property
+    def summary(self) -> str:
+        return self._summary
+
+    @property
+    def stats(self) -> dict:
+        """Size of the history given to the last prompt."""
+        return dict(self._last)
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, str]:
+        query = inputs[self.input_key or get_prompt_input_key(inputs, self.memory_variables)]
+        with self._lock:
+            key, variables = self._memo
+            if key == (self._version, query):
+                return dict(variables)
+            version, summary, pending, buffer = self._version, self._summary, list(self._pending), list(self._buffer)
+        recalled = self._recall(query) if self.embed_function and self._archive else []
+        summary_tokens = self._summary_tokens(summary)
+        used = summary_tokens + sum(turn.tokens for turn in recalled + buffer)
+        recent = self._unsummarized(pending, self.max_tokens - used) + buffer
+        sections = []
+        if summary:
+            sections.append(SUMMARY_HEADER + summary)
+        if recalled:
+            sections.append(RECALL_HEADER + self._format(recalled))
+        if recent:
+            sections.append(self._format(recent))
+        history = SECTION_SEPARATOR.join(sections)
+        self._last = {
+            "history_tokens": self.count_tokens(history),
+            "summary_tokens": summary_tokens,
+            "recent_turns": len(recent),
+            "recalled_turns": len(recalled),
+            "summarized_turns": len(self._archive),
+            "pending_turns": len(pending),
+        }
+        variables = {self.memory_key: history}
+        with self._lock:
+            self._memo = ((version, query), variables)
+        return dict(variables)
+
+    @staticmethod
+    def _unsummarized(pending: List[Turn], budget: int) -> List[Turn]:
+        """The newest evicted turns not summarized yet that fit in the budget (at least the last one), which
+        would be missing from the history until the summarization ends.
+        """
+        kept, tokens = [], 0
+        for turn in reversed(pending):
+            if kept and tokens + turn.tokens > budget:
+                break
+            kept.insert(0, turn)
+            tokens += turn.tokens
+        return kept
+
+    def _summary_tokens(self, summary: str) -> int:
+        """Tokens of the summary section of the history, with its header and the separator of the next one."""
+        return self.count_tokens(SUMMARY_HEADER + summary + SECTION_SEPARATOR) if summary else 0
+
+    def _format(self, turns: List[Turn]) -> str:
+        return "\n".join(turn.format(self.human_prefix, self.ai_prefix) for turn in turns)
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        input_key = self.input_key or get_prompt_input_key(inputs, self.memory_variables)
+        output_key = self.output_key or next(iter(outputs))
+        turn = Turn(inputs[input_key], outputs[output_key], 0)
+        turn.tokens = self.count_tokens(turn.format(self.human_prefix, self.ai_prefix))
+        with self._lock:
+            self._buffer.append(turn)
+            evicted = self._evict()
+            self._pending.extend(evicted)
+            self._version += 1
+        if evicted:
+            if self.background:
+                if self._future is None or self._future.done():
+                    self._future = self._executor.submit(self._summarize)
+            else:
+                self._summarize()
+
+    def _evict(self) -> List[Turn]:
+        """Evict the oldest turns (but the last one) for the history to fit in the budget."""
+        budget = self.max_tokens - self._summary_tokens(self._summary)
+        if self.embed_function:
+            budget -= self.recall_tokens
+        evicted = []
+        total = sum(turn.tokens for turn in self._buffer)
+        while total > budget and len(self._buffer) > 1:
+            turn = self._buffer.pop(0)
+            total -= turn.tokens
+            evicted.append(turn)
+        return evicted
+
+    def _summarize(self):
+        """Fold the pending turns in the summary, until there are none left."""
+        while True:
+            with self._lock:
+                pending, summary = list(self._pending), self._summary
+            if not pending:
+                return
+            start = time.perf_counter()
+            prompt = SUMMARY_PROMPT.format(
+                words=self.summary_words,
+                summary=summary or "(none)",
+                new_lines=self._format(pending),
+            )
+            try:
+                result = self.llm.invoke(prompt)
+                if self.embed_function:
+                    vectors = self._embed([turn.format(self.human_prefix, self.ai_prefix) for turn in pending])
+                    for turn, vector in zip(pending, vectors):
+                        turn.vector = vector
+            except Exception as error:
+                # the turns stay pending and are folded in with the next ones
+                logger.exception(f"Summarization of {len(pending)} turns failed: {error}")
+                return
+            with self._lock:
+                self._summary = getattr(result, "content", result).strip()
+                del self._pending[: len(pending)]
+                self._archive.extend(pending)
+                # a longer summary leaves less room to the recent turns
+                self._pending.extend(self._evict())
+                self._version += 1
+            logger.debug(f"Summarized {len(pending)} turns in {time.perf_counter() - start:.2f}s")
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.asarray(self.embed_function(texts), dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _recall(self, text: str) -> List[Turn]:
+        """The archived turns most similar to the input, in conversation order, within the recall budget."""
+        archive = [turn for turn in self._archive if turn.vector is not None]
+        if not archive:
+            return []
+        query = self._embed([text])[0]
+        scores = np.stack([turn.vector for turn in archive]) @ query
+        recalled, tokens = [], self.count_tokens(RECALL_HEADER + SECTION_SEPARATOR)
+        for index in np.argsort(-scores)[: self.recall_k]:
+            if scores[index] < self.recall_min_score or tokens + archive[index].tokens > self.recall_tokens:
+                continue
+            recalled.append(index)
+            tokens += archive[index].tokens
+        return [archive[index] for index in sorted(recalled)]
+
+    def wait(self):
+        """Wait for the background summarization in progress."""
+        if self._future is not None:
+            self._future.result()
+
+    def clear(self) -> None:
+        self.wait()
+        with self._lock:
+            self._buffer, self._pending, self._archive, self._summary = [], [], [], ""
+            self._version += 1
+
+
+@dataclass
+class TurnReport:
+    """Prompt size and latency of a conversation turn."""
+
+    turn: int
+    prompt_tokens: int  # reported by the API, or counted on the prompt
+    completion_tokens: int
+    history_tokens: int
+    summary_tokens: int
+    recent_turns: int
+    recalled_turns: int
+    summarized_turns: int
+    latency: float
+    cached: bool = False  # answer from the response cache, the model was not called
+
+    def __str__(self) -> str:
+        if self.cached:
+            return f"turn {self.turn}: cached answer (history {self.history_tokens} tokens), {self.latency:.2f}s"
+        return (
+            f"turn {self.turn}: prompt {self.prompt_tokens} tokens (history {self.history_tokens}, summary "
+            f"{self.summary_tokens}), {self.recent_turns} recent / {self.recalled_turns} recalled / "
+            f"{self.summarized_turns} summarized turns, {self.completion_tokens} completion tokens, {self.latency:.2f}s"
+        )
+
+
+class Conversation:
+    """A langchain `ConversationChain` with the token bounded memory, reporting the prompt tokens of every turn.
+
+    With a `response_cache` the answers (with temperature 0) are cached by (memory history, input): the same
+    question in the same state of the conversation is answered without calling the model.
+    """
+
+    def __init__(
+        self,
+        llm: BaseChatModel = None,
+        memory: BaseMemory = None,
+        verbose: bool = False,
+        response_cache: ResponseCache = None,
+        **memory_kwargs,
+    ):
+        self.llm = llm or OpenAIChat()
+        self.response_cache = response_cache
+        memory = memory or SummaryBufferMemory(llm=self.llm, **memory_kwargs)
+        self.usage = TokenUsageHandler()
+        self.chain = ConversationChain(llm=self.llm, memory=memory, verbose=verbose)
+        # pydantic validation copies the memory: the chain updates its own copy
+        self.memory = self.chain.memory
+        self.reports: List[TurnReport] = []
+
+    def send(self, text: str) -> str:
+        start = time.perf_counter()
+        inputs = {self.chain.input_key: text}
+        cache_params = None
+        if self.response_cache is not None and getattr(self.llm, "temperature", 0) == 0:
+            # the memory computes the history once: the chain reuses it
+            history = json.dumps(self.memory.load_memory_variables(inputs), sort_keys=True, default=str)
+            cache_params = {"history": hashlib.sha256(history.encode("utf8")).hexdigest()}
+            response, vector = self.response_cache.lookup(text, self.llm._get_llm_string(), cache_params)
+            if response is not None:
+                self.memory.save_context(inputs, {self.chain.output_key: response})
+                return self._report(text, response, start, cached=True)
+
+        response = self.chain.invoke(inputs, config={"callbacks": [self.usage]})[self.chain.output_key]
+        if cache_params is not None:
+            self.response_cache.put(text, self.llm._get_llm_string(), response, params=cache_params, vector=vector)
+        return self._report(text, response, start)
+
+    def _report(self, text: str, response: str, start: float, cached: bool = False) -> str:
+        stats = getattr(self.memory, "stats", {})
+        count = getattr(self.memory, "count_tokens", None) or token_counter()
+        usage = {} if cached else self.usage.last_usage
+        prompt_tokens = usage.get("prompt_tokens")
+        if not prompt_tokens and not cached:
+            # the model doesn't report the usage: template and input, plus the history
+            prompt_tokens = count(self.chain.prompt.format(input=text, history="")) + stats.get("history_tokens", 0)
+        report = TurnReport(
+            turn=len(self.reports) + 1,
+            prompt_tokens=prompt_tokens or 0,
+            completion_tokens=0 if cached else usage.get("completion_tokens") or count(response),
+            history_tokens=stats.get("history_tokens", 0),
+            summary_tokens=stats.get("summary_tokens", 0),
+            recent_turns=stats.get("recent_turns", 0),
+            recalled_turns=stats.get("recalled_turns", 0),
+            summarized_turns=stats.get("summarized_turns", 0),
+            latency=time.perf_counter() - start,
+            cached=cached,
+        )
+        self.reports.append(report)
+        logger.debug(str(report))
+        return response
+
+
+@app.callback()
+def main():
+    """Conversations with a bounded history."""
+
+
+@app.command()
+def chat(
+    server_url: str = None,
+    model: str = "gpt-4",
+    max_tokens: int = settings.CONVERSATION_MAX_TOKENS,
+    recall: bool = False,
+    temperature: float = 0.0,
+    cache: bool = False,
+    semantic_cache: bool = settings.LLM_CACHE_SEMANTIC,
+):
+    """Chat with GPT-4 (or with `experiments.llms.server` with --server-url, for example http://127.0.0.1:8000/v1)
+    keeping the history within --max-tokens; with --recall the old turns similar to the input are retrieved
+    with the embedding model; with --cache the answers are reused from the response cache (--semantic-cache
+    also for similar questions). The prompt tokens of every turn are printed on stderr.
+    """
+    llm = OpenAIChat(model_name="local" if server_url else model, temperature=temperature, api_base=server_url)
+    embed_function = None
+    if recall:
+        from experiments.embeddings.generate import EmbeddingService
+
+        embed_function = EmbeddingService(backend="hugging_face").embed
+    response_cache = get_response_cache(semantic_cache) if cache else None
+    conversation = Conversation(
+        llm, response_cache=response_cache, max_tokens=max_tokens, embed_function=embed_function
+    )
+
+    while True:
+        input_text = typer.prompt("Enter your text (or 'exit' to stop):")
+        if input_text.lower() == "exit":
+            break
+        print(conversation.send(input_text))
+        typer.echo(str(conversation.reports[-1]), err=True)
+
+
+if __name__ == "__main__":
+    app()
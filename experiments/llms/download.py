@@ -1,17 +1,59 @@
+import json
+from typing import List
+
+import typer
+
 from experiments.config import settings
-from huggingface_hub import snapshot_download
-import os
+from experiments.model_manager import get_model_manager
+
+MISTRAL_MODEL_ID = "mistralai/Mistral-7B-v0.3"
+# transformers needs only the sharded safetensors, the configs and the tokenizer: the consolidated
+# checkpoint (for mistral-inference) and the pytorch bins are not downloaded
+MISTRAL_ALLOW_PATTERNS = ["*.json", "model-*.safetensors", "tokenizer.model"]
+
+app = typer.Typer()
+
+
+def download_mistral(revision: str = "main", allow_patterns: List[str] = MISTRAL_ALLOW_PATTERNS) -> str:
+    """Download the Mistral snapshot with the model manager, returning its local folder."""
+    return get_model_manager().download(MISTRAL_MODEL_ID, revision=revision, allow_patterns=allow_patterns)
+
+
+@app.command()
+def download(
+    repo_id: str = MISTRAL_MODEL_ID,
+    revision: str = "main",
+    allow: List[str] = typer.Option(None, help="glob patterns of the files to download (repeatable)"),
+    ignore: List[str] = typer.Option(None, help="glob patterns of the files to skip (repeatable)"),
+):
+    """Download a model revision in the models path (only the missing files, resuming the partial ones)."""
+    if repo_id == MISTRAL_MODEL_ID and not allow:
+        allow = MISTRAL_ALLOW_PATTERNS
+    typer.echo(get_model_manager().download(repo_id, revision=revision, allow_patterns=allow, ignore_patterns=ignore))
+
+
+@app.command(name="list")
+def list_models():
+    """List the downloaded models and revisions."""
+    for row in get_model_manager().models():
+        typer.echo(json.dumps(row))
+
+
+@app.command()
+def verify(repo_id: str = MISTRAL_MODEL_ID, revision: str = "main"):
+    """Check again the checksums of a downloaded revision."""
+    corrupted = get_model_manager().verify(repo_id, revision)
+    for path in corrupted:
+        typer.echo(f"corrupted: {path}")
+    raise typer.Exit(code=1 if corrupted else 0)
 
-mistral_models_path = settings.MISTRAL_MODEL_PATH
 
-if not os.path.exists(mistral_models_path):
-    os.makedirs(mistral_models_path)
+@app.command()
+def gc(keep: int = settings.MODEL_REVISIONS_KEPT, dry_run: bool = False):
+    """Remove the revisions not pointed by a ref, except the most recently used ones."""
+    freed = get_model_manager().gc(keep=keep, dry_run=dry_run)
+    typer.echo(f"{'To free' if dry_run else 'Freed'}: {freed / 2**20:.1f}MB")
 
-settings._authenticate_hugging_face()
 
 if __name__ == "__main__":
-    snapshot_download(
-        repo_id="mistralai/Mistral-7B-v0.3",
-        local_dir=mistral_models_path,
-        force_download=False,
-    )
+    app()
@@ -1,23 +1,342 @@
-import torch
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
+from typing import Iterator, List
+
+import numpy as np
 import typer
+from loguru import logger
+
 from experiments.config import settings
-from transformers import AutoModelForCausalLM, AutoTokenizer, AutoModelForSequenceClassification
+from experiments.embeddings.generate import get_device
+from experiments.llms.cache import ResponseCache, get_response_cache
+from experiments.llms.download import MISTRAL_MODEL_ID
+from experiments.model_manager import resolve_model_path
+
+# torch and transformers are imported on first use: the chat client doesn't need them with a server
 
 app = typer.Typer()
 
 
-@app.command()
-def chat():
-    # Load the model and tokenizer
-    model_name = "mistralai/Mistral-7B-v0.3"  # Replace with the desired LLaMA model
-    # model_name = settings.MISTRAL_MODEL_PATH
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    # model = AutoModelForSequenceClassification.from_pretrained(model_name)
-
-    # Move the model to the GPU
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+def resolve_model(model_path: str = settings.MISTRAL_MODEL_PATH) -> str:
+    """Use the snapshot in `model_path` if present, otherwise the one downloaded by `experiments.llms.download`
+    (resolved offline from the index of the model manager), otherwise the hub model.
+    """
+    if os.path.isdir(model_path) and os.path.exists(os.path.join(model_path, "config.json")):
+        return model_path
+    source = resolve_model_path(MISTRAL_MODEL_ID)
+    if source == MISTRAL_MODEL_ID:
+        logger.warning(f"No model snapshot in {model_path}, loading {MISTRAL_MODEL_ID} from the hub")
+    return source
+
+
+@lru_cache(maxsize=None)
+def get_model(
+    model_path: str = settings.MISTRAL_MODEL_PATH, device: str = None, runtime: str = settings.LLM_RUNTIME
+) -> tuple:
+    """Load the causal language model and its tokenizer only once for each (model, device, runtime) in the process.
+
+    Args:
+        model_path (str, optional): the local snapshot. Defaults to settings.MISTRAL_MODEL_PATH.
+        device (str, optional): the torch device. Defaults to None (cuda if available).
+        runtime (str, optional): pytorch, or onnx / onnx-int8 with onnxruntime on CPU (the model is exported
+            on first use). Defaults to settings.LLM_RUNTIME.
+
+    Returns:
+        tuple: (tokenizer, model, device)
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    source = resolve_model(model_path)
+    tokenizer = AutoTokenizer.from_pretrained(source)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    if runtime != "pytorch":
+        from optimum.onnxruntime import ORTModelForCausalLM
+
+        from experiments.onnx_runtime import load_onnx_model
+
+        model = load_onnx_model(source, ORTModelForCausalLM, runtime, use_cache=True, use_io_binding=False)
+        # the optimum models keep the keys/values in tuples: `generate` must not create a cache object
+        model._supports_cache_class = False
+        return tokenizer, model, "cpu"
+
+    device = device or get_device()
+    model = AutoModelForCausalLM.from_pretrained(source)
     model.to(device)
+    model.eval()
+    return tokenizer, model, device
+
+
+def generate(
+    prompt: str,
+    max_new_tokens: int = 50,
+    model_path: str = settings.MISTRAL_MODEL_PATH,
+    runtime: str = settings.LLM_RUNTIME,
+) -> str:
+    """Generate the continuation of a prompt with the model loaded in the process."""
+    import torch
+
+    tokenizer, model, device = get_model(model_path, runtime=runtime)
+    inputs = tokenizer(prompt, return_tensors="pt").to(device)
+    input_ids = inputs.input_ids
+    with torch.inference_mode():
+        output = model.generate(
+            input_ids,
+            attention_mask=inputs.attention_mask,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    return tokenizer.decode(output[0, input_ids.shape[1] :], skip_special_tokens=True)
+
+
+def chat_prompt(tokenizer, messages: List[dict]) -> str:
+    """Format the chat messages with the chat template of the tokenizer (or a plain role: content format)."""
+    if getattr(tokenizer, "chat_template", None):
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return "\n".join(f"{message['role']}: {message['content']}" for message in messages) + "\nassistant:"
+
+
+def chat_tokens(tokenizer, messages: List[dict]) -> List[int]:
+    """Token ids of the chat messages followed by the prompt of the assistant answer."""
+    if getattr(tokenizer, "chat_template", None):
+        return tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+    return tokenizer(chat_prompt(tokenizer, messages)).input_ids
+
+
+def sample(logits, temperature: float = 0.0, top_p: float = 1.0) -> int:
+    """Pick the next token from the logits of the last position: greedy, or nucleus sampling with temperature."""
+    import torch
+
+    if temperature <= 0:
+        return int(logits.argmax())
+    probabilities = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probabilities, indices = probabilities.sort(descending=True)
+        # keep the smallest set of tokens with cumulative probability >= top_p
+        outside = sorted_probabilities.cumsum(dim=-1) - sorted_probabilities > top_p
+        sorted_probabilities[outside] = 0.0
+        return int(indices[torch.multinomial(sorted_probabilities, 1)])
+    return int(torch.multinomial(probabilities, 1))
+
+
+def crop_cache(cache, length: int):
+    """Keep the keys/values of the first `length` tokens: a `DynamicCache`, or the tuples of the ONNX models."""
+    if hasattr(cache, "crop"):
+        cache.crop(length)
+        return cache
+    return tuple(tuple(tensor[:, :, :length] for tensor in layer) for layer in cache)
+
+
+@dataclass
+class TurnMetrics:
+    """Latencies of a chat turn: time to first token and inter token latencies."""
+
+    prompt_tokens: int = 0
+    reused_tokens: int = 0  # prompt tokens whose keys/values were already cached
+    generated_tokens: int = 0
+    time_to_first_token: float = 0.0
+    inter_token_latencies: List[float] = field(default_factory=list)
+    elapsed: float = 0.0
+    cached: bool = False  # answer from the response cache
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.generated_tokens / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        if self.cached:
+            return f"cached answer in {self.elapsed * 1000:.1f}ms"
+        latencies = np.asarray(self.inter_token_latencies) * 1000
+        mean = latencies.mean() if len(latencies) else 0.0
+        p95 = np.percentile(latencies, 95) if len(latencies) else 0.0
+        return (
+            f"prompt {self.prompt_tokens} tokens ({self.reused_tokens} cached), {self.generated_tokens} generated, "
+            f"TTFT {self.time_to_first_token * 1000:.0f}ms, inter token {mean:.0f}ms (p95 {p95:.0f}ms), "
+            f"{self.tokens_per_second:.1f} tokens/sec"
+        )
+
+
+class ChatSession:
+    """Multi turn chat keeping the keys/values of the conversation cached between the turns.
+
+    Every turn renders the whole conversation with the chat template, reuses the cached keys/values of the
+    longest common prefix with the previous context and runs the model only on the new tokens; the answer
+    is decoded token by token and streamed. When the conversation doesn't fit in `max_context` tokens the
+    oldest turns are evicted (the system message is kept) down to `max_context - reserve` tokens, so the
+    cache is rebuilt only once in a while.
+
+    With a `response_cache` the greedy answers are cached by (conversation so far, user message): a repeated
+    conversation is answered without running the model.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        model,
+        device: str,
+        max_context: int = settings.LLM_MAX_CONTEXT,
+        reserve: int = None,
+        system_prompt: str = None,
+        response_cache: ResponseCache = None,
+    ):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.max_context = max_context
+        self.reserve = reserve if reserve is not None else max_context // 4
+        self.messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        self.context = []  # token ids whose keys/values are in the cache
+        self.cache = None
+        self.metrics = []
+        self.response_cache = response_cache
+        self.model_name = getattr(getattr(model, "config", None), "_name_or_path", None) or "local"
+
+    def _fit(self, max_new_tokens: int) -> List[int]:
+        """Render the conversation, evicting the oldest turns if it doesn't fit in the context."""
+        tokens = chat_tokens(self.tokenizer, self.messages)
+        if len(tokens) + max_new_tokens <= self.max_context:
+            return tokens
+        limit = max(self.max_context - max(self.reserve, max_new_tokens), 1)
+        first = 1 if self.messages and self.messages[0]["role"] == "system" else 0
+        # drop the oldest user/assistant pairs, always keeping the last user message
+        while len(tokens) > limit and len(self.messages) - first > 1:
+            drop = 2 if len(self.messages) - first > 2 else 1
+            del self.messages[first : first + drop]
+            tokens = chat_tokens(self.tokenizer, self.messages)
+        if len(tokens) > limit:
+            tokens = tokens[-limit:]  # a single message longer than the context: keep its end
+        return tokens
+
+    def _reuse(self, tokens: List[int]) -> int:
+        """Crop the cache to the longest common prefix of the cached context and the new tokens."""
+        common = 0
+        for cached, token in zip(self.context, tokens):
+            if cached != token:
+                break
+            common += 1
+        # at least the last token must be run to get the logits of the next one
+        common = min(common, len(tokens) - 1)
+        if self.cache is not None:
+            self.cache = crop_cache(self.cache, common) if common else None
+        self.context = self.context[:common]
+        return common
+
+    def stream(
+        self, text: str, max_new_tokens: int = 256, temperature: float = 0.0, top_p: float = 1.0
+    ) -> Iterator[str]:
+        """Add a user message and stream the pieces of text of the answer as they are generated."""
+        import torch
+        from transformers import DynamicCache
+
+        cache_params = None
+        if self.response_cache is not None and temperature == 0:
+            history = json.dumps(self.messages, ensure_ascii=False).encode("utf8")
+            cache_params = {"max_new_tokens": max_new_tokens, "history": hashlib.sha256(history).hexdigest()}
+            start = time.perf_counter()
+            answer, vector = self.response_cache.lookup(text, self.model_name, cache_params)
+            if answer is not None:
+                self.messages += [{"role": "user", "content": text}, {"role": "assistant", "content": answer}]
+                self.metrics.append(TurnMetrics(elapsed=time.perf_counter() - start, cached=True))
+                yield answer
+                return
+
+        self.messages.append({"role": "user", "content": text})
+        tokens = self._fit(max_new_tokens)
+        metrics = TurnMetrics(prompt_tokens=len(tokens), reused_tokens=self._reuse(tokens))
+        # the ONNX models (not torch modules) take and return the keys/values as tuples
+        if self.cache is None and isinstance(self.model, torch.nn.Module):
+            self.cache = DynamicCache()
+
+        start = last = time.perf_counter()
+        pending = tokens[len(self.context) :]
+        generated, emitted = [], ""
+        with torch.inference_mode():
+            for _ in range(max_new_tokens):
+                input_ids = torch.tensor([pending], device=self.device)
+                total = len(self.context) + len(pending)
+                output = self.model(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones((1, total), dtype=torch.long, device=self.device),
+                    position_ids=torch.arange(len(self.context), total, device=self.device).unsqueeze(0),
+                    past_key_values=self.cache,
+                    use_cache=True,
+                )
+                self.cache = output.past_key_values
+                self.context.extend(pending)
+                token = sample(output.logits[0, -1], temperature=temperature, top_p=top_p)
+
+                now = time.perf_counter()
+                if not generated:
+                    metrics.time_to_first_token = now - start
+                else:
+                    metrics.inter_token_latencies.append(now - last)
+                last = now
+                if token == self.tokenizer.eos_token_id:
+                    break
+                generated.append(token)
+                pending = [token]
+
+                decoded = self.tokenizer.decode(generated, skip_special_tokens=True)
+                # a multi byte character split in more tokens is emitted when complete
+                if not decoded.endswith("\ufffd") and len(decoded) > len(emitted):
+                    yield decoded[len(emitted) :]
+                    emitted = decoded
+
+        answer = self.tokenizer.decode(generated, skip_special_tokens=True)
+        if len(answer) > len(emitted):
+            yield answer[len(emitted) :]
+        self.messages.append({"role": "assistant", "content": answer})
+        if cache_params is not None:
+            self.response_cache.put(text, self.model_name, answer, params=cache_params, vector=vector)
+        metrics.generated_tokens = len(generated)
+        metrics.elapsed = time.perf_counter() - start
+        self.metrics.append(metrics)
+
+    def send(self, text: str, **kwargs) -> str:
+        """Add a user message and return the whole answer."""
+        return "".join(self.stream(text, **kwargs))
+
+
+def generate_remote(prompt: str, server_url: str, max_new_tokens: int = 50) -> str:
+    """Generate the continuation of a prompt with the model server (OpenAI compatible completions API)."""
+    import openai
+
+    response = openai.Completion.create(
+        model="local", prompt=prompt, max_tokens=max_new_tokens, api_base=server_url, api_key="local"
+    )
+    return response["choices"][0]["text"]
+
+
+@app.command()
+def chat(
+    server_url: str = None,
+    max_new_tokens: int = 50,
+    model_path: str = settings.MISTRAL_MODEL_PATH,
+    stream: bool = True,
+    max_context: int = settings.LLM_MAX_CONTEXT,
+    temperature: float = 0.0,
+    runtime: str = settings.LLM_RUNTIME,
+    cache: bool = False,
+    semantic_cache: bool = settings.LLM_CACHE_SEMANTIC,
+):
+    """Chat with the model: loaded in the process, or served by `experiments.llms.server` with --server-url
+    (for example http://127.0.0.1:8000/v1), so the model is not loaded at every launch.
+
+    With --stream (the default for the local model) the conversation is kept with its cached keys/values
+    and the answer is printed token by token, followed by the time to first token and inter token latency.
+    With --cache the greedy answers are kept in the response cache (`experiments.llms.cache`) and a repeated
+    prompt is not generated again; with --semantic-cache also a similar one.
+    """
+    response_cache = get_response_cache(semantic_cache) if cache else None
+    session = None
+    if server_url is None:
+        tokenizer, model, device = get_model(model_path, runtime=runtime)
+        if stream:
+            session = ChatSession(tokenizer, model, device, max_context=max_context, response_cache=response_cache)
 
     while True:
         # Ask for user input
@@ -25,16 +344,88 @@ def chat():
         if input_text.lower() == "exit":
             break
 
-        # Encode input text
-        input_ids = tokenizer.encode(input_text, return_tensors="pt").to(device)
+        if session is not None:
+            for piece in session.stream(input_text, max_new_tokens=max_new_tokens, temperature=temperature):
+                print(piece, end="", flush=True)
+            print()
+            typer.echo(str(session.metrics[-1]), err=True)
+            continue
+        if server_url:
+            model_name = server_url
+            generate_text = partial(generate_remote, input_text, server_url, max_new_tokens=max_new_tokens)
+        else:
+            model_name = f"{model_path}@{runtime}"
+            generate_text = partial(
+                generate, input_text, max_new_tokens=max_new_tokens, model_path=model_path, runtime=runtime
+            )
+        if response_cache is not None:
+            generated_text, _ = response_cache.cached(
+                input_text, model_name, generate_text, params={"max_new_tokens": max_new_tokens}
+            )
+        else:
+            generated_text = generate_text()
+        print(generated_text)
 
-        # Generate text
-        with torch.no_grad():
-            output = model.generate(input_ids, max_length=50, num_return_sequences=1)
+    if response_cache is not None:
+        typer.echo(f"Response cache: {response_cache.stats()}", err=True)
 
-        # Decode and print the output text
-        generated_text = tokenizer.decode(output[0], skip_special_tokens=True)
-        print(generated_text)
+
+def _benchmark_generation(runtime: str, model_path: str, prompt: str, max_new_tokens: int, repeat: int) -> dict:
+    from experiments.onnx_runtime import import_runtime, rss_bytes
+
+    import_runtime(runtime)
+    memory = rss_bytes()
+    start = time.perf_counter()
+    tokenizer, model, device = get_model(model_path, runtime=runtime)
+    load = time.perf_counter() - start
+    memory = rss_bytes() - memory
+
+    session_metrics = []
+    for _ in range(repeat):
+        session = ChatSession(tokenizer, model, device)
+        session.send(prompt, max_new_tokens=max_new_tokens)
+        session_metrics.append(session.metrics[-1])
+    latencies = [latency for metrics in session_metrics for latency in metrics.inter_token_latencies]
+    return {
+        "runtime": runtime,
+        "load_s": load,
+        "memory_mb": memory / 2**20,
+        "ttft_ms": float(np.mean([metrics.time_to_first_token for metrics in session_metrics])) * 1000,
+        "inter_token_ms": float(np.mean(latencies)) * 1000 if latencies else 0.0,
+        "tokens_per_second": float(np.mean([metrics.tokens_per_second for metrics in session_metrics])),
+        "answer": session.messages[-1]["content"][:40],
+    }
+
+
+@app.command()
+def benchmark(
+    model_path: str = settings.MISTRAL_MODEL_PATH,
+    prompt: str = "Explain what a transformer model is.",
+    max_new_tokens: int = 32,
+    repeat: int = 3,
+    runtimes: List[str] = typer.Option(None, "--runtime"),
+):
+    """Compare load time, memory, time to first token and tokens/sec of the CPU runtimes (pytorch, onnx, onnx-int8).
+
+    The ONNX artifacts are exported first (it takes a while and a lot of memory for a 7B model), then every
+    runtime is measured in its own process.
+    """
+    from optimum.onnxruntime import ORTModelForCausalLM
+
+    from experiments.onnx_runtime import RUNTIMES, benchmark_runtimes, ensure_onnx
+
+    runtimes = runtimes or RUNTIMES
+    for runtime in runtimes:
+        if runtime != "pytorch":
+            ensure_onnx(resolve_model(model_path), ORTModelForCausalLM, runtime, use_cache=True, use_io_binding=False)
+    benchmark_runtimes(
+        _benchmark_generation,
+        runtimes,
+        model_path=model_path,
+        prompt=prompt,
+        max_new_tokens=max_new_tokens,
+        repeat=repeat,
+    )
 
 
 if __name__ == "__main__":
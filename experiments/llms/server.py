@@ -0,0 +1,424 @@
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+import typer
+from loguru import logger
+
+from experiments.config import settings
+from experiments.llms.generate import chat_prompt, get_model
+
+app = typer.Typer()
+
+
+@dataclass
+class GenerationRequest:
+    """A prompt waiting for its completion, with the timings of the request."""
+
+    prompt: str
+    max_tokens: int = settings.LLM_MAX_NEW_TOKENS
+    temperature: float = 1.0
+    top_p: float = 1.0
+    stop: List[str] = field(default_factory=list)
+    text: str = None
+    finish_reason: str = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    batch_size: int = 0
+    error: Exception = None
+    created: float = field(default_factory=time.perf_counter)
+    started: float = None
+    finished: float = None
+    done: threading.Event = field(default_factory=threading.Event)
+
+    @property
+    def sampling(self) -> tuple:
+        """The requests with the same sampling parameters can be generated in the same batch."""
+        return (self.temperature, self.top_p) if self.temperature > 0 else (0.0, 1.0)
+
+    @property
+    def queue_time(self) -> float:
+        return self.started - self.created
+
+    @property
+    def latency(self) -> float:
+        return self.finished - self.created
+
+    @property
+    def tokens_per_second(self) -> float:
+        generation = self.finished - self.started
+        return self.completion_tokens / generation if generation else 0.0
+
+    def metrics(self) -> dict:
+        return {
+            "queue_ms": round(self.queue_time * 1000, 1),
+            "latency_ms": round(self.latency * 1000, 1),
+            "tokens_per_second": round(self.tokens_per_second, 1),
+            "batch_size": self.batch_size,
+        }
+
+
+class ServerMetrics:
+    """Aggregated metrics of the server: requests, batch sizes, latencies and generated tokens."""
+
+    def __init__(self, window: int = 1000):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.busy = 0.0
+        self.latencies = deque(maxlen=window)
+        self.throughputs = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, requests: List[GenerationRequest], elapsed: float):
+        with self._lock:
+            self.batches += 1
+            self.busy += elapsed
+            for request in requests:
+                self.requests += 1
+                self.errors += request.error is not None
+                self.prompt_tokens += request.prompt_tokens
+                self.completion_tokens += request.completion_tokens
+                self.latencies.append(request.latency)
+                self.throughputs.append(request.tokens_per_second)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latencies = np.asarray(self.latencies) * 1000
+            return {
+                "uptime_s": round(time.time() - self.started, 1),
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "mean_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "tokens_per_second": round(self.completion_tokens / self.busy, 1) if self.busy else 0.0,
+                "request_tokens_per_second": round(float(np.mean(self.throughputs)), 1) if self.throughputs else 0.0,
+                "latency_p50_ms": round(float(np.percentile(latencies, 50)), 1) if len(latencies) else 0.0,
+                "latency_p95_ms": round(float(np.percentile(latencies, 95)), 1) if len(latencies) else 0.0,
+            }
+
+
+class DynamicBatcher:
+    """Queue the generation requests and generate them in batches with a single model.
+
+    A worker thread takes the first request in the queue, waits up to `max_wait` seconds for other
+    requests (up to `max_batch_size`) and generates the ones with the same sampling parameters together,
+    with left padding. Concurrent requests share the forward passes instead of waiting for each other.
+    """
+
+    def __init__(self, tokenizer, model, device: str, max_batch_size: int = 8, max_wait: float = 0.02):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = ServerMetrics()
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="generation", daemon=True)
+
+    def start(self) -> "DynamicBatcher":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def submit(self, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        """Queue the requests and wait for their completions."""
+        for request in requests:
+            self._queue.put(request)
+        for request in requests:
+            request.done.wait()
+        return requests
+
+    def _collect(self) -> List[GenerationRequest]:
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.sampling, []).append(request)
+            for requests in groups.values():
+                start = time.perf_counter()
+                for request in requests:
+                    request.started = start
+                    request.batch_size = len(requests)
+                try:
+                    self._generate(requests)
+                except Exception as error:
+                    logger.exception(f"Generation of a batch of {len(requests)} requests failed: {error}")
+                    for request in requests:
+                        request.error = error
+                finished = time.perf_counter()
+                for request in requests:
+                    request.finished = finished
+                    request.done.set()
+                self.metrics.record(requests, finished - start)
+
+    def _generate(self, requests: List[GenerationRequest]):
+        import torch
+
+        self.tokenizer.padding_side = "left"
+        encoded = self.tokenizer([request.prompt for request in requests], return_tensors="pt", padding=True)
+        inputs = {name: encoded[name].to(self.device) for name in ("input_ids", "attention_mask")}
+        temperature, top_p = requests[0].sampling
+        sampling = (
+            {"do_sample": True, "temperature": temperature, "top_p": top_p} if temperature > 0 else {"do_sample": False}
+        )
+        with torch.inference_mode():
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=max(request.max_tokens for request in requests),
+                pad_token_id=self.tokenizer.pad_token_id,
+                **sampling,
+            )
+
+        prompt_length = inputs["input_ids"].shape[1]
+        prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        for request, tokens, count in zip(requests, output[:, prompt_length:].tolist(), prompt_tokens):
+            request.prompt_tokens = count
+            self._finish(request, tokens[: request.max_tokens])
+
+    def _finish(self, request: GenerationRequest, tokens: List[int]):
+        """Decode the completion, cut at the end of sequence token or at the first stop string."""
+        request.finish_reason = "length"
+        if self.tokenizer.eos_token_id in tokens:
+            tokens = tokens[: tokens.index(self.tokenizer.eos_token_id)]
+            request.finish_reason = "stop"
+        text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+        positions = [text.find(stop) for stop in request.stop if stop and stop in text]
+        if positions:
+            text = text[: min(positions)]
+            request.finish_reason = "stop"
+            # the tokens after the stop string are not part of the completion
+            tokens = self.tokenizer.encode(text, add_special_tokens=False) if text else []
+        request.text = text
+        request.completion_tokens = len(tokens)
+
+
+class RequestError(ValueError):
+    """Invalid request, answered with 400."""
+
+
+class GenerationError(RuntimeError):
+    """The model failed to generate a batch, answered with 500."""
+
+
+def _requests(body: dict, prompts: List[str]) -> List[GenerationRequest]:
+    if body.get("stream"):
+        raise RequestError("Streaming is not supported")
+    stop = body.get("stop") or []
+    return [
+        GenerationRequest(
+            prompt=prompt,
+            max_tokens=int(body.get("max_tokens") or settings.LLM_MAX_NEW_TOKENS),
+            temperature=float(body.get("temperature", 1.0)),
+            top_p=float(body.get("top_p", 1.0)),
+            stop=[stop] if isinstance(stop, str) else list(stop),
+        )
+        for prompt in prompts
+        for _ in range(int(body.get("n", 1)))
+    ]
+
+
+def _usage(requests: List[GenerationRequest]) -> dict:
+    prompt_tokens = sum(request.prompt_tokens for request in requests)
+    completion_tokens = sum(request.completion_tokens for request in requests)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """OpenAI compatible endpoints: /v1/completions, /v1/chat/completions, /v1/models, plus /metrics and /health."""
+
+    server: "InferenceServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, message: str, kind: str = "invalid_request_error"):
+        self._send(status, {"error": {"message": message, "type": kind}})
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self._send(200, self.server.batcher.metrics.snapshot())
+        elif self.path == "/v1/models":
+            model = {"id": self.server.model_name, "object": "model", "owned_by": "local"}
+            self._send(200, {"object": "list", "data": [model]})
+        else:
+            self._error(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        handlers = {"/v1/completions": self._completions, "/v1/chat/completions": self._chat_completions}
+        if self.path not in handlers:
+            self._error(404, f"Unknown path {self.path}")
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            response = handlers[self.path](body)
+        except (ValueError, KeyError, TypeError) as error:
+            self._error(400, str(error))
+            return
+        except Exception as error:
+            logger.exception(f"Request {self.path} failed: {error}")
+            self._error(500, str(error), kind="server_error")
+            return
+        self._send(200, response)
+
+    def _generate(self, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        self.server.batcher.submit(requests)
+        for request in requests:
+            if request.error is not None:
+                raise GenerationError(f"Generation failed: {request.error}") from request.error
+        metrics = [request.metrics() for request in requests]
+        logger.info(
+            f"{self.path}: {len(requests)} completions, {sum(r.completion_tokens for r in requests)} tokens, "
+            f"latency {max(m['latency_ms'] for m in metrics):.0f}ms, {metrics[0]['tokens_per_second']:.1f} tokens/sec "
+            f"(batch {metrics[0]['batch_size']})"
+        )
+        return requests
+
+    def _completions(self, body: dict) -> dict:
+        prompts = body.get("prompt")
+        if not prompts:
+            raise RequestError("Missing prompt")
+        prompts = [prompts] if isinstance(prompts, str) else prompts
+        if not all(isinstance(prompt, str) for prompt in prompts):
+            raise RequestError("The prompt must be a string or a list of strings (token ids are not supported)")
+        requests = self._generate(_requests(body, prompts))
+        return {
+            "id": f"cmpl-{uuid.uuid4().hex}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": self.server.model_name,
+            "choices": [
+                {"text": request.text, "index": index, "logprobs": None, "finish_reason": request.finish_reason}
+                for index, request in enumerate(requests)
+            ],
+            "usage": _usage(requests),
+            "metrics": [request.metrics() for request in requests],
+        }
+
+    def _chat_completions(self, body: dict) -> dict:
+        messages = body.get("messages")
+        if not messages:
+            raise RequestError("Missing messages")
+        requests = self._generate(_requests(body, [chat_prompt(self.server.batcher.tokenizer, messages)]))
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.server.model_name,
+            "choices": [
+                {
+                    "index": index,
+                    "message": {"role": "assistant", "content": request.text},
+                    "finish_reason": request.finish_reason,
+                }
+                for index, request in enumerate(requests)
+            ],
+            "usage": _usage(requests),
+            "metrics": [request.metrics() for request in requests],
+        }
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """HTTP server sharing one model (loaded once) among all the connections through the batcher."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, batcher: DynamicBatcher, model_name: str):
+        super().__init__(address, InferenceHandler)
+        self.batcher = batcher
+        self.model_name = model_name
+
+
+def create_server(
+    model_path: str = settings.MISTRAL_MODEL_PATH,
+    host: str = settings.LLM_SERVER_HOST,
+    port: int = settings.LLM_SERVER_PORT,
+    max_batch_size: int = settings.LLM_MAX_BATCH_SIZE,
+    batch_wait: float = settings.LLM_BATCH_WAIT,
+    runtime: str = settings.LLM_RUNTIME,
+) -> InferenceServer:
+    """Load the model and build the server (call `serve_forever` to start it)."""
+    start = time.perf_counter()
+    tokenizer, model, device = get_model(model_path, runtime=runtime)
+    logger.info(f"Model {model_path} loaded on {device} ({runtime}) in {time.perf_counter() - start:.1f}s")
+    batcher = DynamicBatcher(tokenizer, model, device, max_batch_size=max_batch_size, max_wait=batch_wait).start()
+    return InferenceServer((host, port), batcher, model_name=model_path.rstrip("/").split("/")[-1])
+
+
+@app.callback()
+def main():
+    """OpenAI compatible server of the local model."""
+
+
+@app.command()
+def serve(
+    model_path: str = settings.MISTRAL_MODEL_PATH,
+    host: str = settings.LLM_SERVER_HOST,
+    port: int = settings.LLM_SERVER_PORT,
+    max_batch_size: int = settings.LLM_MAX_BATCH_SIZE,
+    batch_wait: float = settings.LLM_BATCH_WAIT,
+    runtime: str = settings.LLM_RUNTIME,
+):
+    """Serve the model with OpenAI compatible endpoints, loading it once from the local snapshot.
+
+    With --runtime onnx or onnx-int8 the model runs with onnxruntime on CPU.
+    """
+    settings._setup_logger()
+    server = create_server(model_path, host, port, max_batch_size, batch_wait, runtime)
+    typer.echo(f"Serving on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.stop()
+
+
+if __name__ == "__main__":
+    app()
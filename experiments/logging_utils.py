@@ -0,0 +1,447 @@
+import atexit
+import copy
+import glob
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List
+
+import numpy as np
+import typer
+from loguru import logger
+
+app = typer.Typer()
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket for each line of code: at most `rate` records per second (with bursts of `burst`) are kept
+    for every call site, the others are dropped. The records of level `min_level` and above are always kept.
+
+    The first record kept after some dropped ones reports how many were dropped. Usable as a stdlib
+    `logging.Filter` and as a loguru `filter`: the same instance can be shared by the loguru sinks, the
+    decision is taken once for each record.
+    """
+
+    def __init__(self, rate: float, burst: int = None, min_level: int = logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.min_level = min_level
+        self.dropped = 0
+        self._buckets = {}  # call site -> [tokens, last update, dropped since the last kept record]
+        self._lock = threading.Lock()
+
+    def _allow(self, site: tuple, level: int) -> tuple:
+        """Return (keep the record, records of the call site dropped before it)."""
+        if level >= self.min_level or self.rate <= 0:
+            return True, 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(site)
+            if bucket is None:
+                bucket = self._buckets[site] = [float(self.burst), now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.dropped += 1
+                return False, 0
+            bucket[0] -= 1
+            dropped, bucket[2] = bucket[2], 0
+            return True, dropped
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # the records coming from loguru were already filtered by the loguru sinks
+        if getattr(record, "rate_limited", False):
+            return True
+        keep, dropped = self._allow((record.pathname, record.lineno), record.levelno)
+        if keep and dropped:
+            record.msg = f"{record.getMessage()} ({dropped} similar messages dropped)"
+            record.args = None
+        return keep
+
+    def __call__(self, record: dict) -> bool:
+        decision = record["extra"].get("_rate_limit")
+        if decision is None:
+            keep, dropped = self._allow((record["file"].path, record["line"]), record["level"].no)
+            if keep and dropped:
+                record["message"] += f" ({dropped} similar messages dropped)"
+            decision = record["extra"]["_rate_limit"] = keep
+        return decision
+
+
+class PropagateHandler(logging.Handler):
+    """Loguru sink passing the records to the python logging system (and to its handlers)."""
+
+    def emit(self, record):
+        record.rate_limited = True
+        logging.getLogger(record.name).handle(record)
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never blocks the caller: when the queue is full the record is dropped (and counted).
+
+    The message is rendered in the caller thread (the arguments may change later) but the exception
+    info is kept for the formatters of the listener, for example the ECS stack trace fields.
+    """
+
+    def __init__(self, queue_size: int = 0):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotating file handler formatting every record once (`RotatingFileHandler` formats it twice, the first time
+    only to check the size of the file) and keeping the size of the file instead of seeking its end.
+
+    With `autoflush=False` the file is not flushed after every record: `BatchQueueListener` flushes every batch.
+    """
+
+    def __init__(self, *args, autoflush: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.autoflush = autoflush
+        self._size = None
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            message = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            if self._size is None:
+                self._size = os.fstat(self.stream.fileno()).st_size
+            if self.maxBytes > 0 and self._size and self._size + len(message) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+                self._size = 0
+            self.stream.write(message)
+            self._size += len(message)
+            if self.autoflush:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class LoguruQueueSink:
+    """Loguru sink putting the formatted messages in the queue of an `AsyncQueueHandler`, for the
+    `LoguruFileHandler` of the listener: the caller only formats the message, the file is written by the
+    background thread.
+    """
+
+    def __init__(self, queue_handler: AsyncQueueHandler):
+        self.queue_handler = queue_handler
+
+    def __call__(self, message):
+        record = message.record
+        self.queue_handler.enqueue(
+            logging.makeLogRecord(
+                {"msg": str(message), "levelno": record["level"].no, "loguru_time": record["time"], "loguru_file": True}
+            )
+        )
+
+
+class LoguruFileHandler(BufferedRotatingFileHandler):
+    """Handler writing the messages of `LoguruQueueSink` in the listener, rotated and cleaned like a loguru file
+    sink: the `{time}` of the file name is the time of the first message of the file, beyond `max_bytes` the file
+    is renamed with the time of the rotation and the files older than `retention` seconds are removed.
+    """
+
+    terminator = ""  # the loguru format ends the messages
+
+    def __init__(self, file_name: str, max_bytes: int, retention: float, autoflush: bool = True):
+        super().__init__(file_name, maxBytes=max_bytes, encoding="utf8", delay=True, autoflush=autoflush)
+        self.file_name = file_name
+        self.retention = retention
+        self._time = None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return getattr(record, "loguru_file", False) and super().filter(record)
+
+    def emit(self, record: logging.LogRecord):
+        self._time = record.loguru_time
+        if self.stream is None:
+            self._name_file()
+        super().emit(record)
+
+    def _name_file(self):
+        self.baseFilename = os.path.abspath(self.file_name.format_map({"time": self._time}))
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+
+    def doRollover(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        root, extension = os.path.splitext(self.baseFilename)
+        os.replace(self.baseFilename, f"{root}.{datetime.now():%Y-%m-%d_%H-%M-%S_%f}{extension}")
+        self._name_file()
+        self._remove_expired()
+
+    def _remove_expired(self):
+        root, extension = os.path.splitext(os.path.abspath(re.sub(r"{[^}]*}", "*", self.file_name)))
+        expiry = time.time() - self.retention
+        for file_path in glob.glob(f"{root}*{extension}"):
+            if file_path != self.baseFilename and os.path.getmtime(file_path) < expiry:
+                os.remove(file_path)
+
+
+_SIZE_UNITS = {"b": 1, "kb": 10**3, "mb": 10**6, "gb": 10**9, "kib": 2**10, "mib": 2**20, "gib": 2**30}
+_DURATION_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+
+
+def _parse_quantity(value: str, units: dict) -> float:
+    """Parse a loguru size ("100MB") or duration ("30 days"), None for the other forms (a time of the day...)."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]+)\s*", str(value))
+    if match is None:
+        return None
+    unit = match.group(2).lower()
+    unit = units.get(unit, units.get(unit[:-1] if unit.endswith("s") else unit))
+    return float(match.group(1)) * unit if unit else None
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    """Queue listener handling the records in batches: a background thread takes all the queued records (up to
+    `batch_size`), passes them to the handlers and flushes the handlers once for the whole batch.
+
+    With a light load a record is written as soon as it arrives, under a heavy load the writes are batched.
+    """
+
+    def __init__(self, record_queue, *handlers, batch_size: int = 512, respect_handler_level: bool = True):
+        super().__init__(record_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.batch_size = batch_size
+        self.batches = 0
+        self.records = 0
+
+    def _monitor(self):
+        has_task_done = hasattr(self.queue, "task_done")
+        stop = False
+        while not stop:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+            for handler in self.handlers:
+                handler.flush()
+            self.batches += 1
+            self.records += len(batch) - stop
+            if has_task_done:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+@dataclass
+class LoggingSetup:
+    """The sinks and handlers added by `setup_logging`, to remove them."""
+
+    loguru_handlers: List[int] = field(default_factory=list)
+    logging_handlers: List[logging.Handler] = field(default_factory=list)
+    listener: BatchQueueListener = None
+    rate_limit: RateLimitFilter = None
+
+    def stats(self) -> dict:
+        queue_handler = next((h for h in self.logging_handlers if isinstance(h, AsyncQueueHandler)), None)
+        return {
+            "records": self.listener.records if self.listener else None,
+            "batches": self.listener.batches if self.listener else None,
+            "queue_dropped": queue_handler.dropped if queue_handler else 0,
+            "rate_limited": self.rate_limit.dropped if self.rate_limit else 0,
+        }
+
+    def flush(self):
+        """Wait for the queued records to be written."""
+        if self.listener is not None:
+            self.listener.queue.join()
+
+    def stop(self):
+        """Remove the sinks and handlers, writing the queued records."""
+        for handler_id in self.loguru_handlers:
+            logger.remove(handler_id)
+        root = logging.getLogger()
+        for handler in self.logging_handlers:
+            root.removeHandler(handler)
+        if self.listener is not None:
+            atexit.unregister(self.listener.stop)
+            self.listener.stop()
+        for handler in self.logging_handlers:
+            handler.close()
+        for handler in self.listener.handlers if self.listener else ():
+            handler.close()
+        self.loguru_handlers, self.logging_handlers = [], []
+
+
+def setup_logging(settings) -> LoggingSetup:
+    """Add the log sinks configured by the settings: the loguru log file and the ECS log file (json lines for
+    elastic) fed by the python logging system, where also the loguru records are propagated.
+
+    With `LOG_ASYNC` the caller only puts the records in a queue, a background thread formats the records for
+    the ECS file and writes both files in batches (the loguru file stays a loguru sink when its rotation isn't a
+    size or its retention isn't a duration). With `LOG_RATE_LIMIT` the records below WARNING of every line of
+    code are limited to that many per second.
+    """
+    import ecs_logging
+
+    setup = LoggingSetup()
+    if settings.LOG_RATE_LIMIT > 0:
+        setup.rate_limit = RateLimitFilter(settings.LOG_RATE_LIMIT)
+
+    # Add ECS rotating files sink
+    os.makedirs(os.path.dirname(os.path.abspath(settings.ECS_LOG_PATH)), exist_ok=True)
+    ecs_handler = BufferedRotatingFileHandler(
+        settings.ECS_LOG_PATH,
+        maxBytes=100_000_000,
+        backupCount=2,
+        encoding="utf8",
+        autoflush=not settings.LOG_ASYNC,
+    )
+    ecs_handler.setFormatter(
+        ecs_logging.StdlibFormatter(
+            extra={
+                "release": settings.RELEASE,
+                "project": settings.PROJECT_NAME,
+            }
+        )
+    )
+    ecs_handler.setLevel(logging.INFO)
+
+    file_sink = settings.LOG_FILE_NAME
+    file_options = {"rotation": settings.LOG_ROTATION_SIZE, "retention": settings.LOG_RETENTION, "encoding": "utf8"}
+    rotation = _parse_quantity(settings.LOG_ROTATION_SIZE, _SIZE_UNITS)
+    retention = _parse_quantity(settings.LOG_RETENTION, _DURATION_UNITS)
+    if settings.LOG_ASYNC:
+        queue_handler = AsyncQueueHandler(settings.LOG_QUEUE_SIZE)
+        queue_handler.setLevel(logging.INFO)
+        handlers = [ecs_handler]
+        if rotation and retention:
+            # the records of the loguru file share the queue, the ECS handler skips them
+            ecs_handler.addFilter(lambda record: not getattr(record, "loguru_file", False))
+            handlers.append(LoguruFileHandler(settings.LOG_FILE_NAME, int(rotation), retention, autoflush=False))
+            file_sink, file_options = LoguruQueueSink(queue_handler), {}
+        setup.listener = BatchQueueListener(queue_handler.queue, *handlers, batch_size=settings.LOG_BATCH_SIZE)
+        setup.listener.start()
+        atexit.register(setup.listener.stop)
+        root_handler = queue_handler
+    else:
+        root_handler = ecs_handler
+
+    # logger.remove() to remove default logging to StdErr
+    setup.loguru_handlers.append(
+        logger.add(
+            file_sink,
+            format=settings.LOG_FORMAT,
+            level=settings.LOG_VERBOSITY,
+            filter=setup.rate_limit,
+            colorize=False,
+            serialize=False,
+            catch=True,
+            backtrace=False,
+            diagnose=False,
+            **file_options,
+        )
+    )
+
+    # Proxy loguru logs also to logging logger.
+    # The ecs logging formats all logs from the python logging system for elastic.
+    # It could be configured to read logs directly from loguru, but in that case it
+    # would miss all parts of the system that log directly to the python logging
+    # system.
+    setup.loguru_handlers.append(
+        logger.add(PropagateHandler(), format="{message}", level=settings.LOG_VERBOSITY, filter=setup.rate_limit)
+    )
+
+    if setup.rate_limit is not None:
+        root_handler.addFilter(setup.rate_limit)
+    pylogger = logging.getLogger()
+    pylogger.addHandler(root_handler)
+    setup.logging_handlers.append(root_handler)
+    return setup
+
+
+def _log_loop(calls: int, pause: float = 0.0) -> List[float]:
+    """Seconds spent in each log call of a loop, waiting `pause` seconds (the GIL is released) between the calls."""
+    durations = []
+    for index in range(calls):
+        start = time.perf_counter()
+        logger.info("Inserted point {} in {}", index, "collection")
+        durations.append(time.perf_counter() - start)
+        if pause:
+            time.sleep(pause)
+    return durations
+
+
+def benchmark(calls: int = 20_000, pause: float = 0.001, modes: List[str] = None) -> dict:
+    """Measure the time spent by the caller in a log call with the sinks of `setup_logging`, in the sync and async
+    modes, with and without the rate limit (a hot loop logging always from the same line).
+
+    `tight_us` is the mean time of a call in a loop doing nothing else, where the background thread competes
+    for the GIL with the caller. `p50_us` and `p99_us` are the times of the calls spaced by `pause` seconds of
+    I/O, like the upserts to the vector store: the background thread writes while the caller waits.
+    """
+    from experiments.config import Settings
+
+    modes = modes or ["sync", "async", "async-rate-limited"]
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        logger.remove()
+        for mode in modes:
+            settings = Settings(
+                LOG_FILE_NAME=os.path.join(folder, f"{mode}.log"),
+                ECS_LOG_PATH=os.path.join(folder, f"{mode}-ecs.log"),
+                LOG_ASYNC=mode.startswith("async"),
+                LOG_RATE_LIMIT=100 if mode.endswith("rate-limited") else 0,
+            )
+            setup = setup_logging(settings)
+            tight = sum(_log_loop(calls))
+            setup.flush()
+            spaced = np.asarray(_log_loop(max(calls // 10, 1), pause)) * 1_000_000
+            setup.stop()
+            results[mode] = {
+                "tight_us": round(tight / calls * 1_000_000, 1),
+                "p50_us": round(float(np.percentile(spaced, 50)), 1),
+                "p99_us": round(float(np.percentile(spaced, 99)), 1),
+                **setup.stats(),
+            }
+    return results
+
+
+@app.callback()
+def main():
+    """Logging setup of the experiments."""
+
+
+@app.command(name="benchmark")
+def benchmark_command(calls: int = 20_000, pause: float = 0.001):
+    """Print the per call overhead of logging in the sync and async modes."""
+    for mode, result in benchmark(calls, pause).items():
+        typer.echo(f"{mode}: {result}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,488 @@
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from experiments.config import settings
+
+try:  # posix only: the lock of the index between processes
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CHUNK_SIZE = 8 * 2**20
+
+
+class ChecksumError(ValueError):
+    """A downloaded file doesn't match the size or the checksum published by the source."""
+
+
+@dataclass
+class RemoteFile:
+    """A file of a model revision: sha256 for the LFS files, git blob sha1 for the small ones."""
+
+    path: str
+    size: int
+    sha256: Optional[str] = None
+    blob_id: Optional[str] = None
+
+    @property
+    def digest(self) -> Optional[str]:
+        return self.sha256 or self.blob_id
+
+    def hasher(self):
+        if self.sha256:
+            return hashlib.sha256()
+        if self.blob_id:
+            # the git object id of a blob is the sha1 of a header with its size followed by the content
+            hasher = hashlib.sha1()
+            hasher.update(f"blob {self.size}\0".encode())
+            return hasher
+        return None
+
+
+def file_hash(file_path: str, hasher=None) -> str:
+    hasher = hasher or hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def selected(path: str, allow_patterns: List[str] = None, ignore_patterns: List[str] = None) -> bool:
+    """Check a file of the repository against the allowed and the ignored glob patterns."""
+    if allow_patterns and not any(fnmatch.fnmatch(path, pattern) for pattern in allow_patterns):
+        return False
+    return not (ignore_patterns and any(fnmatch.fnmatch(path, pattern) for pattern in ignore_patterns))
+
+
+class HubSource:
+    """The hugging face hub: file list with the checksums from the API, files streamed with range requests."""
+
+    def __init__(self, token: str = None, endpoint: str = None, timeout: float = 30.0):
+        self.token = token or settings.HUGGING_FACE_TOKEN or None
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def resolve(self, repo_id: str, revision: str = "main") -> Tuple[str, List[RemoteFile]]:
+        """Return the commit of the revision and its files."""
+        from huggingface_hub import HfApi
+
+        info = HfApi(endpoint=self.endpoint, token=self.token).model_info(
+            repo_id, revision=revision, files_metadata=True
+        )
+        files = [
+            RemoteFile(
+                path=sibling.rfilename,
+                size=sibling.lfs.size if sibling.lfs else sibling.size,
+                sha256=sibling.lfs.sha256 if sibling.lfs else None,
+                blob_id=None if sibling.lfs else sibling.blob_id,
+            )
+            for sibling in info.siblings
+        ]
+        return info.sha, files
+
+    def fetch(self, repo_id: str, commit: str, file: RemoteFile, offset: int = 0) -> Tuple[int, Iterator[bytes]]:
+        """Stream a file from `offset`, returning the offset really served (0 if the range is not supported)."""
+        import requests
+        from huggingface_hub import hf_hub_url
+        from huggingface_hub.utils import build_hf_headers
+
+        headers = build_hf_headers(token=self.token)
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        url = hf_hub_url(repo_id, file.path, revision=commit, endpoint=self.endpoint)
+        response = requests.get(url, headers=headers, stream=True, timeout=self.timeout)
+        response.raise_for_status()
+        start = offset if response.status_code == 206 else 0
+        return start, response.iter_content(CHUNK_SIZE)
+
+
+class MirrorSource:
+    """A local (or mounted) folder mirror: `<root>/<repo id>/<commit>/<files>` and `<root>/<repo id>/refs/<name>`
+    files with the commit of the branches and tags.
+
+    The checksums are read from a `SHA256SUMS` file in the commit folder if present, computed otherwise.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def resolve(self, repo_id: str, revision: str = "main") -> Tuple[str, List[RemoteFile]]:
+        ref = os.path.join(self.root, repo_id, "refs", revision)
+        commit = revision
+        if os.path.exists(ref):
+            with open(ref) as f:
+                commit = f.read().strip()
+        folder = os.path.join(self.root, repo_id, commit)
+        if not os.path.isdir(folder):
+            raise FileNotFoundError(f"Revision {revision} of {repo_id} not found in the mirror {self.root}")
+
+        checksums = {}
+        if os.path.exists(os.path.join(folder, "SHA256SUMS")):
+            with open(os.path.join(folder, "SHA256SUMS")) as f:
+                checksums = {
+                    path.strip(): digest for digest, path in (line.split(None, 1) for line in f if line.strip())
+                }
+        files = []
+        for directory, _, names in os.walk(folder):
+            for name in names:
+                file_path = os.path.join(directory, name)
+                path = os.path.relpath(file_path, folder).replace(os.sep, "/")
+                if path == "SHA256SUMS":
+                    continue
+                files.append(RemoteFile(path, os.path.getsize(file_path), checksums.get(path) or file_hash(file_path)))
+        return commit, sorted(files, key=lambda file: file.path)
+
+    def fetch(self, repo_id: str, commit: str, file: RemoteFile, offset: int = 0) -> Tuple[int, Iterator[bytes]]:
+        def chunks():
+            with open(os.path.join(self.root, repo_id, commit, file.path), "rb") as f:
+                f.seek(offset)
+                yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+        return offset, chunks()
+
+
+class ModelManager:
+    """Download the model snapshots in `path` and keep an index of the available models and revisions.
+
+    - only the files matching the allow/ignore patterns are downloaded (for example only the safetensors)
+    - the files are downloaded in parallel, each one in a `.incomplete` file resumed after an interruption
+    - every file is checked against the size and the checksum published by the source before it is used
+    - a file already downloaded for another revision (same checksum) is linked and not downloaded again
+    - `resolve` finds a model in the index without any network call, so the models load offline
+    - `gc` removes the revisions not pointed by a ref and not recently used
+
+    The snapshots are in `<path>/hub/<org>--<name>/<commit>` and the index in `<path>/hub/index.json`.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.MODELS_PATH,
+        source=None,
+        workers: int = settings.MODEL_DOWNLOAD_WORKERS,
+        retries: int = settings.MODEL_DOWNLOAD_RETRIES,
+    ):
+        self.root = os.path.join(path, "hub")
+        self.source = source or (MirrorSource(settings.MODEL_MIRROR) if settings.MODEL_MIRROR else HubSource())
+        self.workers = workers
+        self.retries = retries
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, "index.json")
+
+    def revision_path(self, repo_id: str, commit: str) -> str:
+        return os.path.join(self.root, repo_id.replace("/", "--"), commit)
+
+    def read_index(self) -> dict:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path, encoding="utf8") as f:
+            return json.load(f)
+
+    def _update_index(self, update):
+        """Apply `update(index)` and write the index atomically, holding the lock of the threads and processes."""
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock, open(os.path.join(self.root, "index.lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.read_index()
+            result = update(index)
+            with open(self.index_path + ".tmp", "w", encoding="utf8") as f:
+                json.dump(index, f, indent=2)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            return result
+
+    @staticmethod
+    def _is_valid(destination: str, file: RemoteFile, verified: dict) -> bool:
+        """Check a file already in the snapshot: its size, and its checksum unless the index records it verified
+        (a file left by an interrupted download of the revision is hashed again).
+        """
+        if not os.path.exists(destination) or os.path.getsize(destination) != file.size:
+            return False
+        if file.digest is None or verified.get(file.path) == file.digest:
+            return True
+        if file_hash(destination, file.hasher()) == file.digest:
+            return True
+        logger.warning(f"{destination} doesn't match the checksum {file.digest}, downloading it again")
+        os.remove(destination)
+        return False
+
+    def _fetch(self, repo_id: str, commit: str, file: RemoteFile, partial: str) -> Tuple[int, object]:
+        """Download a file in `partial`, resuming it after every interruption, returning (bytes transferred,
+        hasher of the whole file).
+        """
+        transferred = 0
+        for attempt in range(1, self.retries + 1):
+            offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+            if offset >= file.size:  # longer than the file: nothing to resume (a complete one is checked before)
+                offset = 0
+            hasher = file.hasher()
+            try:
+                start, chunks = self.source.fetch(repo_id, commit, file, offset)
+                with open(partial, "r+b" if os.path.exists(partial) else "wb") as f:
+                    f.truncate(start)
+                    if hasher is not None and start:
+                        # the checksum covers the part downloaded before the interruption too
+                        f.seek(0)
+                        for chunk in iter(lambda: f.read(min(CHUNK_SIZE, start - f.tell())), b""):
+                            hasher.update(chunk)
+                    f.seek(start)
+                    for chunk in chunks:
+                        f.write(chunk)
+                        transferred += len(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+                return transferred, hasher
+            except OSError as message:  # requests errors are OSError too
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Download of {file.path} interrupted ({message}), resuming ({attempt}/{self.retries})")
+                time.sleep(min(2**attempt, 30))
+
+    def _download_file(
+        self, repo_id: str, commit: str, file: RemoteFile, folder: str, reuse: dict, verified: dict
+    ) -> int:
+        """Download (or resume) a file and check it, returning the bytes transferred."""
+        destination = os.path.join(folder, file.path)
+        if self._is_valid(destination, file, verified):
+            return 0
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if file.digest in reuse and os.path.exists(reuse[file.digest]):
+            try:
+                os.link(reuse[file.digest], destination)
+            except OSError:  # another file system (or no hard links): copy
+                shutil.copyfile(reuse[file.digest], destination)
+            return 0
+
+        partial = destination + ".incomplete"
+        if self._is_valid(partial, file, {}):  # complete, interrupted before the rename
+            os.replace(partial, destination)
+            return 0
+        transferred, hasher = self._fetch(repo_id, commit, file, partial)
+        size = os.path.getsize(partial)
+        digest = hasher.hexdigest() if hasher is not None else None
+        if size != file.size or digest != file.digest:
+            os.remove(partial)
+            raise ChecksumError(
+                f"{repo_id}/{file.path}: corrupted download (size {size}, checksum {digest}), "
+                f"expected size {file.size}, checksum {file.digest}"
+            )
+        os.replace(partial, destination)
+        return transferred
+
+    def download(
+        self, repo_id: str, revision: str = "main", allow_patterns: List[str] = None, ignore_patterns: List[str] = None
+    ) -> str:
+        """Download the selected files of a model revision (only the missing ones), returning the local folder.
+
+        Args:
+            repo_id (str): the model id, for example mistralai/Mistral-7B-v0.3
+            revision (str, optional): branch, tag or commit. Defaults to "main".
+            allow_patterns (List[str], optional): glob patterns of the files to download. Defaults to all.
+            ignore_patterns (List[str], optional): glob patterns of the files to skip. Defaults to None.
+
+        Returns:
+            str: the folder of the snapshot, to load with from_pretrained
+        """
+        commit, files = self.source.resolve(repo_id, revision)
+        files = [file for file in files if selected(file.path, allow_patterns, ignore_patterns)]
+        if not files:
+            raise ValueError(f"No file of {repo_id}@{revision} matches the patterns {allow_patterns}")
+        folder = self.revision_path(repo_id, commit)
+
+        # the revision is indexed before the download so the garbage collection doesn't remove it
+        def register(index):
+            model = index.setdefault(repo_id, {"refs": {}, "revisions": {}})
+            entry = model["revisions"].setdefault(commit, {"files": {}, "complete": False})
+            entry["last_used"] = time.time()
+            reuse = {}
+            for other, other_entry in model["revisions"].items():
+                for path, metadata in other_entry["files"].items():
+                    if other != commit and metadata.get("digest"):
+                        reuse[metadata["digest"]] = os.path.join(self.revision_path(repo_id, other), path)
+            # the files of the revision checked by a previous download (recorded when it completed)
+            verified = {path: metadata.get("digest") for path, metadata in entry["files"].items()}
+            return reuse, verified
+
+        reuse, verified = self._update_index(register)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            transferred = sum(
+                executor.map(lambda file: self._download_file(repo_id, commit, file, folder, reuse, verified), files)
+            )
+        elapsed = time.perf_counter() - start
+
+        def complete(index):
+            model = index[repo_id]
+            entry = model["revisions"][commit]
+            entry["files"].update({file.path: {"size": file.size, "digest": file.digest} for file in files})
+            entry["complete"] = True
+            entry["last_used"] = time.time()
+            if not commit.startswith(revision):
+                model["refs"][revision] = commit
+
+        self._update_index(complete)
+        logger.info(
+            f"{repo_id}@{commit[:10]}: {len(files)} files in {folder}, {transferred / 2**20:.1f}MB downloaded "
+            f"in {elapsed:.1f}s ({transferred / 2**20 / max(elapsed, 1e-9):.1f}MB/s)"
+        )
+        return folder
+
+    def resolve(self, repo_id: str, revision: str = "main") -> Optional[str]:
+        """Find a downloaded revision (branch, tag, commit or commit prefix) in the index, without network calls.
+
+        Returns:
+            Optional[str]: the folder of the snapshot, None if the revision is not available locally
+        """
+        model = self.read_index().get(repo_id)
+        if not model:
+            return None
+        commit = model["refs"].get(revision)
+        if commit is None:
+            commits = [candidate for candidate in model["revisions"] if candidate.startswith(revision)]
+            commit = commits[0] if len(commits) == 1 else None
+        entry = model["revisions"].get(commit) if commit else None
+        if not entry or not entry["complete"]:
+            return None
+        folder = self.revision_path(repo_id, commit)
+        if not all(os.path.exists(os.path.join(folder, path)) for path in entry["files"]):
+            logger.warning(f"Files of {repo_id}@{commit[:10]} missing in {folder}, download it again")
+            return None
+
+        def touch(index):
+            index[repo_id]["revisions"][commit]["last_used"] = time.time()
+
+        self._update_index(touch)
+        return folder
+
+    def models(self) -> List[dict]:
+        """The indexed revisions with their refs, size on disk and last use."""
+        rows = []
+        for repo_id, model in self.read_index().items():
+            for commit, entry in model["revisions"].items():
+                rows.append(
+                    {
+                        "model": repo_id,
+                        "commit": commit,
+                        "refs": [ref for ref, target in model["refs"].items() if target == commit],
+                        "files": len(entry["files"]),
+                        "size": sum(metadata["size"] for metadata in entry["files"].values()),
+                        "complete": entry["complete"],
+                        "last_used": entry["last_used"],
+                    }
+                )
+        return rows
+
+    def verify(self, repo_id: str, revision: str = "main") -> List[str]:
+        """Check again the checksums of a downloaded revision, returning the corrupted or missing files."""
+        model = self.read_index().get(repo_id, {"refs": {}, "revisions": {}})
+        commit = model["refs"].get(revision, revision)
+        entry = model["revisions"].get(commit)
+        if entry is None:
+            raise ValueError(f"{repo_id}@{revision} is not downloaded")
+        folder = self.revision_path(repo_id, commit)
+        corrupted = []
+        for path, metadata in entry["files"].items():
+            file = RemoteFile(path, metadata["size"])
+            if len(metadata["digest"] or "") == 64:
+                file.sha256 = metadata["digest"]
+            else:
+                file.blob_id = metadata["digest"]
+            file_path = os.path.join(folder, path)
+            if not os.path.exists(file_path) or os.path.getsize(file_path) != file.size:
+                corrupted.append(path)
+            elif file.hasher() is not None and file_hash(file_path, file.hasher()) != file.digest:
+                corrupted.append(path)
+        return corrupted
+
+    def remove(self, repo_id: str, commit: str):
+        """Delete a revision from the disk and from the index."""
+
+        def drop(index):
+            model = index.get(repo_id)
+            if model:
+                model["revisions"].pop(commit, None)
+                model["refs"] = {ref: target for ref, target in model["refs"].items() if target != commit}
+                if not model["revisions"]:
+                    index.pop(repo_id)
+
+        self._update_index(drop)
+        shutil.rmtree(self.revision_path(repo_id, commit), ignore_errors=True)
+
+    def gc(self, keep: int = settings.MODEL_REVISIONS_KEPT, dry_run: bool = False) -> int:
+        """Remove the stale revisions: the ones not pointed by a ref, except the `keep` most recently used for
+        each model, and the folders not in the index. Returns the bytes freed (or to free with `dry_run`).
+        """
+        index = self.read_index()
+        stale = []
+        for repo_id, model in index.items():
+            pointed = set(model["refs"].values())
+            others = sorted(
+                (commit for commit in model["revisions"] if commit not in pointed),
+                key=lambda commit: model["revisions"][commit]["last_used"],
+                reverse=True,
+            )
+            stale += [(repo_id, commit) for commit in others[keep:]]
+        known = {
+            self.revision_path(repo_id, commit) for repo_id, model in index.items() for commit in model["revisions"]
+        }
+        orphans = [
+            os.path.join(self.root, name, commit)
+            for name in (os.listdir(self.root) if os.path.isdir(self.root) else [])
+            if os.path.isdir(os.path.join(self.root, name))
+            for commit in os.listdir(os.path.join(self.root, name))
+            if os.path.join(self.root, name, commit) not in known
+        ]
+
+        folders = [self.revision_path(repo_id, commit) for repo_id, commit in stale] + orphans
+        freed = 0
+        for folder in folders:
+            for directory, _, names in os.walk(folder):
+                for name in names:
+                    file_path = os.path.join(directory, name)
+                    # a file linked by another revision is not freed
+                    if os.stat(file_path).st_nlink == 1:
+                        freed += os.path.getsize(file_path)
+        if dry_run:
+            return freed
+        for repo_id, commit in stale:
+            logger.info(f"Removing the stale revision {repo_id}@{commit[:10]}")
+            self.remove(repo_id, commit)
+        for folder in orphans:
+            logger.info(f"Removing {folder}, not in the index")
+            shutil.rmtree(folder, ignore_errors=True)
+        return freed
+
+
+@lru_cache(maxsize=None)
+def get_model_manager(path: str = settings.MODELS_PATH) -> ModelManager:
+    return ModelManager(path)
+
+
+def resolve_model_path(model: str, revision: str = "main") -> str:
+    """Resolve a model for from_pretrained: a local folder as it is, a model downloaded with the manager to its
+    snapshot (offline), otherwise the hub id unchanged.
+    """
+    if os.path.isdir(model):
+        return model
+    return get_model_manager().resolve(model, revision) or model
+
+
+if __name__ == "__main__":
+    manager = get_model_manager()
+    for row in manager.models():
+        print(json.dumps(row))
@@ -0,0 +1,168 @@
+import glob
+import multiprocessing
+import os
+import platform
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List
+
+from loguru import logger
+
+from experiments.config import settings
+
+# pytorch: eager fp32, onnx: exported with optimum and run by onnxruntime, onnx-int8: with dynamic int8 quantization
+RUNTIMES = ("pytorch", "onnx", "onnx-int8")
+ONNX_OPSET = 14
+ONNX_FILE_NAME = "model.onnx"  # written by the optimum export (the decoders with past are exported merged)
+
+
+def check_runtime(runtime: str) -> str:
+    if runtime not in RUNTIMES:
+        raise ValueError(f"Unknown runtime {runtime}, use one of {', '.join(RUNTIMES)}")
+    return runtime
+
+
+def onnx_file_name(runtime: str = "onnx") -> str:
+    """Name of the model file of a runtime: the export writes model.onnx, the quantization model_quantized.onnx."""
+    if check_runtime(runtime) == "onnx-int8":
+        return ONNX_FILE_NAME.replace(".onnx", "_quantized.onnx")
+    return ONNX_FILE_NAME
+
+
+def onnx_path(model: str, runtime: str = "onnx") -> str:
+    """Folder of the exported artifacts: inside the local snapshot, or in MODELS_PATH for a hub model."""
+    if os.path.isdir(model):
+        return os.path.join(model, runtime)
+    return os.path.join(settings.MODELS_PATH, model.replace("/", "--"), runtime)
+
+
+def _quantization_config():
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    flags = ""
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    if "avx512_vnni" in flags:
+        return AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    return AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+
+
+def export_onnx(model: str, model_class, output_path: str, use_cache: bool = False, **kwargs) -> str:
+    """Export a hugging face model to ONNX with optimum (the folder is replaced only when the export is complete).
+
+    The decoders exported `use_cache` take and return the keys/values of the previous tokens.
+    """
+    from optimum.exporters.onnx import main_export
+
+    task = model_class._auto_model_to_task(model_class.auto_model_class)
+    if use_cache:
+        task += "-with-past"
+    temporary = output_path + ".tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    logger.info(f"Exporting {model} to ONNX ({task}) in {output_path}")
+    # the scaled dot product attention of torch needs the opset 14
+    main_export(model, output=temporary, task=task, opset=ONNX_OPSET, do_validation=False)
+    if not os.path.exists(os.path.join(temporary, ONNX_FILE_NAME)):
+        raise FileNotFoundError(f"The ONNX export of {model} didn't write {ONNX_FILE_NAME}")
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(temporary, output_path)
+    return output_path
+
+
+def quantize_onnx(onnx_folder: str, output_path: str) -> str:
+    """Apply the dynamic int8 quantization (weights int8, activations quantized at run time) to the ONNX models."""
+    from optimum.onnxruntime import ORTQuantizer
+
+    temporary = output_path + ".tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    logger.info(f"Quantizing {onnx_folder} to int8 in {output_path}")
+    for file_path in sorted(glob.glob(os.path.join(onnx_folder, "*.onnx"))):
+        quantizer = ORTQuantizer.from_pretrained(onnx_folder, file_name=os.path.basename(file_path))
+        # the models larger than 2GB (the LLMs) need the external data format
+        large = (
+            os.path.getsize(file_path)
+            + sum(os.path.getsize(data) for data in glob.glob(os.path.join(onnx_folder, "*.onnx_data")))
+            > 2**31
+        )
+        quantizer.quantize(
+            save_dir=temporary, quantization_config=_quantization_config(), use_external_data_format=large
+        )
+    for name in os.listdir(onnx_folder):
+        if not name.endswith((".onnx", ".onnx_data")) and not os.path.exists(os.path.join(temporary, name)):
+            shutil.copy(os.path.join(onnx_folder, name), temporary)
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(temporary, output_path)
+    return output_path
+
+
+def ensure_onnx(model: str, model_class, runtime: str = "onnx", **kwargs) -> str:
+    """Export (and quantize) the model on first use, returning the folder of the cached artifacts."""
+    path = onnx_path(model, check_runtime(runtime))
+    if os.path.exists(os.path.join(path, onnx_file_name(runtime))):
+        return path
+    exported = onnx_path(model, "onnx")
+    if not os.path.exists(os.path.join(exported, ONNX_FILE_NAME)):
+        export_onnx(model, model_class, exported, use_cache=kwargs.get("use_cache", False))
+    if runtime == "onnx-int8":
+        quantize_onnx(exported, path)
+    return path
+
+
+def load_onnx_model(model: str, model_class, runtime: str = "onnx", **kwargs):
+    """Load the ONNX (or int8 quantized ONNX) version of a model with onnxruntime on CPU, exporting it if needed.
+
+    Args:
+        model (str): local snapshot or hugging face model id
+        model_class: the optimum class (ORTModelForFeatureExtraction, ORTModelForCausalLM)
+        runtime (str, optional): onnx or onnx-int8. Defaults to "onnx".
+        **kwargs: options of the optimum model (for example use_cache for the causal models)
+
+    Returns:
+        the optimum model
+    """
+    path = ensure_onnx(model, model_class, runtime, **kwargs)
+    return model_class.from_pretrained(
+        path, file_name=onnx_file_name(runtime), provider="CPUExecutionProvider", **kwargs
+    )
+
+
+def import_runtime(runtime: str):
+    """Import the libraries of a runtime, to measure the memory of the model alone."""
+    import torch  # noqa: F401
+    import transformers  # noqa: F401
+
+    if runtime != "pytorch":
+        import optimum.onnxruntime  # noqa: F401
+
+
+def rss_bytes() -> int:
+    """Resident memory of the process."""
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:  # psutil is optional, fallback to the peak resident memory
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchmark_runtimes(function: Callable, runtimes: List[str] = RUNTIMES, **kwargs) -> List[dict]:
+    """Run `function(runtime=..., **kwargs)` for each runtime, each in a new process so the memory of every
+    model is measured alone. The function returns a dict with its measures (latency, throughput, memory).
+    """
+    report = []
+    context = multiprocessing.get_context("spawn")
+    for runtime in runtimes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(function, runtime=runtime, **kwargs).result()
+        report.append(result)
+        print(
+            ", ".join(
+                f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}" for key, value in result.items()
+            )
+        )
+    return report
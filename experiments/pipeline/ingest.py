@@ -0,0 +1,344 @@
+import json
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List
+
+import pyarrow.dataset as ds
+import typer
+from loguru import logger
+
+from experiments.config import settings
+from experiments.embeddings.generate import generate_openai, generation_fastembed, generation_hugging_face
+from experiments.embeddings.store import EmbeddingStore
+from experiments.text.utils import clean_texts
+from experiments.vectordb.base import VectorStore
+from experiments.vectordb.hnsw import HNSWStore
+from experiments.vectordb.qdrant import QdrantStore
+
+app = typer.Typer()
+
+EMBEDDING_BACKENDS = {
+    "openai": generate_openai,
+    "fastembed": generation_fastembed,
+    "hugging_face": generation_hugging_face,
+}
+
+_DONE = object()  # end of stream marker
+
+
+@dataclass
+class Batch:
+    """A batch of records flowing through the pipeline, [start, end) are the row offsets in the dataset."""
+
+    start: int
+    end: int
+    records: List[dict]
+    texts: List[str] = None
+    embeddings: object = None
+
+
+@dataclass
+class StageMetrics:
+    """Number of records processed by a stage and the time spent processing them."""
+
+    name: str
+    records: int = 0
+    batches: int = 0
+    busy: float = 0.0
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def records_per_second(self) -> float:
+        return self.records / self.busy if self.busy else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.records} records in {self.batches} batches, busy {self.busy:.1f}s "
+            f"({self.records_per_second:.0f} records/sec)"
+        )
+
+
+class Checkpoint:
+    """Persist the offset of the last record committed to the vector store, to resume a crashed run."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return json.load(f)["offset"]
+
+    def save(self, offset: int):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"offset": offset, "updated": time.time()}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def read_batches(file_path: str, batch_size: int, offset: int = 0, limit: int = None):
+    """Read the parquet dataset in batches of records, starting from the row `offset`."""
+    position = 0
+    for record_batch in ds.dataset(file_path, format="parquet").to_batches(batch_size=batch_size):
+        if limit is not None and position >= limit:
+            return
+        start, end = position, position + record_batch.num_rows
+        position = end
+        if end <= offset:
+            continue
+        records = record_batch.slice(max(0, offset - start)).to_pylist()
+        start = max(start, offset)
+        if limit is not None and end > limit:
+            records = records[: limit - start]
+            end = limit
+        yield Batch(start=start, end=end, records=records)
+
+
+class Pipeline:
+    """Streaming ingestion: read -> clean -> embed -> write, every stage runs in its own thread.
+
+    The stages are connected by bounded queues: when a stage is slower than the previous one the
+    queue fills up and the previous stage blocks (backpressure), so the memory used is bounded by
+    `queue_size * batch_size` records for each stage. The batches are processed in order and the
+    checkpoint is updated only when a batch is committed, so a crashed run resumes from the last
+    committed batch. The stores that persist in bulk (the local hnsw index) commit with
+    `flush_function` every `flush_every` batches and at the end of the run.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        embed_function: Callable,
+        write_function: Callable,
+        checkpoint: Checkpoint,
+        batch_size: int = 256,
+        queue_size: int = 4,
+        limit: int = None,
+        flush_function: Callable = None,
+        flush_every: int = 1,
+    ):
+        self.file_path = file_path
+        self.embed_function = embed_function
+        self.write_function = write_function
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.limit = limit
+        self.flush_function = flush_function
+        self.flush_every = flush_every
+        self._written = None  # end offset of the last batch written and not yet committed
+        self._unflushed = 0
+        self.metrics = {name: StageMetrics(name) for name in ("read", "clean", "embed", "write")}
+        self._stop = threading.Event()
+        self._errors = []
+
+    @staticmethod
+    def clean(batch: Batch) -> Batch:
+        batch.texts = clean_texts([f"{record['title']} {record['abstract']}" for record in batch.records])
+        for record in batch.records:
+            record.pop("title", None)
+            record.pop("abstract", None)
+        return batch
+
+    def embed(self, batch: Batch) -> Batch:
+        batch.embeddings = self.embed_function(batch.texts)
+        return batch
+
+    def write(self, batch: Batch) -> Batch:
+        self.write_function(batch.embeddings, batch.records)
+        self._written = batch.end
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+        return batch
+
+    def flush(self):
+        """Commit the batches written: flush the store (if needed) and save the checkpoint."""
+        if self._written is None:
+            return
+        if self.flush_function is not None:
+            self.flush_function()
+        self.checkpoint.save(self._written)
+        self._written = None
+        self._unflushed = 0
+
+    def _put(self, output: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                output.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _run_stage(self, name: str, function: Callable, source: queue.Queue, output: queue.Queue):
+        metrics = self.metrics[name]
+        try:
+            while (batch := self._get(source)) is not _DONE:
+                start = time.perf_counter()
+                batch = function(batch)
+                metrics.busy += time.perf_counter() - start
+                metrics.records += len(batch.records)
+                metrics.batches += 1
+                if output is not None and not self._put(output, batch):
+                    return
+        except Exception as error:
+            logger.exception(f"Stage {name} failed: {error}")
+            self._errors.append(error)
+            self._stop.set()
+        finally:
+            if output is not None:
+                self._put(output, _DONE)
+
+    def _read(self, output: queue.Queue, offset: int):
+        metrics = self.metrics["read"]
+        try:
+            start = time.perf_counter()
+            for batch in read_batches(self.file_path, self.batch_size, offset=offset, limit=self.limit):
+                metrics.busy += time.perf_counter() - start
+                metrics.records += len(batch.records)
+                metrics.batches += 1
+                if not self._put(output, batch):
+                    return
+                start = time.perf_counter()
+        except Exception as error:
+            logger.exception(f"Stage read failed: {error}")
+            self._errors.append(error)
+            self._stop.set()
+        finally:
+            self._put(output, _DONE)
+
+    def run(self) -> int:
+        """Run the pipeline from the last checkpoint, returning the offset reached."""
+        offset = self.checkpoint.load()
+        if offset:
+            logger.info(f"Resuming the ingestion from record {offset}")
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(3)]
+        threads = [
+            threading.Thread(target=self._read, args=(queues[0], offset), name="read"),
+            threading.Thread(target=self._run_stage, args=("clean", self.clean, queues[0], queues[1]), name="clean"),
+            threading.Thread(target=self._run_stage, args=("embed", self.embed, queues[1], queues[2]), name="embed"),
+            threading.Thread(target=self._run_stage, args=("write", self.write, queues[2], None), name="write"),
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            logger.warning("Interrupted, stopping the pipeline at the last committed batch")
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        # the batches already written are committed even if a stage failed (the upserts are idempotent)
+        self.flush()
+
+        elapsed = time.perf_counter() - start
+        for metrics in self.metrics.values():
+            logger.info(str(metrics))
+        written = self.metrics["write"].records
+        logger.info(
+            f"Ingested {written} records in {elapsed:.1f}s ({written / elapsed if elapsed else 0:.0f} records/sec)"
+        )
+
+        if self._errors:
+            raise self._errors[0]
+        return self.checkpoint.load()
+
+
+def store_writer(store: VectorStore, create: bool = False) -> Callable:
+    """Write function for the pipeline upserting into a vector store (created on the first batch if `create`)."""
+    state = {"create": create}
+
+    def write(embeddings, records: List[dict]):
+        if state["create"]:
+            store.create(embeddings.shape[1])
+            state["create"] = False
+        store.upsert([record["id"] for record in records], embeddings, records)
+
+    return write
+
+
+def get_store(store: str, collection_name: str, store_path: str) -> VectorStore:
+    """Build the vector store by name: qdrant (server), lance, hnsw or mmap (embedded, saved in `store_path`)."""
+    if store == "qdrant":
+        return QdrantStore(collection_name=collection_name)
+    if store == "lance":
+        from experiments.vectordb.lance_utils import LanceStore
+
+        return LanceStore(table_name=collection_name, uri=store_path)
+    if store == "hnsw":
+        return HNSWStore(path=os.path.join(store_path, collection_name))
+    if store == "mmap":
+        return EmbeddingStore(path=os.path.join(store_path, collection_name))
+    raise typer.BadParameter("store must be one of qdrant, lance, hnsw, mmap")
+
+
+@app.callback()
+def main():
+    """Streaming ingestion of the arxiv dataset into a vector store."""
+
+
+@app.command()
+def ingest(
+    file_path: str = "./data/arxiv/dataset/dataset.parquet",
+    collection_name: str = settings.QDRANT_COLLECTION_NAME,
+    backend: str = "openai",
+    batch_size: int = 256,
+    queue_size: int = 4,
+    limit: int = None,
+    checkpoint_path: str = "./data/arxiv/checkpoints/ingest.json",
+    restart: bool = False,
+    store: str = "qdrant",
+    store_path: str = "./data/vectordb",
+    flush_every: int = 100,
+):
+    """Ingest the arxiv parquet dataset into a vector store: clean, embed and index the papers as a stream."""
+    settings._setup_logger()
+    if backend not in EMBEDDING_BACKENDS:
+        raise typer.BadParameter(f"backend must be one of {', '.join(EMBEDDING_BACKENDS)}")
+
+    checkpoint = Checkpoint(checkpoint_path)
+    if restart:
+        checkpoint.clear()
+
+    vector_store = get_store(store, collection_name, store_path)
+    # the embedded stores (hnsw index, memory-mapped matrix) commit on save, the other stores every batch
+    bulk = isinstance(vector_store, (HNSWStore, EmbeddingStore))
+
+    pipeline = Pipeline(
+        file_path=file_path,
+        embed_function=EMBEDDING_BACKENDS[backend],
+        write_function=store_writer(vector_store, create=checkpoint.load() == 0),
+        checkpoint=checkpoint,
+        flush_function=vector_store.save if bulk else None,
+        flush_every=flush_every if bulk else 1,
+        batch_size=batch_size,
+        queue_size=queue_size,
+        limit=limit if limit is not None else (settings.MAX_ARTICLES if settings.DEBUG_MODE else None),
+    )
+    offset = pipeline.run()
+    typer.echo(f"Ingestion completed up to record {offset}")
+
+
+if __name__ == "__main__":
+    app()
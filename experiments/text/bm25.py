@@ -0,0 +1,197 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Iterable, List
+
+import numpy as np
+
+from experiments.vectordb.base import SearchResult, matches
+
+# Payload fields kept by the keyword index for the filters, besides the id (the same indexed on qdrant)
+FILTER_FIELDS = ("categories", "journal-ref", "doi")
+
+# Words (with inner dots and dashes, to keep tokens like "h.264" or "x-ray") lowercased
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were which with we "
+    "our these those their can not but also been into than then there such using used based".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Split a text in lowercase word tokens without the stop words.
+
+    A regex tokenizer and not spaCy: the index is built on the whole dataset and the queries need the same
+    tokens, in microseconds.
+    """
+    return [token for token in TOKEN_PATTERN.findall((text or "").lower()) if token not in STOP_WORDS]
+
+
+class BM25Index:
+    """In memory BM25 keyword index over the arxiv papers, with the payload fields used by the filters.
+
+    The postings are kept as lists of (document, term frequency) and scored with numpy. A document added
+    again with the same id replaces the previous one (the old one is only hidden: the document frequencies
+    still count it until the index is rebuilt).
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids = []  # document -> id
+        self.payloads = []  # document -> filter fields
+        self.lengths = []  # document -> number of tokens
+        self.alive = []  # document -> not replaced or removed
+        self.rows = {}  # id -> document
+        self.postings = {}  # term -> ([documents], [term frequencies])
+        self._arrays = {}  # term -> (documents, term frequencies) numpy arrays, built on search
+        self._length_array = None
+        self.version = 0  # incremented on every change, to invalidate the caches of the searches
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, ids: List[str], texts: List[str], payloads: List[dict] = None) -> int:
+        """Index the texts with their ids and payloads (only the id and the `FILTER_FIELDS` are kept)."""
+        for index, (identifier, text) in enumerate(zip(ids, texts)):
+            self.remove([identifier])
+            document = len(self.ids)
+            tokens = tokenize(text)
+            for term, frequency in Counter(tokens).items():
+                documents, frequencies = self.postings.setdefault(term, ([], []))
+                documents.append(document)
+                frequencies.append(frequency)
+                self._arrays.pop(term, None)
+            payload = payloads[index] if payloads else {}
+            self.ids.append(identifier)
+            # the id too, so the filters on the id match like on the vector stores
+            self.payloads.append(
+                {"id": identifier, **{field: payload.get(field) for field in FILTER_FIELDS if payload.get(field)}}
+            )
+            self.lengths.append(len(tokens))
+            self.alive.append(True)
+            self.rows[identifier] = document
+        self._length_array = None
+        self.version += 1
+        return len(ids)
+
+    def remove(self, ids: List[str]) -> int:
+        removed = 0
+        for identifier in ids:
+            document = self.rows.pop(identifier, None)
+            if document is not None:
+                self.alive[document] = False
+                removed += 1
+        self.version += 1
+        return removed
+
+    def _postings(self, term: str):
+        if term not in self._arrays:
+            documents, frequencies = self.postings[term]
+            self._arrays[term] = (np.asarray(documents), np.asarray(frequencies, dtype=np.float32))
+        return self._arrays[term]
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every document for the query (0 for the documents without any query term)."""
+        if self._length_array is None:
+            self._length_array = np.asarray(self.lengths, dtype=np.float32)
+        lengths = self._length_array
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        if not len(lengths):
+            return scores
+        normalization = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1e-9))
+        total = len(self.ids)
+        for term, count in Counter(tokenize(query)).items():
+            if term not in self.postings:
+                continue
+            documents, frequencies = self._postings(term)
+            idf = math.log(1 + (total - len(documents) + 0.5) / (len(documents) + 0.5))
+            scores[documents] += count * idf * frequencies * (self.k1 + 1) / (frequencies + normalization[documents])
+        return scores
+
+    def search_batch(self, queries: List[str], limit: int = 10, filters: dict = None) -> List[List[SearchResult]]:
+        """Search many queries, returning the best `limit` documents matching the filters for each one."""
+        allowed = np.asarray(self.alive, dtype=bool)
+        if filters:
+            allowed &= np.fromiter((matches(payload, filters) for payload in self.payloads), bool, len(self.payloads))
+        results = []
+        for query in queries:
+            scores = self.scores(query)
+            scores[~allowed] = 0
+            candidates = np.flatnonzero(scores)
+            if len(candidates) > limit:
+                candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            results.append(
+                [
+                    SearchResult(id=self.ids[document], score=float(scores[document]), payload=self.payloads[document])
+                    for document in candidates
+                ]
+            )
+        return results
+
+    def search(self, query: str, limit: int = 10, filters: dict = None) -> List[SearchResult]:
+        return self.search_batch([query], limit=limit, filters=filters)[0]
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        state = {
+            "k1": self.k1,
+            "b": self.b,
+            "ids": self.ids,
+            "payloads": self.payloads,
+            "lengths": self.lengths,
+            "alive": self.alive,
+            "postings": self.postings,
+        }
+        with open(path + ".tmp", "w", encoding="utf8") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, encoding="utf8") as f:
+            state = json.load(f)
+        index = cls(k1=state["k1"], b=state["b"])
+        index.ids = state["ids"]
+        index.payloads = state["payloads"]
+        index.lengths = state["lengths"]
+        index.alive = state["alive"]
+        index.postings = {term: tuple(posting) for term, posting in state["postings"].items()}
+        index.rows = {identifier: row for row, identifier in enumerate(index.ids) if index.alive[row]}
+        return index
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict], batch_size: int = 10_000, **kwargs) -> "BM25Index":
+        """Build the index from arxiv records (id, title, abstract and the filter fields)."""
+        index = cls(**kwargs)
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                index.add([r["id"] for r in batch], [f"{r['title']} {r['abstract']}" for r in batch], batch)
+                batch = []
+        if batch:
+            index.add([r["id"] for r in batch], [f"{r['title']} {r['abstract']}" for r in batch], batch)
+        return index
+
+    @classmethod
+    def from_parquet(cls, file_path: str, limit: int = None, batch_size: int = 10_000, **kwargs) -> "BM25Index":
+        """Build the index streaming the arxiv parquet dataset (a file or a folder of parts)."""
+        import pyarrow.dataset as ds
+
+        def records():
+            columns = ["id", "title", "abstract", *FILTER_FIELDS]
+            count = 0
+            for record_batch in ds.dataset(file_path, format="parquet").to_batches(
+                columns=columns, batch_size=batch_size
+            ):
+                for record in record_batch.to_pylist():
+                    if limit is not None and count >= limit:
+                        return
+                    count += 1
+                    yield record
+
+        return cls.from_records(records(), batch_size=batch_size, **kwargs)
@@ -1,13 +1,94 @@
-import spacy
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List
 
-# Load spaCy model
-# Remember to download the model before running the code
-# poetry run spacy download en_core_web_sm
-nlp = spacy.load("en_core_web_sm")
+from experiments.config import settings
 
+SPACY_MODEL = "en_core_web_sm"
 
-# Function to clean text using spaCy
-def clean_text(text):
-    doc = nlp(text)
+
+@lru_cache(maxsize=None)
+def get_nlp(model_name: str = SPACY_MODEL, disable: tuple = ("parser", "ner")):
+    """Load a spaCy model on first use, only once for each process (spaCy itself is imported lazily).
+
+    Remember to download the model before running the code:
+    poetry run spacy download en_core_web_sm
+
+    Args:
+        model_name (str, optional): the spaCy model. Defaults to "en_core_web_sm".
+        disable (tuple, optional): the components to disable, the parser and the named entities are not
+            needed for the lemmas and the stop words. Defaults to ("parser", "ner").
+
+    Returns:
+        spacy.Language: the spaCy pipeline
+    """
+    import spacy
+
+    return spacy.load(model_name, disable=list(disable))
+
+
+# Memoization of the cleaned texts (LRU bounded), shared by clean_text and clean_texts
+_CLEANED = OrderedDict()
+_CLEANED_LOCK = threading.Lock()
+_MISSING = object()
+
+
+def _memo_get(text: str):
+    with _CLEANED_LOCK:
+        cleaned = _CLEANED.get(text, _MISSING)
+        if cleaned is not _MISSING:
+            _CLEANED.move_to_end(text)
+        return cleaned
+
+
+def _memo_put(text: str, cleaned: str):
+    with _CLEANED_LOCK:
+        _CLEANED[text] = cleaned
+        while len(_CLEANED) > settings.TEXT_CLEAN_CACHE_SIZE:
+            _CLEANED.popitem(last=False)
+
+
+def _doc_to_text(doc) -> str:
     clean_tokens = [token.lemma_ for token in doc if not token.is_stop and not token.is_punct]
     return " ".join(clean_tokens)
+
+
+# Function to clean text using spaCy
+def clean_text(text):
+    cleaned = _memo_get(text)
+    if cleaned is _MISSING:
+        cleaned = _doc_to_text(get_nlp()(text))
+        _memo_put(text, cleaned)
+    return cleaned
+
+
+def clean_texts(
+    texts: List[str],
+    batch_size: int = settings.TEXT_CLEAN_BATCH_SIZE,
+    n_process: int = settings.TEXT_CLEAN_PROCESSES,
+) -> List[str]:
+    """Clean a list of texts (lemmas without stop words and punctuation) with the spaCy pipe.
+
+    The texts already cleaned are taken from the memoization cache, the others are deduplicated and
+    processed in batches by `n_process` processes.
+
+    Args:
+        texts (List[str]): the texts to clean
+        batch_size (int, optional): texts for each spaCy batch. Defaults to settings.TEXT_CLEAN_BATCH_SIZE.
+        n_process (int, optional): number of processes (-1 for all the cpus). Defaults to settings.TEXT_CLEAN_PROCESSES.
+
+    Returns:
+        List[str]: the cleaned texts, in the input order
+    """
+    results = [_memo_get(text) for text in texts]
+    missing = list(dict.fromkeys(text for text, cleaned in zip(texts, results) if cleaned is _MISSING))
+    computed = {}
+    if missing:
+        # spawning processes costs more than cleaning a few texts
+        processes = n_process if len(missing) > batch_size else 1
+        for text, doc in zip(missing, get_nlp().pipe(missing, batch_size=batch_size, n_process=processes)):
+            computed[text] = _doc_to_text(doc)
+            _memo_put(text, computed[text])
+
+    return [computed[text] if cleaned is _MISSING else cleaned for text, cleaned in zip(texts, results)]
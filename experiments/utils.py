@@ -1,7 +1,21 @@
 import os
+import subprocess  # noqa: S404
+import sys
 
 import yaml
 
+# Maximum import time (seconds) of the modules that are imported by the worker processes and the CLIs
+IMPORT_TIME_BUDGETS = {
+    "experiments.config": 0.5,
+    "experiments.text.utils": 0.5,
+    "experiments.embeddings.generate": 0.5,
+    "experiments.vectordb.qdrant": 2.0,
+    "experiments.pipeline.ingest": 2.0,
+    "experiments.vectordb.lance_utils": 3.5,
+}
+# Libraries loaded lazily, when they are used: importing the modules above must not load them
+HEAVY_MODULES = ("spacy", "openai", "torch", "transformers", "sentence_transformers", "fastembed", "onnxruntime")
+
 
 def read_yaml_file(filepath):
     with open(filepath, "r") as file:
@@ -19,3 +33,53 @@ def ensure_directory_exists(file_path):
     except Exception as message:
         print(f"Impossible to create the CACHE folder: {file_path} - error: {message}")
         return False
+
+
+def measure_import_time(module: str) -> float:
+    """Measure the cumulative import time of a module in a fresh interpreter with `python -X importtime`.
+
+    Args:
+        module (str): the module to import
+
+    Returns:
+        float: the import time in seconds
+    """
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # every line is "import time: self [us] | cumulative | imported package"
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1_000_000
+    raise ValueError(f"Impossible to measure the import time of {module}")
+
+
+def heavy_imports(module: str, heavy_modules: tuple = HEAVY_MODULES) -> list:
+    """List the heavy libraries loaded by the import of a module, in a fresh interpreter."""
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", f"import sys, {module}; print(' '.join(sys.modules))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    loaded = set(result.stdout.split())
+    return [name for name in heavy_modules if name in loaded]
+
+
+def check_import_time(budgets: dict = None) -> bool:
+    """Check that the import time of the modules is inside their budget (see IMPORT_TIME_BUDGETS)."""
+    within_budget = True
+    for module, budget in (budgets or IMPORT_TIME_BUDGETS).items():
+        elapsed = measure_import_time(module)
+        status = "OK" if elapsed <= budget else "OVER BUDGET"
+        print(f"{module}: {elapsed:.3f}s (budget {budget:.3f}s) {status}")
+        within_budget = within_budget and elapsed <= budget
+    return within_budget
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_import_time() else 1)
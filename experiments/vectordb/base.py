@@ -0,0 +1,69 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import List
+
+import numpy as np
+
+
+@dataclass
+class SearchResult:
+    """A search hit: the id of the point, its similarity score (higher is better) and its payload."""
+
+    id: str
+    score: float
+    payload: dict = field(default_factory=dict)
+
+
+class VectorStore(ABC):
+    """Common interface of the vector stores (qdrant, lance and the local hnsw index).
+
+    The ids are the ids of the documents (the arxiv ids), every backend maps them to its own point ids.
+    The filters are a dict of payload field -> value (see `matches`): all the fields must match.
+    Every change of the points increments `version`, so the caches of the searches can be invalidated.
+    """
+
+    version = 0
+
+    def _changed(self):
+        self.version += 1
+
+    @abstractmethod
+    def create(self, dimension: int):
+        """Create (or recreate) the collection for vectors of the given dimension."""
+
+    @abstractmethod
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[dict] = None) -> int:
+        """Insert or replace the vectors with the given ids, returning the number of points written."""
+
+    @abstractmethod
+    def search(self, vector: np.ndarray, limit: int = 10, filters: dict = None) -> List[SearchResult]:
+        """Search the nearest neighbours (cosine similarity) of a vector."""
+
+    @abstractmethod
+    def delete(self, ids: List[str]) -> int:
+        """Delete the points with the given ids, returning the number of points deleted."""
+
+    def search_batch(self, vectors: np.ndarray, limit: int = 10, filters: dict = None) -> List[List[SearchResult]]:
+        """Search the nearest neighbours of many vectors (the backends override it with a single request)."""
+        return [self.search(vector, limit=limit, filters=filters) for vector in np.atleast_2d(vectors)]
+
+
+# Payload fields holding a list of space separated tokens (for example "cs.CL cs.LG"): they match a token
+TEXT_FIELDS = {"categories"}
+
+
+def _match(field: str, stored, value) -> bool:
+    if isinstance(value, (list, tuple, set)):
+        return any(_match(field, stored, item) for item in value)
+    if field in TEXT_FIELDS and isinstance(stored, str):
+        return value in stored.split()
+    return stored == value
+
+
+def matches(payload: dict, filters: dict = None) -> bool:
+    """Check if a payload matches all the filters (used by the backends filtering in process).
+
+    A value matches the field exactly, a list of values matches any of them and the text fields (categories)
+    match one of their tokens: {"categories": ["cs.CL", "cs.LG"], "journal-ref": "Phys. Rev. D 76"}.
+    """
+    return not filters or all(_match(key, payload.get(key), value) for key, value in filters.items())
@@ -0,0 +1,341 @@
+import heapq
+import json
+import math
+import os
+import time
+from typing import List
+
+import numpy as np
+
+from experiments.vectordb.base import SearchResult, VectorStore, matches
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2 normalize the vectors (float32), so the cosine similarity is the dot product."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class HNSWIndex:
+    """Hierarchical Navigable Small World graph (Malkov & Yashunin) over a float32 matrix, cosine distance.
+
+    Every node is inserted in the layers from 0 up to a random level (exponentially less nodes in the upper
+    layers): the search descends greedily from the top layer and explores the bottom layer with a beam of
+    `ef` candidates. The deleted nodes are kept in the graph (for connectivity) and skipped in the results.
+    """
+
+    def __init__(self, dimension: int, m: int = 16, ef_construction: int = 200, ef_search: int = 64, seed: int = 42):
+        self.dimension = dimension
+        self.m = m
+        self.m0 = 2 * m  # the bottom layer has twice the connections
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.count = 0
+        self.levels = []  # top layer of each node
+        self.graph = []  # graph[layer][node] -> list of neighbours
+        self.entry_point = None
+        self.deleted = set()
+        self._level_multiplier = 1 / math.log(m)
+        self._rng = np.random.default_rng(seed)
+        self._vectors = np.empty((1024, dimension), dtype=np.float32)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[: self.count]
+
+    def _distances(self, query: np.ndarray, nodes: List[int]) -> np.ndarray:
+        return 1.0 - self._vectors[nodes] @ query
+
+    def _search_layer(self, query: np.ndarray, entry_points: List[int], ef: int, layer: int) -> List[tuple]:
+        """Beam search inside a layer, returning the `ef` closest (distance, node) sorted by distance."""
+        graph = self.graph[layer]
+        visited = set(entry_points)
+        candidates = list(zip(self._distances(query, entry_points).tolist(), entry_points))
+        heapq.heapify(candidates)
+        # max-heap (negative distances) of the best results found so far
+        results = heapq.nsmallest(ef, candidates)
+        results = [(-dist, node) for dist, node in results]
+        heapq.heapify(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if dist > -results[0][0] and len(results) >= ef:
+                break
+            neighbours = [neighbour for neighbour in graph.get(node, ()) if neighbour not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for neighbour_dist, neighbour in zip(self._distances(query, neighbours).tolist(), neighbours):
+                if len(results) < ef or neighbour_dist < -results[0][0]:
+                    heapq.heappush(candidates, (neighbour_dist, neighbour))
+                    heapq.heappush(results, (-neighbour_dist, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted((-dist, node) for dist, node in results)
+
+    def _select_neighbours(self, candidates: List[tuple], m: int) -> List[int]:
+        """Select up to m neighbours among the (distance, node) candidates sorted by distance.
+
+        Heuristic of the paper: a candidate closer to an already selected neighbour than to the node is
+        skipped, this keeps connections in different directions. The skipped ones fill the free slots.
+        """
+        if len(candidates) <= 1:
+            return [node for _, node in candidates]
+        nodes = [node for _, node in candidates]
+        # distances between all the candidates, computed once
+        pairwise = (1.0 - self._vectors[nodes] @ self._vectors[nodes].T).tolist()
+        selected, skipped = [], []
+        for position, (dist, _) in enumerate(candidates):
+            if len(selected) >= m:
+                break
+            row = pairwise[position]
+            if any(row[other] < dist for other in selected):
+                skipped.append(position)
+            else:
+                selected.append(position)
+        selected.extend(skipped[: m - len(selected)])
+        return [nodes[position] for position in selected]
+
+    def add(self, vector: np.ndarray) -> int:
+        """Insert a vector in the graph, returning its node number."""
+        vector = normalize(vector)
+        node = self.count
+        if node == len(self._vectors):
+            grown = np.empty((2 * len(self._vectors), self.dimension), dtype=np.float32)
+            grown[:node] = self._vectors
+            self._vectors = grown
+        self._vectors[node] = vector
+        self.count += 1
+
+        level = int(-math.log(1.0 - self._rng.random()) * self._level_multiplier)
+        self.levels.append(level)
+        while len(self.graph) <= level:
+            self.graph.append({})
+        for layer in range(level + 1):
+            self.graph[layer][node] = []
+
+        if self.entry_point is None:
+            self.entry_point = node
+            return node
+
+        entry_points = [self.entry_point]
+        top_level = self.levels[self.entry_point]
+        for layer in range(top_level, level, -1):
+            entry_points = [self._search_layer(vector, entry_points, 1, layer)[0][1]]
+
+        for layer in range(min(level, top_level), -1, -1):
+            candidates = self._search_layer(vector, entry_points, self.ef_construction, layer)
+            max_connections = self.m0 if layer == 0 else self.m
+            neighbours = self._select_neighbours(candidates, self.m)
+            self.graph[layer][node] = neighbours
+            for neighbour in neighbours:
+                links = self.graph[layer][neighbour]
+                links.append(node)
+                if len(links) > max_connections:
+                    dists = self._distances(self._vectors[neighbour], links).tolist()
+                    self.graph[layer][neighbour] = self._select_neighbours(sorted(zip(dists, links)), max_connections)
+            entry_points = [candidate for _, candidate in candidates]
+
+        if level > top_level:
+            self.entry_point = node
+        return node
+
+    def search(self, query: np.ndarray, k: int = 10, ef: int = None) -> List[tuple]:
+        """Approximate k nearest neighbours, as (node, cosine similarity) sorted by similarity."""
+        if self.entry_point is None:
+            return []
+        query = normalize(query)
+        entry_points = [self.entry_point]
+        for layer in range(self.levels[self.entry_point], 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+        results = self._search_layer(query, entry_points, max(ef or self.ef_search, k), 0)
+        return [(node, 1.0 - dist) for dist, node in results if node not in self.deleted][:k]
+
+    def exact_search(self, query: np.ndarray, k: int = 10, mask: np.ndarray = None) -> List[tuple]:
+        """Exact k nearest neighbours by brute force (numpy), `mask` selects the nodes to consider."""
+        scores = self.vectors @ normalize(query)
+        if self.deleted:
+            scores[list(self.deleted)] = -np.inf
+        if mask is not None:
+            scores[~mask] = -np.inf
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(node), float(scores[node])) for node in top if np.isfinite(scores[node])]
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), self.vectors)
+        with open(os.path.join(path, "graph.json"), "w") as f:
+            json.dump(
+                {
+                    "dimension": self.dimension,
+                    "m": self.m,
+                    "ef_construction": self.ef_construction,
+                    "ef_search": self.ef_search,
+                    "levels": self.levels,
+                    "entry_point": self.entry_point,
+                    "deleted": sorted(self.deleted),
+                    "graph": [list(layer.items()) for layer in self.graph],
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "HNSWIndex":
+        with open(os.path.join(path, "graph.json")) as f:
+            state = json.load(f)
+        index = cls(
+            state["dimension"], m=state["m"], ef_construction=state["ef_construction"], ef_search=state["ef_search"]
+        )
+        vectors = np.load(os.path.join(path, "vectors.npy"))
+        index._vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, state["dimension"])
+        index.count = len(vectors)
+        index.levels = state["levels"]
+        index.entry_point = state["entry_point"]
+        index.deleted = set(state["deleted"])
+        index.graph = [{int(node): neighbours for node, neighbours in layer} for layer in state["graph"]]
+        return index
+
+
+class HNSWStore(VectorStore):
+    """In-process vector store on top of `HNSWIndex`, persisted in a folder: no external service needed.
+
+    With `exact=True` the searches are done by brute force, useful to validate the approximate results.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        m: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+        exact: bool = False,
+    ):
+        self.path = path
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.exact = exact
+        self.index = None
+        self.ids = []  # node -> document id
+        self.payloads = []  # node -> payload
+        self.nodes = {}  # document id -> node
+        if path and os.path.exists(os.path.join(path, "graph.json")):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def create(self, dimension: int):
+        self.index = HNSWIndex(dimension, m=self.m, ef_construction=self.ef_construction, ef_search=self.ef_search)
+        self.ids, self.payloads, self.nodes = [], [], {}
+        self._changed()
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[dict] = None) -> int:
+        vectors = np.atleast_2d(vectors)
+        if self.index is None:
+            self.create(vectors.shape[1])
+        for position, (identifier, vector) in enumerate(zip(ids, vectors)):
+            if identifier in self.nodes:
+                # the graph doesn't support updates in place: the old node is deleted
+                self.index.deleted.add(self.nodes[identifier])
+            self.nodes[identifier] = self.index.add(vector)
+            self.ids.append(identifier)
+            self.payloads.append(payloads[position] if payloads else {})
+        self._changed()
+        return len(vectors)
+
+    def delete(self, ids: List[str]) -> int:
+        deleted = 0
+        for identifier in ids:
+            node = self.nodes.pop(identifier, None)
+            if node is not None:
+                self.index.deleted.add(node)
+                deleted += 1
+        self._changed()
+        return deleted
+
+    def search(
+        self, vector: np.ndarray, limit: int = 10, filters: dict = None, exact: bool = None
+    ) -> List[SearchResult]:
+        if self.index is None:
+            return []
+        if self.exact if exact is None else exact:
+            mask = np.array([matches(payload, filters) for payload in self.payloads]) if filters else None
+            hits = self.index.exact_search(vector, k=limit, mask=mask)
+        else:
+            # filter the approximate results, widening the beam until there are enough matches
+            ef = max(self.ef_search, limit)
+            while True:
+                hits = [
+                    (node, score)
+                    for node, score in self.index.search(vector, k=ef, ef=ef)
+                    if matches(self.payloads[node], filters)
+                ]
+                if len(hits) >= limit or ef >= self.index.count:
+                    break
+                ef *= 2
+        return [
+            SearchResult(id=self.ids[node], score=score, payload=self.payloads[node]) for node, score in hits[:limit]
+        ]
+
+    def save(self, path: str = None):
+        if self.index is None:  # nothing created or upserted yet
+            return
+        path = path or self.path
+        self.index.save(path)
+        with open(os.path.join(path, "documents.json"), "w") as f:
+            json.dump({"ids": self.ids, "payloads": self.payloads}, f)
+
+    def load(self, path: str = None):
+        path = path or self.path
+        self.index = HNSWIndex.load(path)
+        with open(os.path.join(path, "documents.json")) as f:
+            documents = json.load(f)
+        self.ids, self.payloads = documents["ids"], documents["payloads"]
+        self.nodes = {identifier: node for node, identifier in enumerate(self.ids) if node not in self.index.deleted}
+        self._changed()
+
+
+def benchmark(store: HNSWStore, queries: np.ndarray, k: int = 10, ef_values: tuple = (16, 32, 64, 128, 256)) -> list:
+    """Measure recall@k and latency of the approximate search for different beam sizes against the exact search.
+
+    Args:
+        store (HNSWStore): the store to benchmark
+        queries (np.ndarray): the query vectors
+        k (int, optional): number of neighbours. Defaults to 10.
+        ef_values (tuple, optional): beam sizes to try. Defaults to (16, 32, 64, 128, 256).
+
+    Returns:
+        list: one dict for each ef with the recall and the mean latency in milliseconds
+    """
+    start = time.perf_counter()
+    exact = [{hit.id for hit in store.search(query, limit=k, exact=True)} for query in queries]
+    exact_latency = (time.perf_counter() - start) / len(queries) * 1000
+
+    report = []
+    for ef in ef_values:
+        store.ef_search = ef
+        start = time.perf_counter()
+        approximate = [{hit.id for hit in store.search(query, limit=k, exact=False)} for query in queries]
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(found & expected) / len(expected) for found, expected in zip(approximate, exact)])
+        report.append({"ef": ef, "recall": float(recall), "latency_ms": latency, "exact_latency_ms": exact_latency})
+        print(f"ef={ef}: recall@{k} {recall:.3f}, latency {latency:.2f}ms (exact {exact_latency:.2f}ms)")
+    return report
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(50, 128))
+    data = (centers[rng.integers(0, 50, 5000)] + rng.normal(scale=0.5, size=(5000, 128))).astype(np.float32)
+    store = HNSWStore()
+    start = time.perf_counter()
+    store.upsert([str(index) for index in range(len(data))], data)
+    print(f"Index built in {time.perf_counter() - start:.1f}s")
+    benchmark(store, data[rng.integers(0, len(data), 100)] + rng.normal(scale=0.1, size=(100, 128)))
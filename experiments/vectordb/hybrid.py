@@ -0,0 +1,93 @@
+from typing import Callable, List
+
+import numpy as np
+
+from experiments.text.bm25 import BM25Index
+from experiments.vectordb.base import SearchResult, VectorStore
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[SearchResult]], k: int = 60, weights: List[float] = None, limit: int = None
+) -> List[SearchResult]:
+    """Fuse many rankings of the same documents with the reciprocal rank fusion.
+
+    Every document scores sum(weight / (k + rank)) over the rankings where it appears (rank from 1): the
+    scores of the different retrievers (cosine, BM25) are not comparable, their ranks are.
+
+    Args:
+        rankings (List[List[SearchResult]]): the results of each retriever, best first
+        k (int, optional): smoothing constant, higher values flatten the weight of the top ranks. Defaults to 60.
+        weights (List[float], optional): weight of each ranking. Defaults to None (all 1).
+        limit (int, optional): number of results. Defaults to None (all).
+
+    Returns:
+        List[SearchResult]: the fused results with the fusion score, best first
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores, payloads = {}, {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, result in enumerate(ranking, start=1):
+            scores[result.id] = scores.get(result.id, 0.0) + weight / (k + rank)
+            if result.payload and len(result.payload) > len(payloads.get(result.id, {})):
+                payloads[result.id] = result.payload
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [
+        SearchResult(id=identifier, score=score, payload=payloads.get(identifier, {})) for identifier, score in fused
+    ]
+
+
+class HybridSearch:
+    """Search combining the vector similarity of a store with the BM25 keywords, fused by rank.
+
+    Both the retrievers apply the same payload filters (categories, journal-ref, doi, see `base.matches`)
+    and search all the queries of a batch at once: the vector store answers the whole batch with one
+    request (qdrant `search_batch`) and the keyword index is in memory.
+    """
+
+    def __init__(
+        self,
+        store: VectorStore,
+        keyword_index: BM25Index,
+        embed_function: Callable = None,
+        candidates: int = 50,
+        rrf_k: int = 60,
+        weights: tuple = (1.0, 1.0),
+    ):
+        self.store = store
+        self.keyword_index = keyword_index
+        self.embed_function = embed_function
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.weights = weights
+
+    def search_batch(
+        self, queries: List[str], vectors: np.ndarray = None, limit: int = 10, filters: dict = None
+    ) -> List[List[SearchResult]]:
+        """Hybrid search of many queries.
+
+        Args:
+            queries (List[str]): the query texts, for the keyword search (and the embeddings if `vectors` is None)
+            vectors (np.ndarray, optional): the query embeddings. Defaults to None: computed with `embed_function`.
+            limit (int, optional): number of results for each query. Defaults to 10.
+            filters (dict, optional): payload filters applied by both the retrievers. Defaults to None.
+
+        Returns:
+            List[List[SearchResult]]: the fused results of each query
+        """
+        if vectors is None:
+            if self.embed_function is None:
+                raise ValueError("Pass the query vectors or an embed_function")
+            vectors = self.embed_function(queries)
+        candidates = max(self.candidates, limit)
+        dense = self.store.search_batch(vectors, limit=candidates, filters=filters)
+        sparse = self.keyword_index.search_batch(queries, limit=candidates, filters=filters)
+        return [
+            reciprocal_rank_fusion([vector_hits, keyword_hits], k=self.rrf_k, weights=list(self.weights), limit=limit)
+            for vector_hits, keyword_hits in zip(dense, sparse)
+        ]
+
+    def search(
+        self, query: str, vector: np.ndarray = None, limit: int = 10, filters: dict = None
+    ) -> List[SearchResult]:
+        vectors = None if vector is None else np.atleast_2d(vector)
+        return self.search_batch([query], vectors=vectors, limit=limit, filters=filters)[0]
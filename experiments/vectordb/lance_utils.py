@@ -1,27 +1,118 @@
+import json
+import os
+from functools import lru_cache
+from typing import List
+
 import lancedb
+import numpy as np
+import pyarrow as pa
 from lancedb.embeddings import get_registry
 from lancedb.pydantic import LanceModel, Vector
 
 from experiments.config import settings
 from experiments.embeddings.generate import generate_openai
+from experiments.vectordb.base import SearchResult, VectorStore, matches
+
+LANCE_DB_PATH = "/tmp/db"  # noqa: S108
+
+
+@lru_cache()
+def _get_db(uri: str, pid: int):
+    return lancedb.connect(uri)
+
+
+def get_db(uri: str = LANCE_DB_PATH):
+    """Connect to the lance database on first use, the connection is shared inside the process."""
+    return _get_db(uri, os.getpid())
+
+
+@lru_cache()
+def get_embedding_function(name: str = "text-embedding-ada-002"):
+    """Create the OpenAI embedding function of the lance registry on first use."""
+    settings._configure_openai(settings.OPENAI_KEY)
+    return get_registry().get("openai").create(name=name)
+
+
+@lru_cache()
+def get_words_model():
+    """Build the lance schema of the `words` table, its vector size depends on the embedding function."""
+    func = get_embedding_function()
 
-db = lancedb.connect("/tmp/db")
-func = get_registry().get("openai").create(name="text-embedding-ada-002")
+    class Words(LanceModel):
+        text: str = func.SourceField()
+        vector: Vector(func.ndims()) = func.VectorField()
 
+    return Words
 
-class Words(LanceModel):
-    text: str = func.SourceField()
-    vector: Vector(func.ndims()) = func.VectorField()
 
+def create_words_table(words: list, mode: str = "overwrite"):
+    """Create the `words` table and add the words, embedded by the lance embedding function."""
+    table = get_db().create_table("words", schema=get_words_model(), mode=mode)
+    table.add([{"text": word} for word in words])
+    return table
 
-table = db.create_table("words", schema=Words, mode="overwrite")
-table.add([{"text": "hello world"}, {"text": "goodbye world"}])
 
-query = "greetings"
-actual = table.search(query).limit(1).to_pydantic(Words)[0]
-print(actual.text)
+def search_words(table, query: str, limit: int = 1) -> list:
+    return table.search(query).limit(limit).to_pydantic(get_words_model())
+
+
+class LanceStore(VectorStore):
+    """Vector store interface over a lance table (id, vector, payload as json), embedded without a server."""
+
+    def __init__(self, table_name: str = "documents", uri: str = LANCE_DB_PATH):
+        self.table_name = table_name
+        self.uri = uri
+
+    def _table(self):
+        return get_db(self.uri).open_table(self.table_name)
+
+    def create(self, dimension: int):
+        schema = pa.schema(
+            [("id", pa.string()), ("vector", pa.list_(pa.float32(), dimension)), ("payload", pa.string())]
+        )
+        get_db(self.uri).create_table(self.table_name, schema=schema, mode="overwrite")
+        self._changed()
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[dict] = None) -> int:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        data = pa.table(
+            {
+                "id": list(ids),
+                "vector": pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel()), vectors.shape[1]),
+                "payload": [json.dumps(payloads[index] if payloads else {}) for index in range(len(ids))],
+            }
+        )
+        self._table().merge_insert("id").when_matched_update_all().when_not_matched_insert_all().execute(data)
+        self._changed()
+        return len(ids)
+
+    def search(self, vector: np.ndarray, limit: int = 10, filters: dict = None) -> List[SearchResult]:
+        table = self._table()
+        # the payload is stored as json: the filters are applied on the results, widening the search if needed
+        fetch = limit if not filters else limit * 4
+        while True:
+            rows = table.search(np.asarray(vector, dtype=np.float32)).metric("cosine").limit(fetch).to_list()
+            results = [
+                SearchResult(id=row["id"], score=1.0 - row["_distance"], payload=json.loads(row["payload"]))
+                for row in rows
+            ]
+            results = [result for result in results if matches(result.payload, filters)]
+            if len(results) >= limit or len(rows) < fetch:
+                return results[:limit]
+            fetch *= 4
+
+    def delete(self, ids: List[str]) -> int:
+        if ids:
+            quoted = ", ".join("'" + str(identifier).replace("'", "''") + "'" for identifier in ids)
+            self._table().delete(f"id IN ({quoted})")
+            self._changed()
+        return len(ids)
 
 
 if __name__ == "__main__":
+    table = create_words_table(["hello world", "goodbye world"])
+
+    actual = search_words(table, "greetings")[0]
+    print(actual.text)
 
     embedding = generate_openai(["This is a test"])
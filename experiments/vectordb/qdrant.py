@@ -1,5 +1,15 @@
+import json
+import os
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
+from functools import lru_cache
+from itertools import islice
 from typing import List
 
+import numpy as np
+from loguru import logger
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from qdrant_client.http.models import PointStruct
@@ -7,45 +17,188 @@ from qdrant_client.http.models import PointStruct
 from experiments.config import settings
 from experiments.datasets.arxiv import load_parquet_dataset
 from experiments.embeddings.generate import generate_openai
-from experiments.text.utils import clean_text
+from experiments.text.utils import clean_texts
+from experiments.vectordb.base import TEXT_FIELDS, SearchResult, VectorStore
 
-CLIENT = QdrantClient(
-    url=settings.QDRANT_HOST,
-    port=settings.QDRANT_PORT,
-    api_key=settings.QDRANT_API_KEY,
-)  # Adjust host and port as needed
 
+@lru_cache()
+def _get_client(pid: int) -> QdrantClient:
+    return QdrantClient(
+        url=settings.QDRANT_HOST,
+        port=settings.QDRANT_PORT,
+        grpc_port=settings.QDRANT_GRPC_PORT,
+        prefer_grpc=settings.QDRANT_PREFER_GRPC,
+        api_key=settings.QDRANT_API_KEY,
+    )  # Adjust host and port as needed
 
-def create_collection(collection_name: str = settings.QDRANT_COLLECTION_NAME, vector_size: int = 1536):
-    CLIENT.recreate_collection(
+
+def get_client() -> QdrantClient:
+    """Get the qdrant client, created on first use and shared (with its connection pool) inside the process.
+
+    The client is cached by process id: a forked worker process creates its own connections instead of
+    sharing the parent's sockets.
+    """
+    return _get_client(os.getpid())
+
+
+# Namespace for the point ids derived from the arxiv ids
+ARXIV_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://arxiv.org/abs/")
+
+
+def point_id(arxiv_id: str) -> str:
+    """Derive a stable qdrant point id (uuid) from an arxiv id, so reinserting a paper overwrites it."""
+    return str(uuid.uuid5(ARXIV_NAMESPACE, str(arxiv_id)))
+
+
+def content_point_id(attributes: dict, embedding) -> str:
+    """Derive a stable qdrant point id (uuid) from the content of a point without an arxiv id: its payload, or
+    its vector when there is no payload. The same content inserted again overwrites the point.
+    """
+    if attributes:
+        content = json.dumps(attributes, sort_keys=True, default=str)
+    else:
+        content = np.asarray(embedding, dtype=np.float32).tobytes().hex()
+    return str(uuid.uuid5(ARXIV_NAMESPACE, content))
+
+
+def quantization_config(quantization: str = settings.QDRANT_QUANTIZATION):
+    """Build the qdrant quantization config: int8 (scalar, 4x smaller) or pq (product, 16x smaller)."""
+    if not quantization:
+        return None
+    if quantization == "int8":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+        )
+    if quantization == "pq":
+        return models.ProductQuantization(
+            product=models.ProductQuantizationConfig(compression=models.CompressionRatio.X16, always_ram=True)
+        )
+    raise ValueError(f"Unknown quantization {quantization}, use int8 or pq")
+
+
+def create_collection(
+    collection_name: str = settings.QDRANT_COLLECTION_NAME,
+    vector_size: int = 1536,
+    quantization: str = settings.QDRANT_QUANTIZATION,
+):
+    """Create (or recreate) the collection, with cosine distance.
+
+    With `quantization` the quantized vectors are kept in RAM and the float vectors on disk: they are read
+    only to rescore the candidates of the searches.
+    """
+    get_client().recreate_collection(
         collection_name=collection_name,
-        vectors_config=models.VectorParams(size=vector_size, distance=models.Distance.COSINE),
+        vectors_config=models.VectorParams(
+            size=vector_size, distance=models.Distance.COSINE, on_disk=True if quantization else None
+        ),
+        quantization_config=quantization_config(quantization),
     )
     print(f"Collection {collection_name} created")
 
 
-def insert_embeddings_to_qdrant(
-    embeddings: List[str], payload: dict = None, collection_name: str = settings.QDRANT_COLLECTION_NAME
-):
+def search_params(
+    quantization: str = settings.QDRANT_QUANTIZATION,
+    rescore: bool = True,
+    oversampling: float = settings.QDRANT_OVERSAMPLING,
+) -> models.SearchParams:
+    """Search on the quantized vectors `oversampling` times the limit, rescoring the candidates with the floats."""
+    if not quantization:
+        return None
+    return models.SearchParams(quantization=models.QuantizationSearchParams(rescore=rescore, oversampling=oversampling))
+
 
+def _points(embeddings: List[List[float]], payload: List[dict], ids: List):
     for index, embedding in enumerate(embeddings):
-        attributes = payload[index]
-        point = PointStruct(
-            id=index,  # Unique identifier for the point
-            vector=embedding,
+        attributes = payload[index] if payload else None
+        if ids is not None:
+            identifier = ids[index]
+        elif attributes and attributes.get("id"):
+            identifier = point_id(attributes["id"])
+        else:
+            identifier = content_point_id(attributes, embedding)
+        yield PointStruct(
+            id=identifier,  # Unique identifier for the point
+            vector=np.asarray(embedding, dtype=float).tolist(),
             payload=attributes if attributes else {"example_field": "example_value"},  # Optional payload
         )
-        CLIENT.upsert(collection_name=collection_name, points=[point])
-        print(f"Point {index} inserted")
+
+
+def insert_embeddings_to_qdrant(
+    embeddings: List[List[float]],
+    payload: List[dict] = None,
+    collection_name: str = settings.QDRANT_COLLECTION_NAME,
+    ids: List = None,
+    batch_size: int = settings.QDRANT_BATCH_SIZE,
+    parallel: int = settings.QDRANT_PARALLEL,
+    wait: bool = True,
+) -> int:
+    """Upsert the embeddings in batches, with parallel requests.
+
+    Args:
+        embeddings (List[List[float]]): the vectors (list of lists or numpy matrix)
+        payload (List[dict], optional): the payload of each point. Defaults to None.
+        collection_name (str, optional): the collection. Defaults to settings.QDRANT_COLLECTION_NAME.
+        ids (List, optional): the point ids. Defaults to None: derived from the arxiv `id` of the payload
+            (see `point_id`), or from the content of the point without it (see `content_point_id`), so
+            running the ingestion again doesn't duplicate the points.
+        batch_size (int, optional): points for each request. Defaults to settings.QDRANT_BATCH_SIZE.
+        parallel (int, optional): concurrent requests. Defaults to settings.QDRANT_PARALLEL.
+        wait (bool, optional): wait that every batch is applied before answering. If False the batches are only
+            acknowledged and a final consistency barrier waits that all of them are applied. Defaults to True.
+
+    Returns:
+        int: the number of points inserted
+    """
+    start_time = time.perf_counter()
+    total_points = 0
+    last_point = None
+    pending = set()
+    points = _points(embeddings, payload, ids)
+
+    client = get_client()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        while batch := list(islice(points, batch_size)):
+            # bound the batches in flight, so the points are built only when they can be sent
+            if len(pending) >= parallel * 2:
+                done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(client.upsert, collection_name=collection_name, points=batch, wait=wait))
+            total_points += len(batch)
+            last_point = batch[-1]
+
+        for future in pending:
+            future.result()
+
+    if not wait and last_point is not None:
+        # the updates of a shard are applied in order: once a waited operation sent after all the others
+        # acknowledgments is applied, all the previous batches are applied too
+        client.upsert(collection_name=collection_name, points=[last_point], wait=True)
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Inserted {total_points} points in {elapsed:.1f}s ({total_points / elapsed:.0f} points/sec)")
+    return total_points
+
+
+# Payload indexes of the arxiv fields used by the filters: the ids (like "0704.0001") are keywords and the
+# categories are a text index of space separated tokens (see `build_filter`)
+ARXIV_INDEX = {
+    "id": models.PayloadSchemaType.KEYWORD,
+    "doi": models.PayloadSchemaType.KEYWORD,
+    "journal-ref": models.PayloadSchemaType.KEYWORD,
+    "categories": models.TextIndexParams(
+        type=models.TextIndexType.TEXT, tokenizer=models.TokenizerType.WHITESPACE, lowercase=False
+    ),
+}
 
 
 def create_index(collection_name: str = settings.QDRANT_COLLECTION_NAME, index: dict = None):
 
     if not index:
-        index = {"id": "integer", "doi": "text"}
+        index = ARXIV_INDEX
 
     for index_name, schema in index.items():
-        CLIENT.create_payload_index(
+        get_client().create_payload_index(
             collection_name=collection_name,
             field_name=index_name,
             field_schema=schema,
@@ -53,15 +206,111 @@ def create_index(collection_name: str = settings.QDRANT_COLLECTION_NAME, index:
         print(f"Index {index_name} created")
 
 
+def _condition(key: str, value):
+    if value is None:
+        return models.IsEmptyCondition(is_empty=models.PayloadField(key=key))
+    if key in TEXT_FIELDS:
+        if isinstance(value, (list, tuple, set)):
+            return models.Filter(should=[_condition(key, item) for item in value])
+        return models.FieldCondition(key=key, match=models.MatchText(text=value))
+    if isinstance(value, (list, tuple, set)):
+        return models.FieldCondition(key=key, match=models.MatchAny(any=list(value)))
+    return models.FieldCondition(key=key, match=models.MatchValue(value=value))
+
+
+def build_filter(filters: dict = None) -> models.Filter:
+    """Build the qdrant filter matching all the payload fields of the dict, with the semantic of `base.matches`.
+
+    A value matches exactly, a list matches any of its values and the categories match one of their tokens:
+    {"categories": ["cs.CL", "cs.LG"], "journal-ref": "Phys. Rev. D 76"}.
+    """
+    if not filters:
+        return None
+    return models.Filter(must=[_condition(key, value) for key, value in filters.items()])
+
+
+def _search_result(hit) -> SearchResult:
+    return SearchResult(id=hit.payload.get("id", hit.id), score=hit.score, payload=hit.payload)
+
+
+class QdrantStore(VectorStore):
+    """Vector store interface over a qdrant collection, the document ids are kept in the `id` payload field."""
+
+    def __init__(
+        self,
+        collection_name: str = settings.QDRANT_COLLECTION_NAME,
+        quantization: str = settings.QDRANT_QUANTIZATION,
+        oversampling: float = settings.QDRANT_OVERSAMPLING,
+    ):
+        self.collection_name = collection_name
+        self.quantization = quantization
+        self.oversampling = oversampling
+
+    def create(self, dimension: int):
+        create_collection(collection_name=self.collection_name, vector_size=dimension, quantization=self.quantization)
+        self._changed()
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[dict] = None) -> int:
+        payloads = [dict(payloads[index] if payloads else {}, id=identifier) for index, identifier in enumerate(ids)]
+        inserted = insert_embeddings_to_qdrant(
+            vectors,
+            payload=payloads,
+            collection_name=self.collection_name,
+            ids=[point_id(identifier) for identifier in ids],
+        )
+        self._changed()
+        return inserted
+
+    def search(
+        self, vector: np.ndarray, limit: int = 10, filters: dict = None, rescore: bool = True
+    ) -> List[SearchResult]:
+        hits = get_client().search(
+            collection_name=self.collection_name,
+            query_vector=np.asarray(vector, dtype=float).tolist(),
+            query_filter=build_filter(filters),
+            search_params=search_params(self.quantization, rescore=rescore, oversampling=self.oversampling),
+            limit=limit,
+            with_payload=True,
+        )
+        return [_search_result(hit) for hit in hits]
+
+    def search_batch(
+        self, vectors: np.ndarray, limit: int = 10, filters: dict = None, rescore: bool = True
+    ) -> List[List[SearchResult]]:
+        """Search many vectors with a single request."""
+        query_filter = build_filter(filters)
+        params = search_params(self.quantization, rescore=rescore, oversampling=self.oversampling)
+        batches = get_client().search_batch(
+            collection_name=self.collection_name,
+            requests=[
+                models.SearchRequest(
+                    vector=np.asarray(vector, dtype=float).tolist(),
+                    filter=query_filter,
+                    params=params,
+                    limit=limit,
+                    with_payload=True,
+                )
+                for vector in np.atleast_2d(vectors)
+            ],
+        )
+        return [[_search_result(hit) for hit in hits] for hits in batches]
+
+    def delete(self, ids: List[str]) -> int:
+        get_client().delete(
+            collection_name=self.collection_name,
+            points_selector=models.PointIdsList(points=[point_id(identifier) for identifier in ids]),
+        )
+        self._changed()
+        return len(ids)
+
+
 if __name__ == "__main__":
-    # Load the dataframe
-    dataset = load_parquet_dataset("./data/arxiv/dataset/dataset.parquet")
-    print(dataset.shape)
-    print(dataset.head())
-    # Subset the DataFrame
-    subset_df = dataset.head(settings.MAX_ARTICLES)
+    # Load only the subset of the dataframe that we need
+    subset_df = load_parquet_dataset("./data/arxiv/dataset/dataset.parquet", limit=settings.MAX_ARTICLES)
+    print(subset_df.shape)
+    print(subset_df.head())
     # Combine title and abstract
-    combined_cleaned = [clean_text(f"{row['title']} {row['abstract']}") for index, row in subset_df.iterrows()]
+    combined_cleaned = clean_texts((subset_df["title"] + " " + subset_df["abstract"]).tolist())
     subset_df = subset_df.drop(columns=["title", "abstract"])
     # Generate the embedding
     embeddings = generate_openai(combined_cleaned)
@@ -0,0 +1,228 @@
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Callable, List
+
+import numpy as np
+
+from experiments.config import settings
+from experiments.text.bm25 import BM25Index
+from experiments.vectordb.base import SearchResult, VectorStore
+from experiments.vectordb.hybrid import HybridSearch
+
+_MISSING = object()
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query for the cache keys: case and whitespace don't change the results of a search."""
+    return " ".join(query.split()).casefold()
+
+
+def filters_key(filters: dict = None) -> str:
+    """Canonical string of the filters (the order of the fields and of the values lists doesn't matter, the
+    types of the values do: 2020 and "2020" don't match the same payloads).
+    """
+    if not filters:
+        return ""
+    canonical = {
+        key: sorted(value, key=repr) if isinstance(value, (list, tuple, set)) else value
+        for key, value in filters.items()
+    }
+    return json.dumps(canonical, sort_keys=True, default=str)
+
+
+def size_of(value) -> int:
+    """Approximate bytes used by a cached value (embedding or search results)."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if isinstance(value, list):
+        return 56 + sum(size_of(item) for item in value)
+    if isinstance(value, SearchResult):
+        return 120 + len(value.id) + len(json.dumps(value.payload, default=str))
+    return 64 + len(str(value))
+
+
+class TTLCache:
+    """Thread safe LRU cache with expiration, bounded both by number of entries and by (approximate) bytes.
+
+    The least recently used entries are evicted when one of the limits is exceeded and the entries older
+    than `ttl` seconds are dropped when they are read.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float = None, size_function: Callable = size_of):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_function = size_function
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (value, expires, size)
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.size_function(value)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class Retriever:
+    """Search path with a two level cache in front of the embedding model and the vector store.
+
+    - query text -> embedding: a recurring query is not embedded again
+    - query + filters + limit -> results: a recurring search doesn't hit the vector store
+
+    The results are cached together with the `version` of the store (and of the keyword index): an upsert
+    or a delete through the store invalidates all of them. The writes done by other processes are seen
+    after at most the results `ttl`.
+    """
+
+    def __init__(
+        self,
+        store: VectorStore,
+        embed_function: Callable,
+        model_name: str = "default",
+        keyword_index: BM25Index = None,
+        embedding_cache: TTLCache = None,
+        result_cache: TTLCache = None,
+    ):
+        self.store = store
+        self.embed_function = embed_function
+        self.model_name = model_name
+        self.keyword_index = keyword_index
+        self.hybrid = HybridSearch(store, keyword_index) if keyword_index is not None else None
+        self.embedding_cache = embedding_cache or TTLCache(
+            settings.QUERY_EMBEDDING_CACHE_ENTRIES,
+            settings.QUERY_EMBEDDING_CACHE_BYTES,
+            ttl=settings.QUERY_EMBEDDING_CACHE_TTL,
+        )
+        self.result_cache = result_cache or TTLCache(
+            settings.SEARCH_RESULT_CACHE_ENTRIES,
+            settings.SEARCH_RESULT_CACHE_BYTES,
+            ttl=settings.SEARCH_RESULT_CACHE_TTL,
+        )
+        self._version = None
+
+    @property
+    def version(self) -> tuple:
+        """Version of the searched data: the store and the keyword index."""
+        return self.store.version, self.keyword_index.version if self.keyword_index is not None else None
+
+    def _check_version(self) -> tuple:
+        version = self.version
+        if version != self._version:
+            # the data changed: the cached results are stale, free their memory
+            self.result_cache.clear()
+            self._version = version
+        return version
+
+    def embed(self, queries: List[str]) -> np.ndarray:
+        """Embed the queries, calling the model once for all the queries not in the cache."""
+        keys = [(self.model_name, normalize_query(query)) for query in queries]
+        vectors = [self.embedding_cache.get(key) for key in keys]
+        missing = {}  # key -> position of the first query to embed
+        for position, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None:
+                missing.setdefault(key, position)
+        if missing:
+            embedded = np.asarray(
+                self.embed_function([queries[position] for position in missing.values()]), dtype=np.float32
+            )
+            computed = dict(zip(missing, embedded))
+            for key, vector in computed.items():
+                self.embedding_cache.put(key, vector)
+            vectors = [vector if vector is not None else computed[key] for key, vector in zip(keys, vectors)]
+        return np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def search_batch(self, queries: List[str], limit: int = 10, filters: dict = None) -> List[List[SearchResult]]:
+        """Search many queries (hybrid when there is a keyword index), only the ones not cached hit the store."""
+        version = self._check_version()
+        keys = [(normalize_query(query), filters_key(filters), limit, version) for query in queries]
+        results = [self.result_cache.get(key) for key in keys]
+        missing = {}
+        for position, (key, result) in enumerate(zip(keys, results)):
+            if result is None:
+                missing.setdefault(key, position)
+        if missing:
+            texts = [queries[position] for position in missing.values()]
+            vectors = self.embed(texts)
+            if self.hybrid is not None:
+                found = self.hybrid.search_batch(texts, vectors=vectors, limit=limit, filters=filters)
+            else:
+                found = self.store.search_batch(vectors, limit=limit, filters=filters)
+            computed = dict(zip(missing, found))
+            for key, result in computed.items():
+                self.result_cache.put(key, result)
+            results = [result if result is not None else computed[key] for key, result in zip(keys, results)]
+        # copies: the results of the callers can't change the cached ones
+        return [[replace(hit, payload=copy.deepcopy(hit.payload)) for hit in result] for result in results]
+
+    def search(self, query: str, limit: int = 10, filters: dict = None) -> List[SearchResult]:
+        return self.search_batch([query], limit=limit, filters=filters)[0]
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[dict] = None) -> int:
+        """Write through the store (invalidating the cached results)."""
+        return self.store.upsert(ids, vectors, payloads)
+
+    def delete(self, ids: List[str]) -> int:
+        return self.store.delete(ids)
+
+    def stats(self) -> dict:
+        """Hit rate, size and evictions of the two caches."""
+        return {"embeddings": self.embedding_cache.stats(), "results": self.result_cache.stats()}
@@ -0,0 +1,401 @@
+import queue
+import re
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Iterator, List, Optional
+
+import numpy as np
+import typer
+from loguru import logger
+
+from experiments.config import settings
+
+WHISPER_SAMPLERATE = 16_000
+WHISPER_WINDOW_SECONDS = 30.0  # whisper transcribes at most 30 seconds at once
+
+app = typer.Typer()
+
+
+class Resampler:
+    """Streaming resampler: anti aliasing low pass (windowed sinc FIR) and linear interpolation.
+
+    The filter history and the fractional position are kept between the blocks, so a stream resampled
+    block by block is the same as resampled at once (without clicks at the block boundaries).
+    """
+
+    def __init__(self, samplerate: int, target: int = WHISPER_SAMPLERATE, taps: int = 63):
+        self.step = samplerate / target
+        self.identity = samplerate == target
+        cutoff = min(1.0, target / samplerate) * 0.9  # of the input nyquist frequency
+        n = np.arange(taps) - (taps - 1) / 2
+        kernel = cutoff * np.sinc(cutoff * n) * np.hamming(taps)
+        self.kernel = (kernel / kernel.sum()).astype(np.float32)
+        self.history = np.zeros(taps - 1, dtype=np.float32)
+        self.pending = np.zeros(0, dtype=np.float32)  # filtered samples not interpolated yet
+        self.position = 0.0  # position of the next output sample in `pending`
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        block = np.asarray(block, dtype=np.float32)
+        if self.identity:
+            return block
+        signal = np.concatenate([self.history, block])
+        self.history = signal[len(signal) - len(self.history) :]
+        filtered = np.concatenate([self.pending, np.convolve(signal, self.kernel, mode="valid")])
+        last = len(filtered) - 1
+        count = int((last - self.position) // self.step) + 1 if last >= self.position else 0
+        positions = self.position + np.arange(count) * self.step
+        output = np.interp(positions, np.arange(len(filtered)), filtered).astype(np.float32)
+        following = self.position + count * self.step
+        consumed = min(int(following), last)
+        self.pending = filtered[consumed:]
+        self.position = following - consumed
+        return output
+
+
+def resample(audio: np.ndarray, samplerate: int, target: int = WHISPER_SAMPLERATE) -> np.ndarray:
+    return Resampler(samplerate, target).process(audio)
+
+
+class EnergyVAD:
+    """Voice activity detection on the energy of 30ms frames, against an adaptive noise floor.
+
+    A frame is speech when it is `margin_db` over the noise floor (and over `min_db`); a segment starts
+    after `start_frames` speech frames and ends after `silence_ms` without speech.
+    """
+
+    def __init__(
+        self,
+        samplerate: int = WHISPER_SAMPLERATE,
+        frame_ms: int = 30,
+        margin_db: float = 10.0,
+        min_db: float = -45.0,
+        start_frames: int = 3,
+        silence_ms: int = settings.VAD_SILENCE_MS,
+    ):
+        self.frame_size = samplerate * frame_ms // 1000
+        self.margin_db = margin_db
+        self.min_db = min_db
+        self.start_frames = start_frames
+        self.silence_frames = max(silence_ms // frame_ms, 1)
+        self.noise_db = min_db - margin_db
+        self.speaking = False
+        self._voiced = 0
+        self._silent = 0
+
+    def update(self, frame: np.ndarray) -> Optional[str]:
+        """Classify a frame, returning "start" or "end" when a speech segment starts or ends."""
+        energy = 10 * np.log10(np.mean(np.square(frame, dtype=np.float64)) + 1e-12)
+        voiced = energy > max(self.noise_db + self.margin_db, self.min_db)
+        if not voiced:
+            # the floor follows the noise slowly up and immediately down
+            self.noise_db = min(energy, 0.95 * self.noise_db + 0.05 * energy)
+        if not self.speaking:
+            self._voiced = self._voiced + 1 if voiced else 0
+            if self._voiced >= self.start_frames:
+                self.speaking, self._silent = True, 0
+                return "start"
+        else:
+            self._silent = 0 if voiced else self._silent + 1
+            if self._silent >= self.silence_frames:
+                self.speaking, self._voiced = False, 0
+                return "end"
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_whisper_model(model_name: str = settings.WHISPER_MODEL) -> tuple:
+    """Load the whisper processor and model (on CPU) only once in the process."""
+    from transformers import WhisperForConditionalGeneration, WhisperProcessor
+
+    from experiments.model_manager import resolve_model_path
+
+    source = resolve_model_path(model_name)
+    processor = WhisperProcessor.from_pretrained(source)
+    model = WhisperForConditionalGeneration.from_pretrained(source)
+    model.eval()
+    return processor, model
+
+
+class WhisperBackend:
+    """Transcribe 16kHz audio with a hugging face whisper model on CPU (thread safe: the model is shared)."""
+
+    def __init__(self, model_name: str = settings.WHISPER_MODEL, language: str = None, max_new_tokens: int = 224):
+        self.model_name = model_name
+        self.language = language
+        self.max_new_tokens = max_new_tokens
+        self._lock = threading.Lock()
+
+    def __call__(self, audio: np.ndarray) -> str:
+        import torch
+
+        with self._lock:  # the first chunks of the pool must not load the model twice
+            processor, model = get_whisper_model(self.model_name)
+        features = processor(audio, sampling_rate=WHISPER_SAMPLERATE, return_tensors="pt").input_features
+        with torch.inference_mode():
+            tokens = model.generate(
+                features, language=self.language, task="transcribe", max_new_tokens=self.max_new_tokens
+            )
+        return processor.batch_decode(tokens, skip_special_tokens=True)[0].strip()
+
+
+def _words(text: str) -> List[str]:
+    return re.sub(r"[^\w\s']", "", text.lower()).split()
+
+
+def merge_overlap(previous: str, text: str, max_words: int = 12, max_offset: int = 2) -> str:
+    """Remove from `text` the words at its start repeating the end of `previous` (the overlapping audio)."""
+    before, words = _words(previous), text.split()
+    after = _words(text)
+    if len(after) != len(words):  # punctuation only words: keep the text as it is
+        return text
+    for size in range(min(len(before), len(after), max_words), 0, -1):
+        # the first words of a chunk can be a word cut by the overlap start, skip up to `max_offset` of them
+        for offset in range(min(max_offset, len(after) - size) + 1):
+            if before[-size:] == after[offset : offset + size]:
+                return " ".join(words[offset + size :])
+    return text
+
+
+@dataclass
+class Transcript:
+    """Text of a chunk of speech, with its position in the audio and the delay behind the live audio."""
+
+    start: float  # seconds of audio
+    end: float
+    text: str
+    final: bool  # last chunk of a speech segment
+    latency: float = 0.0  # seconds between the last audio of the chunk fed and the transcript emitted
+
+
+@dataclass
+class TranscriptionStats:
+    audio_seconds: float = 0.0
+    speech_seconds: float = 0.0
+    processing_seconds: float = 0.0
+    chunks: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+    @property
+    def real_time_factor(self) -> float:
+        """Processing time over audio time (below 1 the pool keeps up with the live audio)."""
+        return self.processing_seconds / self.audio_seconds if self.audio_seconds else 0.0
+
+    def __str__(self) -> str:
+        latencies = np.asarray(self.latencies or [0.0])
+        return (
+            f"{self.audio_seconds:.1f}s of audio, {self.speech_seconds:.1f}s of speech in {self.chunks} chunks, "
+            f"real time factor {self.real_time_factor:.2f}, latency behind real time "
+            f"{latencies.mean():.2f}s (p95 {np.percentile(latencies, 95):.2f}s, max {latencies.max():.2f}s)"
+        )
+
+
+class StreamingTranscriber:
+    """Transcribe a live audio stream: resampling, voice activity detection, overlapping chunks and a pool.
+
+    The audio is fed in blocks of any size and samplerate (`feed`), resampled to 16kHz and split in speech
+    segments by the VAD (the silence is never transcribed). Every `chunk_seconds` of speech (and at the end
+    of a segment) a chunk starting `overlap_seconds` before is submitted to the worker pool; the transcripts
+    are emitted in order, with the words repeated by the overlap removed, to `on_transcript` and to the
+    `transcripts` queue.
+
+    Args:
+        transcribe (Callable, optional): 16kHz float32 audio -> text. Defaults to a WhisperBackend.
+        workers (int, optional): chunks transcribed in parallel. Defaults to settings.TRANSCRIPTION_WORKERS.
+        chunk_seconds (float, optional): speech sent at once. Defaults to settings.TRANSCRIPTION_CHUNK_SECONDS.
+        overlap_seconds (float, optional): audio repeated between the chunks. Defaults to settings.TRANSCRIPTION_OVERLAP_SECONDS.
+        vad (EnergyVAD, optional): the voice activity detection. Defaults to EnergyVAD().
+        padding_seconds (float, optional): audio kept before and after a speech segment. Defaults to 0.2.
+        on_transcript (Callable, optional): called with every Transcript (from a worker thread).
+    """
+
+    def __init__(
+        self,
+        transcribe: Callable = None,
+        workers: int = settings.TRANSCRIPTION_WORKERS,
+        chunk_seconds: float = settings.TRANSCRIPTION_CHUNK_SECONDS,
+        overlap_seconds: float = settings.TRANSCRIPTION_OVERLAP_SECONDS,
+        vad: EnergyVAD = None,
+        padding_seconds: float = 0.2,
+        on_transcript: Callable = None,
+    ):
+        if chunk_seconds + overlap_seconds > WHISPER_WINDOW_SECONDS:
+            raise ValueError(f"chunk + overlap must be at most {WHISPER_WINDOW_SECONDS} seconds")
+        self.transcribe = transcribe or WhisperBackend()
+        self.chunk = int(chunk_seconds * WHISPER_SAMPLERATE)
+        self.overlap = int(overlap_seconds * WHISPER_SAMPLERATE)
+        self.padding = int(padding_seconds * WHISPER_SAMPLERATE)
+        self.vad = vad or EnergyVAD()
+        self.on_transcript = on_transcript
+        self.transcripts = queue.Queue()
+        self.stats = TranscriptionStats()
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whisper")
+        self._resampler = None
+        self._samplerate = None
+        self._audio = np.zeros(0, dtype=np.float32)  # recent audio, starting at sample `_audio_start`
+        self._audio_start = 0
+        self._frame = np.zeros(0, dtype=np.float32)  # samples of the next VAD frame
+        self._samples = 0  # samples fed (at 16kHz)
+        self._segment_start = None  # first sample of the current speech segment
+        self._chunk_start = None  # first new sample of the next chunk
+        self._submitted = 0
+        self._emitted = 0
+        self._done = {}  # sequence -> (Transcript, continuation) completed but not emitted yet
+        self._previous = ""  # text of the last chunk of the segment, for the overlap merge
+        self._lock = threading.Lock()
+        self._futures = []
+
+    def feed(self, frames: np.ndarray, samplerate: int):
+        """Add a block of audio (float in [-1, 1] or int16, mono or with channels on the last axis)."""
+        frames = np.asarray(frames)
+        if frames.dtype == np.int16:
+            frames = frames.astype(np.float32) / 32768
+        if frames.ndim > 1:
+            frames = frames.mean(axis=1)
+        if self._resampler is None or samplerate != self._samplerate:
+            self._resampler, self._samplerate = Resampler(samplerate), samplerate
+        audio = self._resampler.process(frames)
+        now = time.perf_counter()
+        self.stats.audio_seconds += len(frames) / samplerate
+
+        self._audio = np.concatenate([self._audio, audio])
+        frame_size = self.vad.frame_size
+        position = self._samples - len(self._frame)  # first sample of the pending VAD frame
+        pending = np.concatenate([self._frame, audio])
+        self._samples += len(audio)
+        complete = len(pending) // frame_size * frame_size
+        for start in range(0, complete, frame_size):
+            event = self.vad.update(pending[start : start + frame_size])
+            end = position + start + frame_size
+            if event == "start":
+                self._segment_start = max(end - self.vad.start_frames * frame_size - self.padding, self._audio_start)
+                self._chunk_start = self._segment_start
+            elif event == "end":
+                self._submit(self._chunk_start, min(end + self.padding, self._samples), final=True, fed_at=now)
+                self._segment_start = self._chunk_start = None
+            elif self._segment_start is not None and end - self._chunk_start >= self.chunk:
+                self._submit(self._chunk_start, end, final=False, fed_at=now)
+                self._chunk_start = end
+        self._frame = pending[complete:]
+
+        # keep only the audio still needed: the current chunk with its overlap, or the padding before speech
+        keep_from = self._chunk_start - self.overlap if self._chunk_start is not None else self._samples - self.padding
+        keep_from = max(keep_from - self.vad.start_frames * frame_size, self._audio_start)
+        self._audio = self._audio[keep_from - self._audio_start :]
+        self._audio_start = keep_from
+
+    def _submit(self, start: int, end: int, final: bool, fed_at: float):
+        continuation = start != self._segment_start
+        begin = max(start - self.overlap if continuation else start, self._audio_start)
+        audio = self._audio[begin - self._audio_start : end - self._audio_start].copy()
+        sequence = self._submitted
+        self._submitted += 1
+        self.stats.speech_seconds += (end - start) / WHISPER_SAMPLERATE
+        future = self._executor.submit(self._run, sequence, audio, start, end, final, continuation, fed_at)
+        self._futures.append(future)
+
+    def _run(self, sequence, audio, start, end, final, continuation, fed_at):
+        began = time.perf_counter()
+        try:
+            text = self.transcribe(audio)
+        except Exception as message:
+            logger.error(f"Transcription of the chunk {start / WHISPER_SAMPLERATE:.1f}s failed: {message}")
+            text = ""
+        transcript = Transcript(start / WHISPER_SAMPLERATE, end / WHISPER_SAMPLERATE, text, final)
+        with self._lock:
+            self.stats.processing_seconds += time.perf_counter() - began
+            self._done[sequence] = (transcript, continuation, fed_at)
+            # emit in order: a chunk waits for the previous ones (needed to merge the overlap)
+            while self._emitted in self._done:
+                transcript, continuation, fed_at = self._done.pop(self._emitted)
+                text = transcript.text
+                transcript.text = merge_overlap(self._previous, text) if continuation else text
+                self._previous = "" if transcript.final else text
+                transcript.latency = time.perf_counter() - fed_at
+                self.stats.latencies.append(transcript.latency)
+                self.stats.chunks += 1
+                self._emitted += 1
+                self.transcripts.put(transcript)
+                if self.on_transcript is not None:
+                    self.on_transcript(transcript)
+
+    def flush(self):
+        """End of the stream: transcribe the open speech segment and wait for all the chunks."""
+        if self._segment_start is not None:
+            self._submit(self._chunk_start, self._samples, final=True, fed_at=time.perf_counter())
+            self._segment_start = self._chunk_start = None
+        for future in self._futures:
+            future.result()
+        self._futures = []
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def wav_blocks(file_path: str, block_seconds: float = 0.1, realtime: bool = False) -> Iterator[tuple]:
+    """Read a 16 bit WAV file in blocks of (float32 mono frames, samplerate), at the pace of the audio with
+    `realtime` (to simulate a live stream), otherwise as fast as possible.
+    """
+    with wave.open(file_path, "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"Only 16 bit WAV files are supported, {file_path} has {8 * f.getsampwidth()} bits")
+        samplerate, channels = f.getframerate(), f.getnchannels()
+        block = max(int(samplerate * block_seconds), 1)
+        start = time.perf_counter()
+        position = 0
+        while data := f.readframes(block):
+            frames = np.frombuffer(data, dtype=np.int16).reshape(-1, channels).mean(axis=1) / 32768
+            position += len(frames)
+            if realtime:
+                time.sleep(max(start + position / samplerate - time.perf_counter(), 0))
+            yield frames.astype(np.float32), samplerate
+
+
+def transcribe_stream(blocks, transcriber: StreamingTranscriber) -> Iterator[Transcript]:
+    """Feed the audio blocks to the transcriber, yielding the transcripts as soon as they are ready."""
+    for frames, samplerate in blocks:
+        transcriber.feed(frames, samplerate)
+        while not transcriber.transcripts.empty():
+            yield transcriber.transcripts.get()
+    transcriber.flush()
+    while not transcriber.transcripts.empty():
+        yield transcriber.transcripts.get()
+
+
+@app.callback()
+def main():
+    """Streaming speech to text with whisper."""
+
+
+@app.command()
+def transcribe(
+    file_path: str,
+    realtime: bool = False,
+    model_name: str = settings.WHISPER_MODEL,
+    language: str = None,
+    workers: int = settings.TRANSCRIPTION_WORKERS,
+    chunk_seconds: float = settings.TRANSCRIPTION_CHUNK_SECONDS,
+):
+    """Transcribe a WAV file as a live stream (with --realtime at the pace of the audio), printing the
+    transcripts as they are emitted and the latency behind real time at the end.
+    """
+    backend = WhisperBackend(model_name, language=language)
+    with StreamingTranscriber(backend, workers=workers, chunk_seconds=chunk_seconds) as transcriber:
+        for transcript in transcribe_stream(wav_blocks(file_path, realtime=realtime), transcriber):
+            typer.echo(f"[{transcript.start:7.1f}s - {transcript.end:7.1f}s] {transcript.text}")
+    typer.echo(str(transcriber.stats), err=True)
+
+
+if __name__ == "__main__":
+    app()
@@ -1,15 +1,30 @@
-import io
+import subprocess
 import threading
 import time
-import pyaudio
 import wave
-import typer
-from pydub import AudioSegment
-import sounddevice as sd
+from contextlib import ExitStack
+from typing import Callable
+
 import numpy as np
+import typer
+
+# PortAudio is needed only to record from the real devices (the synthetic device works without it)
+try:
+    import pyaudio
+except (ImportError, OSError):
+    pyaudio = None
+try:
+    import sounddevice as sd
+except (ImportError, OSError):
+    sd = None
 
 app = typer.Typer()
 
+BLOCK_SIZE = 1024  # frames of every callback
+BUFFER_SECONDS = 10.0  # audio the ring buffers hold while the writer is late
+WRITE_INTERVAL = 0.05  # seconds between two drains of the writer thread
+STOP_CHECK_MS = 100  # milliseconds of recording between two checks for a failure of the writer thread
+
 
 def list_audio_sources() -> list:
     try:
@@ -23,7 +38,7 @@ def list_audio_sources() -> list:
                 info.append((i, dev["name"], "Output"))
         p.terminate()
         return info
-    except OSError:
+    except (OSError, AttributeError):
         typer.echo(
             "Errore: Impossibile accedere ai dispositivi audio. "
             + "Assicurati di avere configurato correttamente la scheda audio nell'ambiente dove stai lanciando il codice"
@@ -62,143 +77,326 @@ def record_audio():
     format = typer.prompt("Formato di output (wav o mp3)")
     output = typer.prompt("Nome del file di output")
 
+    if format.lower() not in ("wav", "mp3"):
+        typer.echo(f"Formato non supportato: {format}. Uso WAV come predefinito.")
+        format = "wav"
+
     recorder = AudioRecorder(mic_index, system_index)
     recorder.print_device_info()  # Stampa le informazioni sui dispositivi
     typer.echo(f"Registrazione in corso per {duration} secondi...")
 
     # Avvia il thread del countdown
+    recorder.is_recording = True
     countdown_thread = threading.Thread(target=countdown, args=(duration, recorder))
     countdown_thread.start()
 
-    # Avvia la registrazione
-    recorder.record(duration)
+    # Avvia la registrazione, salvata sul file mentre registra
+    recorder.record(duration, output, format=format.lower())
 
     # Attendi che il thread del countdown termini
     countdown_thread.join()
+    typer.echo(f"File salvato come {output}")
 
-    if format.lower() == "wav":
-        recorder.save_wav(output)
-    elif format.lower() == "mp3":
-        recorder.save_mp3(output)
-    else:
-        typer.echo(f"Formato non supportato: {format}. Uso WAV come predefinito.")
-        recorder.save_wav(output)
 
-    typer.echo(f"File salvato come {output}")
+class RingBuffer:
+    """Preallocated single producer / single consumer ring buffer of audio frames.
+
+    The audio callback writes and the writer thread reads without locks: each side only moves its own
+    index (a python int assignment is atomic) and the data is copied before the index is published. When
+    the buffer is full the new block is dropped and counted in `overruns`, the callback never waits.
+    """
+
+    def __init__(self, capacity: int, channels: int, dtype=np.float32):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, channels), dtype=dtype)
+        self.written = 0  # frames written since the start (moved only by the producer)
+        self.read = 0  # frames read since the start (moved only by the consumer)
+        self.overruns = 0  # frames dropped because the buffer was full
+
+    def available(self) -> int:
+        return self.written - self.read
+
+    def write(self, block: np.ndarray) -> bool:
+        frames = len(block)
+        if frames > self.capacity - self.available():
+            self.overruns += frames
+            return False
+        start = self.written % self.capacity
+        first = min(frames, self.capacity - start)
+        self.data[start : start + first] = block[:first]
+        self.data[: frames - first] = block[first:]
+        self.written += frames
+        return True
+
+    def read_into(self, out: np.ndarray, frames: int) -> int:
+        """Copy up to `frames` frames into `out`, returning the frames copied."""
+        frames = min(frames, self.available(), len(out))
+        start = self.read % self.capacity
+        first = min(frames, self.capacity - start)
+        out[:first] = self.data[start : start + first]
+        out[first:frames] = self.data[: frames - first]
+        self.read += frames
+        return frames
+
+
+class WavWriter:
+    """Stream mono int16 frames to a WAV file (the header is completed on close)."""
+
+    def __init__(self, filename: str, samplerate: int):
+        self.file = wave.open(filename, "wb")
+        self.file.setnchannels(1)  # Mono
+        self.file.setsampwidth(2)
+        self.file.setframerate(samplerate)
+
+    def write(self, frames: np.ndarray):
+        self.file.writeframes(frames.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+class Mp3Writer:
+    """Stream mono int16 frames to the MP3 encoder of ffmpeg through a pipe (the encoder used by pydub)."""
+
+    def __init__(self, filename: str, samplerate: int, bitrate: str = "128k", encoder: str = None):
+        if encoder is None:
+            from pydub.utils import get_encoder_name
+
+            encoder = get_encoder_name()
+        command = [encoder, "-loglevel", "error", "-y", "-f", "s16le", "-ar", str(samplerate), "-ac", "1", "-i", "-"]
+        self.process = subprocess.Popen(
+            command + ["-codec:a", "libmp3lame", "-b:a", bitrate, filename], stdin=subprocess.PIPE
+        )
+
+    def write(self, frames: np.ndarray):
+        self.process.stdin.write(frames.tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"MP3 encoder failed with exit code {self.process.returncode}")
+
+
+WRITERS = {"wav": WavWriter, "mp3": Mp3Writer}
 
 
 class AudioRecorder:
-    def __init__(self, mic_index, system_index):
+    """Record the microphone together with the system audio, mixed to mono and saved while recording.
+
+    The callbacks of the two streams only copy their blocks into a preallocated ring buffer each; a writer
+    thread drains the buffers every `WRITE_INTERVAL` seconds, mixes the frames available on both streams
+    into preallocated scratch arrays and streams them as int16 to the WAV file or to the MP3 encoder.
+    The memory doesn't grow with the duration, so long meetings can be recorded. Without `system_index`
+    only the microphone is recorded.
+
+    Args:
+        mic_index (int): the input device
+        system_index (int, optional): the output device. Defaults to None (microphone only).
+        device (optional): the sounddevice module, or a stand-in with the same interface
+            (for example `SyntheticSoundDevice`). Defaults to sounddevice.
+        buffer_seconds (float, optional): capacity of the ring buffers. Defaults to BUFFER_SECONDS.
+        on_audio (Callable, optional): called by the writer thread with the mixed int16 frames and the
+            samplerate (for example `StreamingTranscriber.feed`), the array is reused: copy it to keep it.
+    """
+
+    def __init__(
+        self,
+        mic_index,
+        system_index=None,
+        device=None,
+        buffer_seconds: float = BUFFER_SECONDS,
+        on_audio: Callable = None,
+    ):
         self.mic_index = mic_index
         self.system_index = system_index
-        self.recording = None
+        self.device = device or sd
+        self.buffer_seconds = buffer_seconds
         self.is_recording = False
         self.samplerate = 44100
+        self.buffers = []
+        self.frames_written = 0
+        self.status_errors = 0  # blocks with an overflow/underflow status from PortAudio
+        self.on_audio = on_audio
+        self.error = None  # exception of the writer thread, raised by `record`
+
+    def _callback(self, buffer: RingBuffer):
+        def callback(data, frames, time, status):
+            if status:
+                self.status_errors += 1
+            buffer.write(data)  # no allocation and no lock: the block is copied in the ring
 
-    def record(self, duration):
-        mic_info = sd.query_devices(self.mic_index, "input")
-        system_info = sd.query_devices(self.system_index, "output")
+        return callback
 
+    def _write_loop(self, writer, stop: threading.Event):
+        try:
+            self._write_frames(writer, stop)
+        except Exception as error:
+            # for example an `on_audio` hook that fails or the MP3 encoder that died: `record` stops the
+            # streams (instead of filling the ring buffers until they overrun) and raises it
+            self.error = error
+
+    def _write_frames(self, writer, stop: threading.Event):
+        chunk = int(self.samplerate * max(WRITE_INTERVAL * 4, 0.5))
+        blocks = [np.empty((chunk, buffer.data.shape[1]), dtype=np.float32) for buffer in self.buffers]
+        mixed = np.empty(chunk, dtype=np.float32)
+        channel = np.empty(chunk, dtype=np.float32)
+        samples = np.empty(chunk, dtype=np.int16)
+        while True:
+            stopping = stop.wait(WRITE_INTERVAL)
+            # the frames of the two streams are mixed only when both are available (aligned by position)
+            while (frames := min(chunk, *(buffer.available() for buffer in self.buffers))) > 0:
+                mixed[:frames] = 0
+                for buffer, block in zip(self.buffers, blocks):
+                    buffer.read_into(block, frames)
+                    np.mean(block[:frames], axis=1, out=channel[:frames])
+                    mixed[:frames] += channel[:frames]
+                mixed[:frames] *= 32767 / len(self.buffers)
+                np.clip(mixed[:frames], -32768, 32767, out=mixed[:frames])
+                samples[:frames] = mixed[:frames]
+                writer.write(samples[:frames])
+                if self.on_audio is not None:
+                    self.on_audio(samples[:frames], self.samplerate)
+                self.frames_written += frames
+            if stopping:
+                return
+
+    def record(self, duration, filename: str, format: str = "wav"):
+        """Record for `duration` seconds streaming the mixed audio to `filename` (wav or mp3)."""
+        mic_info = self.device.query_devices(self.mic_index, "input")
         # Usa il sample rate nativo del dispositivo di input
         self.samplerate = int(mic_info["default_samplerate"])
-
-        channels_in = mic_info["max_input_channels"]
-        channels_out = system_info["max_output_channels"]
-
-        self.recording_input = []
-        self.recording_output = []
+        capacity = int(self.samplerate * self.buffer_seconds)
+
+        streams = [(self.device.InputStream, self.mic_index, mic_info["max_input_channels"])]
+        if self.system_index is not None:
+            system_info = self.device.query_devices(self.system_index, "output")
+            streams.append((self.device.OutputStream, self.system_index, system_info["max_output_channels"]))
+        self.buffers = [RingBuffer(capacity, channels) for _, _, channels in streams]
+        self.frames_written = 0
+        self.error = None
+
+        writer = WRITERS[format](filename, self.samplerate)
+        stop = threading.Event()
+        writer_thread = threading.Thread(target=self._write_loop, args=(writer, stop), daemon=True)
         self.is_recording = True
-
-        def input_callback(indata, frames, time, status):
-            if status:
-                print(f"Input status: {status}")
-            self.recording_input.append(indata.copy())
-
-        def output_callback(outdata, frames, time, status):
-            if status:
-                print(f"Output status: {status}")
-            self.recording_output.append(outdata.copy())
-
+        writer_thread.start()
         try:
-            with sd.InputStream(
-                device=self.mic_index,
-                channels=channels_in,
-                callback=input_callback,
-                samplerate=self.samplerate,
-                blocksize=1024,
-                latency="high",
-            ):
-                with sd.OutputStream(
-                    device=self.system_index,
-                    channels=channels_out,
-                    callback=output_callback,
-                    samplerate=self.samplerate,
-                    blocksize=1024,
-                    latency="high",
-                ):
-                    sd.sleep(int(duration * 1000))
-        except sd.PortAudioError as e:
+            with ExitStack() as stack:
+                for (stream, index, channels), buffer in zip(streams, self.buffers):
+                    stack.enter_context(
+                        stream(
+                            device=index,
+                            channels=channels,
+                            callback=self._callback(buffer),
+                            samplerate=self.samplerate,
+                            blocksize=BLOCK_SIZE,
+                            latency="high",
+                        )
+                    )
+                remaining = int(duration * 1000)
+                while remaining > 0 and self.error is None:
+                    step = min(remaining, STOP_CHECK_MS)
+                    self.device.sleep(step)
+                    remaining -= step
+        except self.device.PortAudioError as e:
             typer.echo(f"Errore durante l'apertura dello stream audio: {e}")
+        finally:
+            stop.set()
+            writer_thread.join()
             self.is_recording = False
-            return
-        self.is_recording = False
-
-    def save_wav(self, filename):
-        if not self.recording_input or not self.recording_output:
-            typer.echo("Nessuna registrazione disponibile.")
-            return
-
-        # Combina input e output
-        combined_input = np.concatenate(self.recording_input)
-        combined_output = np.concatenate(self.recording_output)
-
-        # Assicurati che abbiano la stessa lunghezza
-        min_length = min(combined_input.shape[0], combined_output.shape[0])
-        combined = np.mean([combined_input[:min_length], combined_output[:min_length]], axis=0)
+            self._close(writer)
 
-        combined = (combined * 32767).astype(np.int16)
+        overruns = sum(buffer.overruns for buffer in self.buffers)
+        if overruns or self.status_errors:
+            typer.echo(f"Attenzione: {overruns} frame persi, {self.status_errors} blocchi con errori di stato")
+        if self.error is not None:
+            raise self.error
+        return self.frames_written
 
-        with wave.open(filename, "wb") as wf:
-            wf.setnchannels(1)  # Mono
-            wf.setsampwidth(2)
-            wf.setframerate(self.samplerate)
-            wf.writeframes(combined.tobytes())
-
-    def save_mp3(self, filename):
-        if not self.recording_input or not self.recording_output:
-            typer.echo("Nessuna registrazione disponibile.")
-            return
-
-        # Combina input e output
-        combined_input = np.concatenate(self.recording_input)
-        combined_output = np.concatenate(self.recording_output)
-
-        # Assicurati che abbiano la stessa lunghezza
-        min_length = min(combined_input.shape[0], combined_output.shape[0])
-        combined = np.mean([combined_input[:min_length], combined_output[:min_length]], axis=0)
-
-        combined = (combined * 32767).astype(np.int16)
-
-        buffer = io.BytesIO()
-        with wave.open(buffer, "wb") as wf:
-            wf.setnchannels(1)  # Mono
-            wf.setsampwidth(2)
-            wf.setframerate(self.samplerate)
-            wf.writeframes(combined.tobytes())
-
-        buffer.seek(0)
-        audio_segment = AudioSegment.from_wav(buffer)
-        audio_segment.export(filename, format="mp3")
+    def _close(self, writer):
+        try:
+            writer.close()
+        except Exception as error:
+            # after a failure of the writer thread (the encoder that died) its error is the one raised
+            if self.error is None:
+                self.error = error
 
     def print_device_info(self):
-        mic_info = sd.query_devices(self.mic_index, "input")
-        system_info = sd.query_devices(self.system_index, "output")
+        mic_info = self.device.query_devices(self.mic_index, "input")
         typer.echo(
             f"Mic device: {mic_info['name']}, channels: {mic_info['max_input_channels']}, default samplerate: {mic_info['default_samplerate']}"
         )
-        typer.echo(
-            f"System device: {system_info['name']}, channels: {system_info['max_output_channels']}, default samplerate: {system_info['default_samplerate']}"
-        )
+        if self.system_index is not None:
+            system_info = self.device.query_devices(self.system_index, "output")
+            typer.echo(
+                f"System device: {system_info['name']}, channels: {system_info['max_output_channels']}, default samplerate: {system_info['default_samplerate']}"
+            )
+
+
+class SyntheticSoundDevice:
+    """Stand-in of the sounddevice module: the streams call their callback with sine waves from a thread,
+    at the pace of the samplerate divided by `speed` (so an hour of audio can be recorded in seconds).
+    """
+
+    PortAudioError = RuntimeError
+
+    def __init__(self, samplerate: int = 44100, channels: int = 2, frequency: float = 440.0, speed: float = 1.0):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.frequency = frequency
+        self.speed = speed
+
+    def query_devices(self, device=None, kind=None) -> dict:
+        return {
+            "name": f"synthetic {kind} {device}",
+            "max_input_channels": self.channels,
+            "max_output_channels": self.channels,
+            "default_samplerate": float(self.samplerate),
+        }
+
+    def sleep(self, msec: int):
+        time.sleep(msec / 1000 / self.speed)
+
+    def InputStream(self, **kwargs):
+        return SyntheticStream(self, **kwargs)
+
+    def OutputStream(self, **kwargs):
+        return SyntheticStream(self, **kwargs)
+
+
+class SyntheticStream:
+    def __init__(
+        self, source: SyntheticSoundDevice, channels: int, callback, samplerate: int, blocksize: int, **kwargs
+    ):
+        self.source = source
+        self.channels = channels
+        self.callback = callback
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        # the block is reused by every callback, as PortAudio does
+        block = np.empty((self.blocksize, self.channels), dtype=np.float32)
+        position = 0
+        interval = self.blocksize / self.samplerate / self.source.speed
+        deadline = time.perf_counter()
+        while not self._stop.is_set():
+            phase = 2 * np.pi * self.source.frequency * (position + np.arange(self.blocksize)) / self.samplerate
+            block[:] = 0.5 * np.sin(phase)[:, None]
+            self.callback(block, self.blocksize, None, None)
+            position += self.blocksize
+            deadline += interval
+            self._stop.wait(max(deadline - time.perf_counter(), 0))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
 
 
 def main():
@@ -222,9 +420,7 @@ def main():
 
 
 if __name__ == "__main__":
-    # # Uso
-    # sources = [1, 2]  # Indici delle sorgenti audio
-    # recorder = AudioRecorder(sources)
-    # recorder.record(duration=10)  # Registra per 10 secondi
-    # recorder.save_wav("output.wav")
+    # # Uso senza scheda audio
+    # recorder = AudioRecorder(0, 1, device=SyntheticSoundDevice(speed=60))
+    # recorder.record(duration=600, filename="output.wav")  # 10 minuti registrati in 10 secondi
     typer.run(main)
@@ -1,13 +1,23 @@
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
+from config import llm_model
 
+from experiments.llms.cache import get_response_cache
+from experiments.llms.conversation import Conversation, OpenAIChat
 
-llm = ChatOpenAI(temperature: float = 0.0, model: str="gpt-4")
-memory = ConversationBufferMemory()
-conversation = ConversationChain(
-    llm=llm, 
-    memory = memory,
-    verbose=True
-)
+# The history in the prompt is kept within max_tokens: the recent turns verbatim and a running summary of
+# the older ones (updated in background), instead of the whole conversation resent to GPT-4 at every turn
+llm = OpenAIChat(temperature=0.0, model_name=llm_model)
+# the answers are cached on disk: the same question in the same state of the conversation doesn't call GPT-4
+conversation = Conversation(llm=llm, max_tokens=1500, response_cache=get_response_cache(), verbose=True)
 
+conversation.send("Hi, my name is Andrea")
+conversation.send("What is 1+1?")
+conversation.send("What is my name?")
+
+# prompt tokens, history size and latency of every turn
+for report in conversation.reports:
+    print(report)
+print(get_response_cache().stats())
+
+# the langchain ConversationChain and its memory
+print(conversation.memory.summary)
+chain = conversation.chain
@@ -0,0 +1,112 @@
+import json
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from experiments.datasets.arxiv import (
+    ARXIV_COLUMNS,
+    _import_shard,
+    _shard_ranges,
+    load_parquet_dataset,
+    manual_import,
+    parallel_import,
+    stream_import,
+)
+
+SNAPSHOT = "arxiv-metadata-oai-snapshot.json"
+RECORDS = 120
+
+
+def record(index: int) -> dict:
+    paper = {column: f"{column} of paper {index}" for column in ARXIV_COLUMNS}
+    # lines of very different lengths: the shard boundaries fall anywhere inside them
+    paper.update(id=f"0704.{index:04d}", abstract="word " * (index % 17) * 5, doi=None)
+    return paper
+
+
+def write_snapshot(folder, lines: list, trailing_newline: bool = True):
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / SNAPSHOT).write_text("\n".join(lines) + ("\n" if trailing_newline else ""))
+    return str(folder)
+
+
+@pytest.fixture
+def raw(tmp_path):
+    return write_snapshot(tmp_path / "raw", [json.dumps(record(index)) for index in range(RECORDS)])
+
+
+def ids(path: str) -> list:
+    return load_parquet_dataset(path, columns=["id"])["id"].tolist()
+
+
+def test_stream_import(raw, tmp_path):
+    output_file = str(tmp_path / "dataset" / "dataset.parquet")
+    assert stream_import(output_file, raw, row_group_size=50) == RECORDS
+    assert pq.ParquetFile(output_file).metadata.num_row_groups == 3
+    frame = load_parquet_dataset(output_file)
+    assert frame.to_dict("records") == [record(index) for index in range(RECORDS)]
+
+
+@pytest.mark.parametrize("workers", [1, 3, 7])
+def test_parallel_import(raw, tmp_path, workers):
+    output_folder = str(tmp_path / "parts")
+    assert parallel_import(output_folder, raw, workers=workers, row_group_size=16) == RECORDS
+    assert len(list((tmp_path / "parts").iterdir())) == workers
+    # the parts are read back in order: no line dropped or parsed twice at the shard boundaries
+    assert ids(output_folder) == [f"0704.{index:04d}" for index in range(RECORDS)]
+
+
+@pytest.mark.parametrize("size", [0, 1, 7, 100, 101])
+@pytest.mark.parametrize("shards", [1, 3, 8, 200])
+def test_shard_ranges_cover_every_byte_once(tmp_path, size, shards):
+    file_name = tmp_path / "file"
+    file_name.write_bytes(b"x" * size)
+    ranges = _shard_ranges(str(file_name), shards)
+    assert 1 <= len(ranges) <= max(shards, 1)
+    assert ranges[0][0] == 0 and ranges[-1][1] == size
+    assert all(previous[1] == current[0] for previous, current in zip(ranges, ranges[1:]))
+    assert all(start < end for start, end in ranges) or size == 0
+    assert sum(end - start for start, end in ranges) == size
+
+
+def test_shards_split_at_every_byte(tmp_path):
+    lines = [json.dumps({"id": str(index), "title": "x" * index}) for index in range(6)]
+    raw = write_snapshot(tmp_path / "raw", lines[:3] + [""] + lines[3:], trailing_newline=False)
+    file_name = f"{raw}/{SNAPSHOT}"
+    size = len(open(file_name, "rb").read())
+    for split in range(size + 1):
+        first, second = str(tmp_path / "first.parquet"), str(tmp_path / "second.parquet")
+        written = _import_shard(file_name, 0, split, first, 100) + _import_shard(file_name, split, size, second, 100)
+        assert written == len(lines)
+        assert ids(first) + ids(second) == [str(index) for index in range(6)], split
+
+
+def test_empty_snapshot(tmp_path):
+    raw = write_snapshot(tmp_path / "raw", [], trailing_newline=False)
+    assert parallel_import(str(tmp_path / "parts"), raw, workers=4) == 0
+    frame = load_parquet_dataset(str(tmp_path / "parts"), columns=["id", "title"])
+    assert list(frame.columns) == ["id", "title"] and frame.empty
+
+
+def test_manual_import_return_values(raw, tmp_path):
+    expected = pd.DataFrame([record(index) for index in range(RECORDS)], columns=ARXIV_COLUMNS)
+    frame = manual_import(str(tmp_path / "in_memory"), raw)
+    pd.testing.assert_frame_equal(frame, expected)
+
+    output_folder = str(tmp_path / "parallel")
+    # read back from the parquet parts: the columns may have the pandas string dtype
+    pd.testing.assert_frame_equal(manual_import(output_folder, raw, workers=3), expected, check_dtype=False)
+    assert manual_import(output_folder, raw, streaming=True, workers=3) == RECORDS
+    assert manual_import(str(tmp_path / "streaming"), raw, streaming=True) == RECORDS
+    assert ids(str(tmp_path / "streaming" / "dataset.parquet")) == expected["id"].tolist()
+
+
+def test_parallel_import_replaces_the_previous_parts(raw, tmp_path):
+    output_folder = str(tmp_path / "parts")
+    parallel_import(output_folder, raw, workers=5)
+    parallel_import(output_folder, raw, workers=2)
+    assert sorted(os.listdir(output_folder)) == ["part-00000.parquet", "part-00001.parquet"]
+    assert len(ids(output_folder)) == RECORDS
+    assert sorted(os.listdir(tmp_path)) == ["parts", "raw"]  # no partial folder left
@@ -0,0 +1,66 @@
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+
+from experiments.datasets.arxiv import ARXIV_COLUMNS, load_parquet_dataset
+
+CATEGORIES = ["cs.LG", "cs.CL stat.ML", "math.CO", "cs.LGX", "stat.ML cs.LG"]
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    path = tmp_path_factory.mktemp("arxiv") / "dataset.parquet"
+    records = {column: [f"{column} {index}" for index in range(50)] for column in ARXIV_COLUMNS}
+    records["id"] = [f"0704.{index:04d}" for index in range(50)]
+    records["categories"] = [CATEGORIES[index % len(CATEGORIES)] for index in range(50)]
+    records["doi"] = [None if index % 3 else f"10.1/{index}" for index in range(50)]
+    records['quoted "name"'] = [str(index) for index in range(50)]
+    pq.write_table(pa.table(records), path, row_group_size=10)
+    return str(path)
+
+
+def load(dataset, lazy, **kwargs) -> list:
+    """Rows read by an engine, as a pandas dataframe."""
+    result = load_parquet_dataset(dataset, lazy=lazy, **kwargs)
+    if lazy == "arrow":
+        assert isinstance(result, ds.Scanner)
+        limit = kwargs.get("limit")
+        result = (result.head(limit) if limit else result.to_table()).to_pandas()
+    elif lazy == "polars":
+        result = result.collect().to_pandas()
+    elif lazy == "duckdb":
+        result = result.df()
+    return result
+
+
+@pytest.mark.parametrize("lazy", [None, "arrow", "polars", "duckdb"])
+@pytest.mark.parametrize(
+    "filters, category, expected",
+    [
+        ([("id", ">=", "0704.0045")], None, [f"0704.{index:04d}" for index in range(45, 50)]),
+        ([("id", "in", ["0704.0001", "0704.0002", "missing"])], None, ["0704.0001", "0704.0002"]),
+        ([("id", "in", [])], None, []),
+        ([("id", "not in", []), ("id", "<", "0704.0002")], None, ["0704.0000", "0704.0001"]),
+        ([("id", "<", "0704.0010")], "cs.LG", ["0704.0000", "0704.0004", "0704.0005", "0704.0009"]),
+        ([("journal-ref", "==", "journal-ref 7")], None, ["0704.0007"]),
+        ([('quoted "name"', "==", "12")], None, ["0704.0012"]),
+    ],
+)
+def test_filters_pushdown(dataset, lazy, filters, category, expected):
+    frame = load(dataset, lazy, columns=["id", "categories"], filters=filters, category=category)
+    assert list(frame.columns) == ["id", "categories"]
+    assert sorted(frame["id"]) == expected
+
+
+@pytest.mark.parametrize("lazy", [None, "arrow", "polars", "duckdb"])
+def test_columns_and_limit(dataset, lazy):
+    frame = load(dataset, lazy, columns=['quoted "name"', "doi"], filters=[("doi", "!=", "")], limit=4)
+    assert list(frame.columns) == ['quoted "name"', "doi"]
+    assert len(frame) == 4
+    assert frame["doi"].notna().all()
+
+
+def test_unknown_engine(dataset):
+    with pytest.raises(ValueError, match="Unknown lazy engine"):
+        load_parquet_dataset(dataset, lazy="spark")
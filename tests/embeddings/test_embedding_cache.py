@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+
+from experiments.embeddings.cache import EmbeddingCache
+
+MODEL = "model"
+
+
+def vector(index: int, dim: int = 8) -> np.ndarray:
+    return np.full(dim, index, dtype=np.float32)
+
+
+def make_cache(path, **kwargs) -> EmbeddingCache:
+    options = {"max_entries": 1000, "versioning": False, "keep_versions": 3, "flush_entries": 1000, "max_segments": 16}
+    return EmbeddingCache(str(path), **(options | kwargs))
+
+
+def test_hits_and_misses(tmp_path):
+    cache = make_cache(tmp_path)
+    calls = []
+
+    def embed(texts):
+        calls.append(list(texts))
+        return np.stack([vector(len(text)) for text in texts])
+
+    result = cache.embed(MODEL, ["a", "bb", "a"], embed)
+    np.testing.assert_array_equal(result, np.stack([vector(1), vector(2), vector(1)]))
+    assert calls == [["a", "bb"]]  # the duplicated text is embedded once
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    cache.embed(MODEL, ["bb", "ccc"], embed)
+    assert calls[-1] == ["ccc"]
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert cache.hit_rate == pytest.approx(0.2)
+    assert cache.get("other model", "a") is None  # the model is part of the key
+
+
+def test_max_entries_eviction(tmp_path):
+    cache = make_cache(tmp_path, max_entries=3)
+    for index in range(3):
+        cache.put(MODEL, str(index), vector(index))
+    assert cache.get(MODEL, "0") is not None  # "1" is now the least recently used
+    cache.put(MODEL, "3", vector(3))
+
+    assert len(cache) == 3
+    assert cache.get(MODEL, "1") is None
+    for index in (0, 2, 3):
+        np.testing.assert_array_equal(cache.get(MODEL, str(index)), vector(index))
+    # the rows of the evicted entries are reused by the next ones: the matrix doesn't grow
+    for index in range(4, 10):
+        cache.put(MODEL, str(index), vector(index))
+    assert cache._slabs[8].size == 4
+    assert len(cache) == 3
+
+
+def test_save_and_load_segments_and_snapshot(tmp_path):
+    cache = make_cache(tmp_path, flush_entries=2, max_segments=3)
+    for index in range(7):
+        cache.put(MODEL, str(index), vector(index, dim=4 if index % 2 else 8))
+    cache.put(MODEL, "0", vector(100))  # updated: the last value wins
+    cache.save()
+
+    folder = os.path.join(str(tmp_path), "dim-8")
+    assert len(cache.snapshots(folder)) == 1  # the segments beyond max_segments were compacted
+    assert len(cache.segments(folder)) <= 3
+    assert len(cache.segments(os.path.join(str(tmp_path), "dim-4"))) > 0
+
+    loaded = make_cache(tmp_path)
+    assert len(loaded) == 7
+    np.testing.assert_array_equal(loaded.get(MODEL, "0"), vector(100))
+    for index in range(1, 7):
+        np.testing.assert_array_equal(loaded.get(MODEL, str(index)), vector(index, dim=4 if index % 2 else 8))
+
+    # a compaction of everything gives the same entries
+    for dim_folder in loaded._folders():
+        loaded.compact(dim_folder)
+        assert loaded.segments(dim_folder) == []
+    compacted = make_cache(tmp_path)
+    assert len(compacted) == 7
+    np.testing.assert_array_equal(compacted.get(MODEL, "0"), vector(100))
+
+
+@pytest.mark.parametrize("versioning, kept", [(True, 2), (False, 1)])
+def test_snapshots_kept(tmp_path, versioning, kept):
+    cache = make_cache(tmp_path, versioning=versioning, keep_versions=2, flush_entries=1, max_segments=0)
+    for index in range(5):
+        cache.put(MODEL, str(index), vector(index))  # every put is saved and compacted
+
+    folder = os.path.join(str(tmp_path), "dim-8")
+    assert len(cache.snapshots(folder)) == kept
+    assert cache.segments(folder) == []
+    loaded = make_cache(tmp_path)
+    assert len(loaded) == 5
+    np.testing.assert_array_equal(loaded.get(MODEL, "4"), vector(4))
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from experiments.embeddings.cache import EmbeddingCache
+from experiments.embeddings.generate import EmbeddingService
+
+TEXTS = ["a much longer text than the others", "short", "", "medium text", "tiny", "the longest text of all the texts"]
+
+
+def vectorize(texts):
+    """Stub model: the embedding of a text is its length and its first character."""
+    return np.asarray([[len(text), ord(text[0]) if text else 0] for text in texts], dtype=np.float32)
+
+
+@pytest.fixture
+def service():
+    service = EmbeddingService(device="cpu", batch_size=2, sort_window=2, use_cache=False)
+    service.batches = []
+
+    def embed_batch(batch):
+        service.batches.append(batch)
+        return vectorize(batch)
+
+    service._embed_batch = embed_batch
+    return service
+
+
+def test_batches_sorted_by_length_in_input_order(service):
+    embeddings = service.embed(TEXTS)
+    assert embeddings.dtype == np.float32 and embeddings.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(embeddings, vectorize(TEXTS))
+    # the texts of similar length are batched together: little padding inside a batch
+    assert service.batches == [["", "tiny"], ["short", "medium text"], [TEXTS[5], TEXTS[0]]]
+    assert service.embed([]).shape == (0, 0)
+
+
+def test_stream_in_windows(service):
+    texts = TEXTS * 3
+    windows = list(service.embed_stream(iter(texts)))
+    assert [len(window) for window in windows] == [4, 4, 4, 4, 2]
+    np.testing.assert_array_equal(np.vstack(windows), vectorize(texts))
+
+
+def test_cached_texts_are_not_embedded_again(service, tmp_path):
+    service.cache = EmbeddingCache(str(tmp_path), versioning=False)
+    np.testing.assert_array_equal(service.embed(TEXTS[:4]), vectorize(TEXTS[:4]))
+    service.batches.clear()
+    np.testing.assert_array_equal(service.embed(TEXTS), vectorize(TEXTS))
+    assert sorted(text for batch in service.batches for text in batch) == sorted(TEXTS[4:])
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from experiments.embeddings.store import EmbeddingStore
+
+DIMENSION = 24
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return np.random.default_rng(0).standard_normal((500, DIMENSION)).astype(np.float32)
+
+
+def normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def make_store(path, vectors, chunk_size=64) -> EmbeddingStore:
+    store = EmbeddingStore(str(path), chunk_size=chunk_size)
+    store.append([f"doc-{index}" for index in range(len(vectors))], vectors)
+    store.save()
+    return store
+
+
+def test_exact_search_is_the_brute_force(tmp_path, vectors):
+    # chunks smaller than the store: the top-k of every chunk are merged
+    store = make_store(tmp_path, vectors, chunk_size=64)
+    queries = np.random.default_rng(1).standard_normal((20, DIMENSION)).astype(np.float32)
+    expected = normalize(queries) @ normalize(vectors).T
+
+    results = store.search_batch(queries, limit=10)
+    for hits, scores in zip(results, expected):
+        assert [hit.id for hit in hits] == [f"doc-{row}" for row in np.argsort(-scores)[:10]]
+        np.testing.assert_allclose([hit.score for hit in hits], np.sort(scores)[::-1][:10], rtol=1e-5)
+    assert store.search(vectors[3], limit=1)[0].id == "doc-3"
+    assert len(store.search(queries[0], limit=1000)) == 500
+
+    with pytest.raises(ValueError, match="filters"):
+        store.search(queries[0], filters={"year": 2020})
+
+
+def test_upsert_and_delete_hide_the_stale_rows(tmp_path, vectors):
+    store = make_store(tmp_path, vectors[:100])
+    store.upsert(["doc-5"], vectors[50:51])
+    assert store.delete(["doc-50", "missing"]) == 1
+    store.save()
+
+    for opened in (store, EmbeddingStore(str(tmp_path))):
+        assert len(opened) == 99
+        hits = opened.search(vectors[50], limit=3)
+        assert hits[0].id == "doc-5" and hits[0].score == pytest.approx(1.0)
+        assert "doc-50" not in {hit.id for hit in hits}
+        assert "doc-5" not in {hit.id for hit in opened.search(vectors[5], limit=5)}
+        ids = [identifier for chunk_ids, _ in opened.iter_chunks(chunk_size=30) for identifier in chunk_ids]
+        assert len(ids) == len(set(ids)) == 99
+
+
+def test_uncommitted_rows_are_dropped(tmp_path, vectors):
+    store = make_store(tmp_path, vectors[:100])
+    store.append(["crashed"], vectors[100:101])  # never committed by save
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert len(reopened) == 100
+    reopened.append(["doc-100"], vectors[100:101])
+    reopened.save()
+    assert (tmp_path / "vectors.bin").stat().st_size == 101 * DIMENSION * 4
+    final = EmbeddingStore(str(tmp_path))
+    assert final.ids[-1] == "doc-100" and len(final) == 101
+    np.testing.assert_allclose(final.get(["doc-100"])[0], normalize(vectors[100]), rtol=1e-6)
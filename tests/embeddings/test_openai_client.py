@@ -0,0 +1,165 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from experiments.embeddings.openai_client import OpenAIEmbeddingClient
+
+
+class FakeEmbeddingServer(ThreadingHTTPServer):
+    """Local `/embeddings` endpoint: the embedding of a text is [its length, its first character], the
+    scripted failures (http status codes) are answered to the first requests.
+    """
+
+    def __init__(self, failures=()):
+        super().__init__(("127.0.0.1", 0), EmbeddingHandler)
+        self.failures = list(failures)
+        self.requests = []  # inputs of every successful request
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        assert self.path == "/embeddings"
+        texts = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["input"]
+        server = self.server
+        with server.lock:
+            failure = server.failures.pop(0) if server.failures else None
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(0.05)  # the requests overlap
+            if failure is not None:
+                error = {"error": {"message": f"status {failure}", "type": "server_error"}}
+                self.reply(failure, error, {"Retry-After": "0.01"} if failure == 429 else None)
+                return
+            with server.lock:
+                server.requests.append(texts)
+            data = [{"index": index, "embedding": [len(text), ord(text[0])]} for index, text in enumerate(texts)]
+            usage = {"prompt_tokens": len(texts), "total_tokens": len(texts)}
+            # the items in reverse order: the client sorts them by index
+            self.reply(200, {"object": "list", "data": data[::-1], "model": "test", "usage": usage})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@pytest.fixture
+def make_server():
+    servers = []
+
+    def make(failures=()):
+        server = FakeEmbeddingServer(failures)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_client(server, **kwargs) -> OpenAIEmbeddingClient:
+    return OpenAIEmbeddingClient(api_base=server.api_base, api_key="test", backoff=0.01, **kwargs)
+
+
+def test_requests_are_bounded_by_the_tokens(make_server):
+    server = make_server()
+    client = make_client(server, max_batch_size=100, max_batch_tokens=50)
+    texts = [f"{chr(97 + index % 26)} " + "word " * (index % 7) for index in range(40)]
+
+    embeddings = client.embed(texts)
+
+    assert embeddings.dtype == np.float32
+    np.testing.assert_array_equal(embeddings, [[len(text), ord(text[0])] for text in texts])
+    assert len(server.requests) == len(client.pack(texts)) > 1
+    for request in server.requests:
+        tokens = [client.count_tokens(text) for text in request]
+        assert sum(tokens) <= 50
+    assert sorted(text for request in server.requests for text in request) == sorted(texts)
+
+
+def test_requests_are_bounded_by_the_inputs(make_server):
+    client = make_client(make_server(), max_batch_size=3)
+    assert client.pack(["a"] * 10) == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    # a text longer than the token limit is sent alone
+    client.max_batch_tokens = 5
+    assert client.pack(["a", "word " * 20, "b"]) == [[0], [1], [2]]
+
+
+def test_concurrency_is_bounded(make_server):
+    server = make_server()
+    client = make_client(server, max_batch_size=1, max_concurrency=3)
+    client.embed([f"text {index}" for index in range(12)])
+    assert len(server.requests) == 12
+    assert server.max_in_flight == 3
+
+
+@pytest.mark.parametrize("failures", [[429], [503], [500, 502]])
+def test_retry_on_rate_limits_and_server_errors(make_server, failures):
+    server = make_server(failures)
+    client = make_client(server, max_batch_size=2, max_concurrency=1)
+
+    embeddings = client.embed(["one", "two", "three"])
+
+    np.testing.assert_array_equal(embeddings, [[3, ord("o")], [3, ord("t")], [5, ord("t")]])
+    assert client.stats.retries == len(failures)
+    assert client.stats.requests == 2
+
+
+def test_no_retry_on_client_errors(make_server):
+    import openai
+
+    server = make_server([400])
+    client = make_client(server)
+    with pytest.raises(openai.error.InvalidRequestError):
+        client.embed(["one"])
+    assert client.stats.retries == 0
+
+
+def test_retries_are_bounded(make_server):
+    import openai
+
+    server = make_server([503] * 5)
+    client = make_client(server, max_retries=2)
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        client.embed(["one"])
+    assert client.stats.retries == 2
+    assert server.requests == []
+
+
+def test_stats(make_server):
+    client = make_client(make_server([429]), max_batch_size=4)
+    client.embed([f"text {index}" for index in range(10)])
+    stats = client.stats
+    assert stats.requests == 3
+    assert stats.inputs == 10
+    assert stats.tokens == 10  # the usage reported by the server
+    assert stats.retries == 1
+    assert len(stats.latencies) == 3
+    assert all(latency >= 0.05 for latency in stats.latencies)
+    assert stats.elapsed > 0 and stats.inputs_per_second > 0
+    assert "10 inputs in 3 requests (1 retries)" in str(stats)
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from experiments.embeddings.quantization import Quantizer, get_quantizer
+from experiments.embeddings.store import EmbeddingStore, benchmark
+
+DIMENSION = 32
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(30, DIMENSION))
+    vectors = (centers[rng.integers(0, 30, 3000)] + rng.normal(scale=0.5, size=(3000, DIMENSION))).astype(np.float32)
+    queries = (vectors[rng.integers(0, 3000, 50)] + rng.normal(scale=0.1, size=(50, DIMENSION))).astype(np.float32)
+    return vectors, queries
+
+
+@pytest.fixture
+def store(tmp_path, data):
+    store = EmbeddingStore(str(tmp_path), chunk_size=1000)
+    store.append([str(index) for index in range(len(data[0]))], data[0])
+    store.save()
+    return store
+
+
+@pytest.mark.parametrize(
+    "method, ratio, min_recall, oversampling",
+    [("int8", 1 / 4, 0.9, "oversampling 4"), ("pq", 1 / 16, 0.45, "oversampling 8")],
+)
+def test_recall_at_a_fixed_seed(store, data, method, ratio, min_recall, oversampling):
+    store.quantize(method, seed=0)
+    report = benchmark(store, data[1], k=10)
+    recalls = {row["mode"]: row["recall"] for row in report}
+    assert report[0]["memory_ratio"] == pytest.approx(ratio)
+    assert recalls["no rescore"] >= min_recall
+    # rescoring more candidates with the float vectors recovers the exact neighbours
+    rescored = [row["recall"] for row in report[1:]]
+    assert rescored == sorted(rescored)
+    assert recalls[oversampling] >= 0.99
+
+
+@pytest.mark.parametrize("method", ["int8", "pq"])
+def test_quantized_store_is_reopened_and_appended(store, data, tmp_path, method):
+    quantizer = store.quantize(method, seed=0)
+    store.append(["new"], data[1][:1])
+    store.save()
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert reopened.quantizer.method == method
+    np.testing.assert_array_equal(reopened.codes, store.codes)
+    np.testing.assert_array_equal(reopened.codes[-1], quantizer.encode(reopened.get(["new"]))[0])
+    assert reopened.search(data[1][0], limit=1)[0].id == "new"
+
+
+@pytest.mark.parametrize("method", ["int8", "pq"])
+def test_quantizer_round_trip(data, tmp_path, method):
+    vectors, queries = data
+    quantizer = get_quantizer(method).fit(vectors)
+    quantizer.save(str(tmp_path / "quantizer.npz"))
+    loaded = Quantizer.load(str(tmp_path / "quantizer.npz"))
+
+    codes = quantizer.encode(vectors[:100])
+    assert codes.dtype == np.uint8 and codes.shape == (100, quantizer.code_size)
+    np.testing.assert_array_equal(loaded.encode(vectors[:100]), codes)
+    # the scores of the codes are the inner products with the decoded vectors
+    np.testing.assert_allclose(loaded.scores(queries, codes), queries @ quantizer.decode(codes).T, rtol=1e-4, atol=1e-3)
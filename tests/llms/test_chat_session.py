@@ -0,0 +1,78 @@
+import torch
+
+from experiments.llms.cache import ResponseCache
+from experiments.llms.generate import ChatSession, chat_tokens, crop_cache
+
+
+def greedy_answer(tokenizer, model, messages, max_new_tokens):
+    """The answer generated without any cache reuse, from the whole conversation."""
+    input_ids = torch.tensor([chat_tokens(tokenizer, messages)])
+    output = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=0)
+    return tokenizer.decode(output[0, input_ids.shape[1] :], skip_special_tokens=True)
+
+
+def test_crop_cache(tiny_model):
+    from transformers import DynamicCache
+
+    _, model = tiny_model
+    with torch.inference_mode():
+        output = model(input_ids=torch.tensor([[4, 5, 6, 7, 8]]), past_key_values=DynamicCache(), use_cache=True)
+    cache = crop_cache(output.past_key_values, 3)
+    assert cache.get_seq_length() == 3
+
+    legacy = tuple((torch.zeros(1, 2, 5, 8), torch.ones(1, 2, 5, 8)) for _ in range(2))
+    cropped = crop_cache(legacy, 2)
+    assert [tuple(tensor.shape) for layer in cropped for tensor in layer] == [(1, 2, 2, 8)] * 4
+
+
+def test_the_prefix_of_the_conversation_is_reused(tiny_model):
+    tokenizer, model = tiny_model
+    session = ChatSession(tokenizer, model, "cpu", max_context=512, system_prompt="the assistant")
+
+    first = session.send("hello world", max_new_tokens=6)
+    second = session.send("the vector index", max_new_tokens=6)
+
+    turns = session.metrics
+    assert turns[0].reused_tokens == 0 and turns[0].generated_tokens == 6
+    # the second turn runs the model only on the new tokens: the first turn is in the cache
+    assert turns[1].reused_tokens >= turns[0].prompt_tokens
+    assert len(session.context) == turns[1].prompt_tokens + 5  # the last generated token is not run yet
+    assert len(turns[1].inter_token_latencies) == 5
+
+    # the streamed answers are the ones generated from the whole conversation without the cache
+    messages = [{"role": "system", "content": "the assistant"}, {"role": "user", "content": "hello world"}]
+    assert first == greedy_answer(tokenizer, model, messages, 6)
+    messages += [{"role": "assistant", "content": first}, {"role": "user", "content": "the vector index"}]
+    assert second == greedy_answer(tokenizer, model, messages, 6)
+
+
+def test_old_turns_are_evicted(tiny_model):
+    tokenizer, model = tiny_model
+    session = ChatSession(tokenizer, model, "cpu", max_context=40, reserve=20, system_prompt="the assistant")
+    for _ in range(4):
+        session.send("the vector index of the paper", max_new_tokens=4)
+
+    # the 4th turn doesn't fit: the oldest turns are evicted down to max_context - reserve tokens
+    assert [turn.prompt_tokens for turn in session.metrics] == [11, 22, 33, 11]
+    assert session.messages[0] == {"role": "system", "content": "the assistant"}
+    assert [message["role"] for message in session.messages] == ["system", "user", "assistant"]
+    assert len(session.context) <= session.max_context
+
+
+def test_repeated_conversations_are_answered_from_the_response_cache(tiny_model):
+    tokenizer, model = tiny_model
+    cache = ResponseCache(":memory:")
+    answers = [
+        ChatSession(tokenizer, model, "cpu", response_cache=cache).send("hello world", max_new_tokens=5)
+        for _ in range(2)
+    ]
+    assert answers[0] == answers[1]
+    assert cache.hits == 1
+
+
+def test_sampled_answers_are_not_cached(tiny_model):
+    tokenizer, model = tiny_model
+    cache = ResponseCache(":memory:")
+    session = ChatSession(tokenizer, model, "cpu", response_cache=cache)
+    session.send("hello world", max_new_tokens=3, temperature=0.7)
+    assert len(cache) == 0
@@ -0,0 +1,63 @@
+import re
+from typing import List
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from typer.testing import CliRunner
+
+from experiments.llms.conversation import SummaryBufferMemory, app
+
+MAX_TOKENS = 200
+
+
+class RecordingChatModel(FakeListChatModel):
+    """Fake chat model keeping the prompts it receives."""
+
+    prompts: List[str] = []
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        self.prompts.append(messages[-1].content)
+        return super()._call(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+def summarized_questions(prompt: str) -> List[str]:
+    new_lines = prompt.split("New lines of conversation:")[1]
+    return re.findall(r"Human: (question \d+)", new_lines)
+
+
+def test_summary_buffer_memory_stays_within_the_budget():
+    llm = RecordingChatModel(responses=[f"The user asked {index + 1} times about the topics." for index in range(50)])
+    memory = SummaryBufferMemory(llm=llm, max_tokens=MAX_TOKENS, background=False)
+    answer = "A fairly long answer with some details about the question that was asked just now."
+
+    history_tokens = []
+    for index in range(30):
+        history = memory.load_memory_variables({"input": f"question {index}"})["history"]
+        history_tokens.append(memory.stats["history_tokens"])
+        assert memory.count_tokens(history) <= MAX_TOKENS
+        memory.save_context({"input": f"question {index}"}, {"output": answer})
+
+    # the history grows with the first turns, then stays within the budget
+    assert history_tokens[5] > history_tokens[1]
+    assert max(history_tokens) <= MAX_TOKENS
+    assert memory.stats["pending_turns"] == 0
+
+    # every evicted turn was folded in the summary once, in order, the others are in the history verbatim
+    assert llm.prompts
+    evicted = [question for prompt in llm.prompts for question in summarized_questions(prompt)]
+    assert evicted == [f"question {index}" for index in range(len(evicted))]
+    history = memory.load_memory_variables({"input": "question 30"})["history"]
+    assert history.startswith(f"Summary of the earlier conversation:\n{memory.summary}")
+    assert memory.summary == f"The user asked {len(llm.prompts)} times about the topics."
+    recent = re.findall(r"Human: (question \d+)", history)
+    assert recent == [f"question {index}" for index in range(len(evicted), 30)]
+    assert memory.stats["summarized_turns"] == len(evicted)
+
+    # the summary of the previous turns is given to the next summarization
+    assert "Current summary:\n(none)" in llm.prompts[0]
+    assert "Current summary:\nThe user asked 1 times" in llm.prompts[1]
+
+
+def test_cli_keeps_the_chat_command():
+    result = CliRunner().invoke(app, ["chat", "--help"])
+    assert result.exit_code == 0
+    assert "--max-tokens" in result.output
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+import torch
+
+from experiments import onnx_runtime
+from experiments.onnx_runtime import ensure_onnx, onnx_file_name, onnx_path
+
+
+class RecordingExport:
+    """Stand-in for the optimum export and quantization, writing only the model files."""
+
+    def __init__(self, monkeypatch):
+        self.calls = []
+        monkeypatch.setattr(onnx_runtime, "export_onnx", self.export)
+        monkeypatch.setattr(onnx_runtime, "quantize_onnx", self.quantize)
+
+    def _write(self, folder: str, name: str) -> str:
+        os.makedirs(folder, exist_ok=True)
+        open(os.path.join(folder, name), "w").close()
+        return folder
+
+    def export(self, model, model_class, output_path, use_cache=False):
+        self.calls.append(("export", output_path, use_cache))
+        return self._write(output_path, "model.onnx")
+
+    def quantize(self, onnx_folder, output_path):
+        self.calls.append(("quantize", onnx_folder, output_path))
+        return self._write(output_path, "model_quantized.onnx")
+
+
+def test_cache_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(onnx_runtime.settings, "MODELS_PATH", str(tmp_path / "models"))
+    assert onnx_path(str(tmp_path), "onnx") == str(tmp_path / "onnx")
+    assert onnx_path("org/model", "onnx-int8") == str(tmp_path / "models" / "org--model" / "onnx-int8")
+    assert onnx_file_name("onnx") == "model.onnx"
+    assert onnx_file_name("onnx-int8") == "model_quantized.onnx"
+    with pytest.raises(ValueError, match="Unknown runtime"):
+        ensure_onnx("org/model", None, "tensorrt")
+
+
+def test_artifacts_are_built_once(tmp_path, monkeypatch):
+    recorder = RecordingExport(monkeypatch)
+    snapshot = str(tmp_path)
+    exported, quantized = str(tmp_path / "onnx"), str(tmp_path / "onnx-int8")
+
+    # int8 from scratch: export then quantize the export
+    assert ensure_onnx(snapshot, None, "onnx-int8", use_cache=True) == quantized
+    assert recorder.calls == [("export", exported, True), ("quantize", exported, quantized)]
+    assert ensure_onnx(snapshot, None, "onnx-int8") == quantized
+    assert ensure_onnx(snapshot, None, "onnx") == exported
+    assert len(recorder.calls) == 2
+
+    # a quantized folder without its model file (interrupted) is built again from the existing export
+    os.remove(os.path.join(quantized, "model_quantized.onnx"))
+    ensure_onnx(snapshot, None, "onnx-int8")
+    assert recorder.calls[2:] == [("quantize", exported, quantized)]
+
+
+def test_onnx_generation_matches_pytorch(tiny_model, tmp_path):
+    from optimum.onnxruntime import ORTModelForCausalLM
+
+    from experiments.llms.generate import ChatSession
+
+    tokenizer, model = tiny_model
+    model.save_pretrained(tmp_path)
+    tokenizer.save_pretrained(tmp_path)
+    answers = {}
+    for runtime in ("onnx", "onnx-int8"):
+        onnx_model = onnx_runtime.load_onnx_model(
+            str(tmp_path), ORTModelForCausalLM, runtime, use_cache=True, use_io_binding=False
+        )
+        assert os.path.exists(tmp_path / runtime / onnx_file_name(runtime))
+        answers[runtime] = ChatSession(tokenizer, onnx_model, "cpu").send("hello world", max_new_tokens=8)
+
+    with torch.inference_mode():
+        expected = ChatSession(tokenizer, model, "cpu").send("hello world", max_new_tokens=8)
+    assert answers["onnx"] == expected
+    assert len(answers["onnx-int8"].split()) == 8
@@ -0,0 +1,121 @@
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+
+from experiments.llms.cache import ResponseCache
+
+MODEL = "gpt-4"
+
+
+def bag_of_words(texts):
+    """Stub embedding: hashed counts of the lowercase words."""
+    vectors = np.zeros((len(texts), 64), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.lower().split():
+            vectors[row, zlib.crc32(word.strip("?.!").encode()) % 64] += 1
+    return vectors
+
+
+def test_exact_hits():
+    cache = ResponseCache(":memory:")
+    assert cache.get("What is HNSW?", MODEL) is None
+    cache.put("What is HNSW?", MODEL, "A graph index.")
+
+    assert cache.get("What  is\nHNSW?", MODEL) == "A graph index."  # the spacing is normalized
+    assert cache.get("what is hnsw?", MODEL) is None  # the case is not
+    assert cache.get("What is HNSW?", "gpt-3.5-turbo") is None
+    assert cache.get("What is HNSW?", MODEL, {"temperature": 0.7}) is None
+    assert cache.stats() | {"hit_rate": None} == {
+        "entries": 1,
+        "hits": 1,
+        "semantic_hits": 0,
+        "misses": 4,
+        "hit_rate": None,
+        "evictions": 0,
+        "expirations": 0,
+    }
+
+    generated = []
+    answer = cache.cached("Explain PQ", MODEL, lambda: generated.append(1) or "Product quantization.")
+    assert answer == ("Product quantization.", False)
+    assert cache.cached("Explain PQ", MODEL, lambda: generated.append(1) or "other") == ("Product quantization.", True)
+    assert len(generated) == 1
+
+
+def test_ttl_expiry():
+    cache = ResponseCache(":memory:", ttl=0.2)
+    cache.put("old question", MODEL, "old answer")
+    time.sleep(0.3)
+    cache.put("new question", MODEL, "new answer")
+
+    assert cache.get("old question", MODEL) is None
+    assert cache.expirations == 1
+    assert cache.get("new question", MODEL) == "new answer"
+    assert len(cache) == 1
+
+    time.sleep(0.3)
+    assert cache.expire() == 1
+    assert len(cache) == 0
+
+
+def test_lru_eviction():
+    cache = ResponseCache(":memory:", max_entries=2)
+    cache.put("first", MODEL, "1")
+    time.sleep(0.01)
+    cache.put("second", MODEL, "2")
+    time.sleep(0.01)
+    assert cache.get("first", MODEL) == "1"  # the second one is now the least recently used
+    time.sleep(0.01)
+    cache.put("third", MODEL, "3")
+
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    assert cache.get("second", MODEL) is None
+    assert cache.get("first", MODEL) == "1"
+    assert cache.get("third", MODEL) == "3"
+
+
+def test_semantic_hit_and_miss():
+    cache = ResponseCache(":memory:", embed_function=bag_of_words, similarity_threshold=0.8)
+    cache.put("What is the capital of France?", MODEL, "Paris.")
+
+    assert cache.get("what is the capital of france", MODEL) == "Paris."
+    assert cache.semantic_hits == 1
+    assert cache.get("What is the population of Germany?", MODEL) is None
+    assert cache.get("what is the capital of france", MODEL, {"temperature": 1.0}) is None  # another scope
+
+    # the vector computed by the lookup is stored with the answer
+    answer, vector = cache.lookup("Who wrote Hamlet?", MODEL)
+    assert answer is None and vector is not None
+    cache.put("Who wrote Hamlet?", MODEL, "Shakespeare.", vector=vector)
+    assert cache.get("who wrote hamlet", MODEL) == "Shakespeare."
+    assert cache.semantic_hits == 2
+
+
+def test_vectors_of_another_embedding_model_are_not_compared(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    first = ResponseCache(path, embed_function=bag_of_words, embedding_model="model-a", similarity_threshold=0.8)
+    first.put("What is the capital of France?", MODEL, "Paris.")
+
+    second = ResponseCache(path, embed_function=bag_of_words, embedding_model="model-b", similarity_threshold=0.8)
+    assert second.get("what is the capital of france", MODEL) is None
+    assert second.get("What is the capital of France?", MODEL) == "Paris."  # the exact match doesn't need them
+    third = ResponseCache(path, embed_function=bag_of_words, embedding_model="model-a")
+    assert third.get("what is the capital of france", MODEL) == "Paris."
+
+
+def test_database_of_a_previous_version(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE responses (key TEXT PRIMARY KEY, scope TEXT NOT NULL, prompt TEXT NOT NULL, "
+        "response TEXT NOT NULL, vector BLOB, created REAL NOT NULL, last_used REAL NOT NULL, "
+        "hits INTEGER NOT NULL DEFAULT 0)"
+    )
+    connection.close()
+
+    cache = ResponseCache(path, embed_function=bag_of_words)
+    cache.put("What is the capital of France?", MODEL, "Paris.")
+    assert cache.get("what is the capital of france", MODEL) == "Paris."
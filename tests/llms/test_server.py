@@ -0,0 +1,98 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from experiments.llms.server import DynamicBatcher, GenerationRequest, InferenceServer
+
+PROMPTS = ["the vector index is", "hello world", "a model of the cache", "the user query"]
+
+
+@pytest.fixture
+def server(tiny_model):
+    tokenizer, model = tiny_model
+    batcher = DynamicBatcher(tokenizer, model, "cpu", max_batch_size=4, max_wait=0.2).start()
+    server = InferenceServer(("127.0.0.1", 0), batcher, model_name="tiny")
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    batcher.stop()
+
+
+def call(server, path: str, body: dict = None) -> tuple:
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    data = json.dumps(body).encode("utf8") if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def complete(batcher: DynamicBatcher, prompt: str, **kwargs) -> GenerationRequest:
+    return batcher.submit([GenerationRequest(prompt=prompt, temperature=0.0, **kwargs)])[0]
+
+
+def test_endpoints(server):
+    assert call(server, "/health") == (200, {"status": "ok"})
+    assert call(server, "/v1/models")[1]["data"][0]["id"] == "tiny"
+    assert call(server, "/v1/unknown")[0] == 404
+    assert call(server, "/v1/completions", {"max_tokens": 4})[0] == 400
+    assert call(server, "/v1/completions", {"prompt": "hello", "stream": True})[0] == 400
+    assert call(server, "/v1/completions", {"prompt": [1, 2]})[0] == 400
+
+    status, response = call(server, "/v1/completions", {"prompt": PROMPTS[:2], "max_tokens": 6, "temperature": 0})
+    assert status == 200
+    expected = [complete(server.batcher, prompt, max_tokens=6) for prompt in PROMPTS[:2]]
+    assert [choice["text"] for choice in response["choices"]] == [request.text for request in expected]
+    assert all(choice["finish_reason"] == "length" for choice in response["choices"])
+    assert response["usage"] == {"prompt_tokens": 6, "completion_tokens": 12, "total_tokens": 18}
+
+    messages = [{"role": "system", "content": "the assistant"}, {"role": "user", "content": "hello world"}]
+    status, response = call(server, "/v1/chat/completions", {"messages": messages, "max_tokens": 5, "n": 2})
+    assert status == 200
+    assert len(response["choices"]) == 2
+    assert response["choices"][0]["message"]["role"] == "assistant"
+    assert response["usage"]["completion_tokens"] == 10
+
+    metrics = call(server, "/metrics")[1]
+    assert metrics["requests"] == 6 and metrics["errors"] == 0
+
+
+def test_stop_string_and_completion_tokens(server):
+    full = complete(server.batcher, PROMPTS[0], max_tokens=12)
+    words = full.text.split()
+    assert len(words) == full.completion_tokens == 12
+    stop = words[5]
+    position = next(index for index in range(1, len(words)) if words[index] == stop)  # the first " stop"
+
+    request = complete(server.batcher, PROMPTS[0], max_tokens=12, stop=[f" {stop}"])
+    assert request.finish_reason == "stop"
+    assert request.text == " ".join(words[:position])
+    # the tokens generated after the stop string are not counted
+    assert request.completion_tokens == position
+
+
+def test_concurrent_requests_are_batched(server):
+    expected = {prompt: complete(server.batcher, prompt, max_tokens=8).text for prompt in PROMPTS}
+    batches = server.batcher.metrics.batches
+    responses = {}
+
+    def send(prompt):
+        responses[prompt] = call(server, "/v1/completions", {"prompt": prompt, "max_tokens": 8, "temperature": 0})[1]
+
+    threads = [threading.Thread(target=send, args=(prompt,)) for prompt in PROMPTS]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # the left padded batch generates the same greedy completions as the prompts alone
+    assert {prompt: response["choices"][0]["text"] for prompt, response in responses.items()} == expected
+    assert max(response["metrics"][0]["batch_size"] for response in responses.values()) > 1
+    assert server.batcher.metrics.batches - batches < len(PROMPTS)
@@ -0,0 +1,155 @@
+import zlib
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from typer.testing import CliRunner
+
+from experiments.pipeline import ingest
+from experiments.pipeline.ingest import Checkpoint, Pipeline, read_batches, store_writer
+from experiments.vectordb.hnsw import HNSWStore
+
+RECORDS = 230
+DIMENSION = 16
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    path = tmp_path / "dataset.parquet"
+    table = pa.table(
+        {
+            "id": [f"2401.{index:05d}" for index in range(RECORDS)],
+            "title": [f"Paper {index}" for index in range(RECORDS)],
+            "abstract": [f"Abstract of the paper number {index}." for index in range(RECORDS)],
+            "year": [2020 + index % 4 for index in range(RECORDS)],
+        }
+    )
+    # several row groups: the batches are cut at their boundaries too
+    pq.write_table(table, path, row_group_size=80)
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def lowercase_clean(monkeypatch):
+    """The spaCy model is not needed to test the streaming: the texts are only lowercased."""
+
+    def clean(batch):
+        batch.texts = [f"{record.pop('title')} {record.pop('abstract')}".lower() for record in batch.records]
+        return batch
+
+    monkeypatch.setattr(Pipeline, "clean", staticmethod(clean))
+
+
+class HashEmbedding:
+    """Deterministic embedding of the texts, recording the texts embedded."""
+
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts):
+        self.texts.extend(texts)
+        vectors = np.zeros((len(texts), DIMENSION), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.split():
+                vectors[row, zlib.crc32(word.encode()) % DIMENSION] += 1
+        return vectors
+
+
+def test_read_batches(dataset):
+    batches = list(read_batches(dataset, batch_size=50, offset=60, limit=200))
+    assert [(batch.start, batch.end) for batch in batches][0] == (60, 80)
+    ids = [record["id"] for batch in batches for record in batch.records]
+    assert ids == [f"2401.{index:05d}" for index in range(60, 200)]
+    assert all(len(batch.records) == batch.end - batch.start for batch in batches)
+
+
+def test_pipeline_into_hnsw_with_resume(dataset, tmp_path):
+    store_path = str(tmp_path / "store")
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    embedding = HashEmbedding()
+    store = HNSWStore(store_path)
+    write = store_writer(store, create=True)
+    written = []
+
+    def crashing_write(embeddings, records):
+        if len(written) == 5:
+            raise RuntimeError("crash")
+        written.append(len(records))
+        write(embeddings, records)
+
+    pipeline = Pipeline(
+        dataset,
+        embedding,
+        crashing_write,
+        checkpoint,
+        batch_size=20,
+        queue_size=2,
+        flush_function=store.save,
+        flush_every=2,
+    )
+    with pytest.raises(RuntimeError, match="crash"):
+        pipeline.run()
+    # the 5 batches written are committed at the end of the failed run
+    assert checkpoint.load() == 100
+    assert len(HNSWStore(store_path)) == 100
+
+    # a new process resumes from the checkpoint
+    embedding = HashEmbedding()
+    store = HNSWStore(store_path)
+    pipeline = Pipeline(
+        dataset,
+        embedding,
+        store_writer(store, create=checkpoint.load() == 0),
+        checkpoint,
+        batch_size=20,
+        queue_size=2,
+        flush_function=store.save,
+        flush_every=2,
+    )
+    assert pipeline.run() == RECORDS
+    assert len(embedding.texts) == RECORDS - 100
+    assert embedding.texts[0] == "paper 100 abstract of the paper number 100."
+    assert pipeline.metrics["write"].records == RECORDS - 100
+
+    store = HNSWStore(store_path)
+    assert len(store) == RECORDS
+    query = HashEmbedding()(["paper 7 abstract of the paper number 7."])[0]
+    hit = store.search(query, limit=1, exact=True)[0]
+    assert hit.id == "2401.00007"
+    assert hit.payload == {"id": "2401.00007", "year": 2023}
+    assert [result.payload["year"] for result in store.search(query, limit=5, filters={"year": 2021})] == [2021] * 5
+
+    # nothing left to ingest
+    assert pipeline.run() == RECORDS
+
+
+def test_ingest_command(dataset, tmp_path, monkeypatch):
+    monkeypatch.setitem(ingest.EMBEDDING_BACKENDS, "hash", HashEmbedding())
+    monkeypatch.setattr(type(ingest.settings), "_setup_logger", lambda self: True)
+    arguments = [
+        "ingest",
+        "--file-path",
+        dataset,
+        "--backend",
+        "hash",
+        "--store",
+        "mmap",
+        "--store-path",
+        str(tmp_path / "store"),
+        "--collection-name",
+        "papers",
+        "--checkpoint-path",
+        str(tmp_path / "checkpoint.json"),
+        "--batch-size",
+        "64",
+        "--limit",
+        "100",
+    ]
+    result = CliRunner().invoke(ingest.app, arguments)
+    assert result.exit_code == 0, result.output
+    assert "Ingestion completed up to record 100" in result.output
+
+    result = CliRunner().invoke(ingest.app, arguments[:-1] + ["150"])
+    assert "Ingestion completed up to record 150" in result.output
+    assert len(ingest.get_store("mmap", "papers", str(tmp_path / "store"))) == 150
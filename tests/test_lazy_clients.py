@@ -0,0 +1,67 @@
+import json
+import os
+import subprocess
+import sys
+
+from experiments.vectordb import lance_utils, qdrant
+
+MODULES = (
+    "experiments.embeddings.openai_client",
+    "experiments.llms.download",
+    "experiments.vectordb.lance_utils",
+    "experiments.vectordb.qdrant",
+)
+
+SCRIPT = """
+import json, os, sys
+for module in sys.argv[1:]:
+    __import__(module)
+from experiments.embeddings.openai_client import configure_openai
+from experiments.vectordb import lance_utils, qdrant
+openai = sys.modules.get("openai")
+print(json.dumps({
+    "files": sorted(os.listdir(".")),
+    "openai_key": getattr(openai, "api_key", None),
+    "clients": [
+        function.cache_info().currsize
+        for function in (configure_openai, qdrant._get_client, lance_utils._get_db, lance_utils.get_embedding_function)
+    ],
+}))
+"""
+
+
+def test_imports_have_no_side_effects(tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(
+        os.environ,
+        PYTHONPATH=root,
+        OPENAI_KEY="sk-test",
+        HUGGING_FACE_TOKEN="hf_test",
+        HF_HOME=str(tmp_path / "hf"),
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT, *MODULES],
+        cwd=tmp_path,
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    # no folder created, no login, no key set, no connection opened
+    assert json.loads(output.splitlines()[-1]) == {"files": [], "openai_key": None, "clients": [0, 0, 0, 0]}
+
+
+def test_clients_are_shared_inside_a_process_only(monkeypatch):
+    monkeypatch.setattr(qdrant, "QdrantClient", lambda **kwargs: object())
+    monkeypatch.setattr(lance_utils.lancedb, "connect", lambda uri: object())
+    qdrant._get_client.cache_clear()
+    lance_utils._get_db.cache_clear()
+
+    client, db = qdrant.get_client(), lance_utils.get_db()
+    assert qdrant.get_client() is client and lance_utils.get_db() is db
+    # a forked worker (another process id) opens its own connections
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    assert qdrant.get_client() is not client and lance_utils.get_db() is not db
+
+    qdrant._get_client.cache_clear()
+    lance_utils._get_db.cache_clear()
@@ -0,0 +1,112 @@
+import json
+import logging
+import time
+
+import pytest
+from loguru import logger
+
+from experiments.config import Settings
+from experiments.logging_utils import RateLimitFilter, benchmark, setup_logging
+
+
+@pytest.fixture
+def log_settings(tmp_path):
+    def make(**kwargs):
+        return Settings(LOG_FILE_NAME=str(tmp_path / "loguru.log"), ECS_LOG_PATH=str(tmp_path / "ecs.log"), **kwargs)
+
+    return make
+
+
+def read_lines(path) -> list:
+    with open(path, encoding="utf8") as f:
+        return f.read().splitlines()
+
+
+def test_async_logging_only_queues_in_the_caller(log_settings, tmp_path):
+    setup = setup_logging(log_settings(LOG_ASYNC=True))
+    setup.listener.stop()  # nobody writes: the records stay in the queue
+    try:
+        for index in range(10):
+            logger.info("queued {}", index)
+        assert not (tmp_path / "loguru.log").exists()
+        assert setup.listener.queue.qsize() == 20  # a record for each file
+    finally:
+        setup.listener.start()
+        setup.stop()
+    assert len(read_lines(tmp_path / "loguru.log")) == 10
+    assert len(read_lines(tmp_path / "ecs.log")) == 10
+
+
+def test_async_logging_lowers_the_per_call_overhead():
+    results = benchmark(calls=2000, pause=0.0005, modes=["sync", "async"])
+    assert results["async"]["p50_us"] < results["sync"]["p50_us"]
+    assert results["async"]["records"] == 2 * (2000 + 200)  # the loguru file and the ECS file
+
+
+def test_flush_and_stop_write_every_queued_record(log_settings, tmp_path):
+    setup = setup_logging(log_settings(LOG_ASYNC=True, LOG_BATCH_SIZE=7))
+    for index in range(500):
+        logger.info("record {}", index)
+    setup.flush()
+    assert len(read_lines(tmp_path / "loguru.log")) == 500
+
+    stdlib_logger = logging.getLogger("experiments.test")
+    stdlib_logger.setLevel(logging.INFO)
+    for index in range(500, 1000):
+        stdlib_logger.info("record %d", index)
+        logger.info("record {}", index)
+    setup.stop()
+    assert len(read_lines(tmp_path / "loguru.log")) == 1000
+    ecs = [json.loads(line)["message"] for line in read_lines(tmp_path / "ecs.log")]
+    assert len(ecs) == 1500
+    assert sorted(set(ecs), key=lambda message: int(message.split()[1])) == [f"record {i}" for i in range(1000)]
+    assert setup.stats()["queue_dropped"] == 0
+
+
+def test_rate_limit_drops_and_reports_the_records(log_settings, tmp_path):
+    setup = setup_logging(log_settings(LOG_ASYNC=False, LOG_RATE_LIMIT=10))
+    try:
+        for index in range(16):
+            if index == 15:
+                logger.warning("never dropped")
+                time.sleep(0.2)
+            logger.info("hot loop {}", index)
+    finally:
+        setup.stop()
+
+    assert setup.rate_limit.dropped == 5
+    lines = read_lines(tmp_path / "loguru.log")
+    assert sum("hot loop" in line for line in lines) == 11  # the burst and the record after the pause
+    assert "never dropped" in lines[-2]
+    assert lines[-1].endswith("hot loop 15 (5 similar messages dropped)")
+    ecs = [json.loads(line)["message"] for line in read_lines(tmp_path / "ecs.log")]
+    assert ecs[-1] == "hot loop 15 (5 similar messages dropped)"
+
+
+def test_rate_limit_filter_on_stdlib_records():
+    rate_limit = RateLimitFilter(rate=1, burst=2)
+    records = [logging.LogRecord("test", logging.INFO, "file.py", 10, "message %d", (i,), None) for i in range(5)]
+    assert [rate_limit.filter(record) for record in records] == [True, True, False, False, False]
+    assert rate_limit.dropped == 3
+    error = logging.LogRecord("test", logging.ERROR, "file.py", 10, "error", (), None)
+    assert rate_limit.filter(error)
+
+    rate_limit._buckets[("file.py", 10)][1] -= 1  # a second later
+    record = logging.LogRecord("test", logging.INFO, "file.py", 10, "message %d", (5,), None)
+    assert rate_limit.filter(record)
+    assert record.getMessage() == "message 5 (3 similar messages dropped)"
+
+
+def test_async_loguru_file_rotation(log_settings, tmp_path):
+    settings = log_settings(LOG_ASYNC=True, LOG_ROTATION_SIZE="2 KB", LOG_RETENTION="1 day")
+    settings.LOG_FILE_NAME = str(tmp_path / "logs" / "app_{time:YYYY}.log")
+    setup = setup_logging(settings)
+    for index in range(100):
+        logger.info("rotated record {}", index)
+    setup.stop()
+
+    files = sorted((tmp_path / "logs").iterdir())
+    assert len(files) > 2
+    assert all(file.name.startswith(f"app_{time.localtime().tm_year}") for file in files)
+    assert all(file.stat().st_size <= 2000 for file in files)
+    assert sum(len(read_lines(file)) for file in files) == 100
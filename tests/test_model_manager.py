@@ -0,0 +1,170 @@
+import json
+import os
+
+import pytest
+
+from experiments.model_manager import ChecksumError, MirrorSource, ModelManager
+
+REPO_ID = "org/model"
+
+
+class RecordingSource(MirrorSource):
+    """Mirror recording the offsets requested, failing every call when offline."""
+
+    def __init__(self, root: str):
+        super().__init__(root)
+        self.offsets = {}
+        self.offline = False
+
+    def resolve(self, repo_id: str, revision: str = "main"):
+        if self.offline:
+            raise ConnectionError("offline")
+        return super().resolve(repo_id, revision)
+
+    def fetch(self, repo_id, commit, file, offset=0):
+        if self.offline:
+            raise ConnectionError("offline")
+        self.offsets.setdefault(file.path, []).append(offset)
+        return super().fetch(repo_id, commit, file, offset)
+
+
+def add_revision(root, commit: str, files: dict, ref: str = "main"):
+    for path, content in files.items():
+        file_path = os.path.join(root, REPO_ID, commit, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as f:
+            f.write(content)
+    if ref:
+        os.makedirs(os.path.join(root, REPO_ID, "refs"), exist_ok=True)
+        with open(os.path.join(root, REPO_ID, "refs", ref), "w") as f:
+            f.write(commit)
+
+
+@pytest.fixture
+def weights():
+    return os.urandom(3000)
+
+
+@pytest.fixture
+def mirror(tmp_path, weights):
+    root = str(tmp_path / "mirror")
+    add_revision(root, "c1", {"model.bin": weights, "config/config.json": b'{"layers": 2}'})
+    return RecordingSource(root)
+
+
+@pytest.fixture
+def manager(tmp_path, mirror):
+    return ModelManager(str(tmp_path / "models"), source=mirror, workers=2, retries=2)
+
+
+def read(file_path) -> bytes:
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def test_download(manager, mirror, weights):
+    folder = manager.download(REPO_ID)
+    assert folder == manager.revision_path(REPO_ID, "c1")
+    assert read(os.path.join(folder, "model.bin")) == weights
+    assert read(os.path.join(folder, "config", "config.json")) == b'{"layers": 2}'
+    assert not any(name.endswith(".incomplete") for _, _, names in os.walk(folder) for name in names)
+    assert manager.read_index()[REPO_ID]["refs"] == {"main": "c1"}
+    assert manager.verify(REPO_ID) == []
+
+    # a second download finds every file already there
+    mirror.offsets.clear()
+    manager.download(REPO_ID)
+    assert mirror.offsets == {}
+
+
+def test_download_only_the_selected_files(manager):
+    folder = manager.download(REPO_ID, allow_patterns=["*.json"])
+    assert os.listdir(folder) == ["config"]
+    with pytest.raises(ValueError):
+        manager.download(REPO_ID, allow_patterns=["*.safetensors"])
+
+
+def test_resume_of_a_truncated_partial(manager, mirror, weights):
+    partial = os.path.join(manager.revision_path(REPO_ID, "c1"), "model.bin.incomplete")
+    os.makedirs(os.path.dirname(partial))
+    with open(partial, "wb") as f:
+        f.write(weights[:1000])
+
+    folder = manager.download(REPO_ID)
+    assert mirror.offsets["model.bin"] == [1000]
+    assert read(os.path.join(folder, "model.bin")) == weights
+    assert not os.path.exists(partial)
+
+
+def test_complete_partial_is_checked_without_a_request(manager, mirror, weights):
+    partial = os.path.join(manager.revision_path(REPO_ID, "c1"), "model.bin.incomplete")
+    os.makedirs(os.path.dirname(partial))
+    with open(partial, "wb") as f:
+        f.write(weights)
+
+    folder = manager.download(REPO_ID)
+    assert "model.bin" not in mirror.offsets
+    assert read(os.path.join(folder, "model.bin")) == weights
+
+
+@pytest.mark.parametrize("content", [b"x" * 3000, b"x" * 4000], ids=["corrupted", "too-long"])
+def test_wrong_partial_is_downloaded_again(manager, mirror, weights, content):
+    partial = os.path.join(manager.revision_path(REPO_ID, "c1"), "model.bin.incomplete")
+    os.makedirs(os.path.dirname(partial))
+    with open(partial, "wb") as f:
+        f.write(content)
+
+    folder = manager.download(REPO_ID)
+    assert mirror.offsets["model.bin"] == [0]
+    assert read(os.path.join(folder, "model.bin")) == weights
+
+
+def test_checksum_mismatch(manager, mirror):
+    with open(os.path.join(mirror.root, REPO_ID, "c1", "SHA256SUMS"), "w") as f:
+        f.write(f"{'0' * 64}  model.bin\n")
+
+    with pytest.raises(ChecksumError):
+        manager.download(REPO_ID)
+    folder = manager.revision_path(REPO_ID, "c1")
+    assert not os.path.exists(os.path.join(folder, "model.bin"))
+    assert not os.path.exists(os.path.join(folder, "model.bin.incomplete"))
+    assert manager.resolve(REPO_ID) is None
+
+
+def test_offline_resolve(manager, mirror):
+    assert manager.resolve(REPO_ID) is None
+    folder = manager.download(REPO_ID)
+
+    mirror.offline = True
+    assert manager.resolve(REPO_ID) == folder
+    assert manager.resolve(REPO_ID, "c1") == folder  # the commit
+    assert manager.resolve(REPO_ID, "c") == folder  # a prefix of the commit
+    assert manager.resolve(REPO_ID, "v2") is None
+
+    os.remove(os.path.join(folder, "model.bin"))
+    assert manager.resolve(REPO_ID) is None
+
+
+def test_gc(manager, mirror, weights):
+    manager.download(REPO_ID)
+    add_revision(mirror.root, "c2", {"model.bin": weights, "config/config.json": b'{"layers": 3}'})
+    manager.download(REPO_ID)
+    add_revision(mirror.root, "c3", {"model.bin": weights, "config/config.json": b'{"layers": 4}'})
+    manager.download(REPO_ID)
+    # the weights are linked from the first revision, not downloaded again
+    assert mirror.offsets["model.bin"] == [0]
+    orphan = os.path.join(manager.root, "org--model", "unknown")
+    os.makedirs(orphan)
+    with open(os.path.join(orphan, "file.bin"), "wb") as f:
+        f.write(b"x" * 100)
+
+    # c3 is pointed by main, c2 is the most recently used of the others
+    assert manager.gc(keep=1, dry_run=True) == len(b'{"layers": 2}') + 100
+    assert os.path.exists(orphan)
+    manager.gc(keep=1)
+    assert not os.path.exists(orphan)
+    assert not os.path.exists(manager.revision_path(REPO_ID, "c1"))
+    index = manager.read_index()
+    assert sorted(index[REPO_ID]["revisions"]) == ["c2", "c3"]
+    assert json.loads(read(os.path.join(manager.resolve(REPO_ID), "config", "config.json"))) == {"layers": 4}
+    assert read(os.path.join(manager.revision_path(REPO_ID, "c2"), "model.bin")) == weights
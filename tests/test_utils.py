@@ -0,0 +1,30 @@
+import subprocess
+
+import pytest
+
+from experiments.utils import IMPORT_TIME_BUDGETS, check_import_time, heavy_imports, measure_import_time
+
+
+def test_measure_import_time():
+    elapsed = measure_import_time("json")
+    assert 0 < elapsed < 5
+
+
+def test_measure_import_time_of_a_missing_module():
+    with pytest.raises(subprocess.CalledProcessError):
+        measure_import_time("experiments.missing_module")
+
+
+def test_check_import_time():
+    assert check_import_time({"json": 60.0})
+    assert not check_import_time({"json": 0.0})
+
+
+def test_heavy_imports():
+    assert heavy_imports("json", ("json", "spacy")) == ["json"]
+
+
+# the import time itself depends on the machine: it is checked by `make check_import_time`
+@pytest.mark.parametrize("module", IMPORT_TIME_BUDGETS)
+def test_no_heavy_library_loaded_on_import(module):
+    assert heavy_imports(module) == []
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+from experiments.text import utils
+from experiments.text.utils import clean_text, clean_texts
+
+STOP_WORDS = {"the", "a", "of", "is"}
+
+
+class StubNLP:
+    """Stand-in for the spaCy pipeline (the model may not be installed): lowercase lemmas split on spaces."""
+
+    def __init__(self):
+        self.texts = []
+        self.processes = []
+
+    def _doc(self, text):
+        self.texts.append(text)
+        return [
+            SimpleNamespace(lemma_=word.lower(), is_stop=word.lower() in STOP_WORDS, is_punct=word in ".,;")
+            for word in text.split()
+        ]
+
+    def __call__(self, text):
+        return self._doc(text)
+
+    def pipe(self, texts, batch_size, n_process):
+        self.processes.append(n_process)
+        return (self._doc(text) for text in texts)
+
+
+@pytest.fixture
+def nlp(monkeypatch):
+    nlp = StubNLP()
+    monkeypatch.setattr(utils, "get_nlp", lambda: nlp)
+    monkeypatch.setattr(utils, "_CLEANED", OrderedDict())
+    return nlp
+
+
+def test_cleaned_texts_are_memoized(nlp):
+    texts = ["The Graph of a network .", "Attention is all", "The Graph of a network ."]
+    assert clean_texts(texts, batch_size=2, n_process=4) == ["graph network", "attention all", "graph network"]
+    assert nlp.texts == texts[:2]  # the duplicated text is cleaned once
+    assert nlp.processes == [1]  # a single batch: no processes spawned
+
+    assert clean_texts(["Attention is all", "New text"], batch_size=2, n_process=4) == ["attention all", "new text"]
+    assert nlp.texts == texts[:2] + ["New text"]
+    assert clean_text("The Graph of a network .") == "graph network"
+    assert clean_text("A single text") == "single text"
+    assert clean_texts(["A single text"]) == ["single text"]
+    assert len(nlp.texts) == 4
+
+    many = [f"text {index}" for index in range(5)]
+    clean_texts(many, batch_size=2, n_process=4)
+    assert nlp.processes[-1] == 4
+
+
+def test_memo_is_bounded(nlp, monkeypatch):
+    monkeypatch.setattr(utils.settings, "TEXT_CLEAN_CACHE_SIZE", 2)
+    clean_texts(["first", "second"])
+    clean_text("first")  # "second" is now the least recently used
+    clean_text("third")
+    assert list(utils._CLEANED) == ["first", "third"]
+    clean_texts(["second", "first"])
+    assert nlp.texts == ["first", "second", "third", "second"]
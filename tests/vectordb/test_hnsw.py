@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from experiments.vectordb.hnsw import HNSWIndex, HNSWStore, normalize
+
+DIMENSION = 32
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return np.random.default_rng(0).standard_normal((1000, DIMENSION)).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def index(vectors):
+    index = HNSWIndex(DIMENSION, m=16, ef_construction=100)
+    for vector in normalize(vectors):
+        index.add(vector)
+    return index
+
+
+def test_recall_against_exact_search(index):
+    queries = np.random.default_rng(1).standard_normal((50, DIMENSION)).astype(np.float32)
+    recalls = []
+    for query in queries:
+        exact = {node for node, _ in index.exact_search(query, k=10)}
+        approximate = index.search(query, k=10, ef=64)
+        assert len(approximate) == 10
+        scores = [score for _, score in approximate]
+        assert scores == sorted(scores, reverse=True)
+        recalls.append(len(exact & {node for node, _ in approximate}) / 10)
+    assert np.mean(recalls) >= 0.95
+
+
+def test_exact_search_is_the_brute_force(index, vectors):
+    query = vectors[7]
+    hits = index.exact_search(query, k=5)
+    assert hits[0][0] == 7 and hits[0][1] == pytest.approx(1.0)
+    expected = np.argsort(-(normalize(vectors) @ normalize(query)))[:5]
+    assert [node for node, _ in hits] == expected.tolist()
+
+
+def make_store(vectors, path=None) -> HNSWStore:
+    store = HNSWStore(path, ef_construction=100)
+    ids = [f"doc-{index}" for index in range(len(vectors))]
+    store.upsert(ids, vectors, [{"year": 2020 + index % 3} for index in range(len(vectors))])
+    return store
+
+
+def test_save_and_load(tmp_path, vectors):
+    store = make_store(vectors[:300], str(tmp_path / "index"))
+    store.delete(["doc-3", "doc-4"])
+    store.save()
+
+    loaded = HNSWStore(str(tmp_path / "index"))
+    assert len(loaded) == len(store) == 298
+    np.testing.assert_array_equal(loaded.index.vectors, store.index.vectors)
+    assert loaded.index.deleted == store.index.deleted
+    for query in vectors[:20]:
+        assert loaded.search(query, limit=10) == store.search(query, limit=10)
+        assert loaded.search(query, limit=5, filters={"year": 2021}) == store.search(
+            query, limit=5, filters={"year": 2021}
+        )
+
+
+def test_save_of_an_empty_store(tmp_path):
+    store = HNSWStore(str(tmp_path / "index"))
+    store.save()
+    assert not (tmp_path / "index").exists()
+    assert store.search(np.ones(DIMENSION)) == []
+
+
+@pytest.mark.parametrize("exact", [False, True])
+def test_delete_and_upsert_hide_the_stale_nodes(vectors, exact):
+    store = make_store(vectors[:300])
+    version = store.version
+
+    assert store.delete(["doc-10", "missing"]) == 1
+    hits = store.search(vectors[10], limit=10, exact=exact)
+    assert "doc-10" not in {hit.id for hit in hits}
+    assert len(store) == 299
+
+    # doc-20 moved to the vector of doc-30: its old node is not returned anymore
+    store.upsert(["doc-20"], vectors[30:31], [{"year": 1999}])
+    hits = store.search(vectors[20], limit=10, exact=exact)
+    assert all(hit.id != "doc-20" or hit.score < 0.99 for hit in hits)
+    hits = store.search(vectors[30], limit=2, exact=exact)
+    assert {hit.id for hit in hits} == {"doc-20", "doc-30"}
+    assert next(hit for hit in hits if hit.id == "doc-20").payload == {"year": 1999}
+    assert len(store) == 299
+    assert store.version == version + 2
+
+    ids = [hit.id for hit in store.search(vectors[0], limit=50, exact=exact)]
+    assert len(ids) == len(set(ids)) == 50
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from experiments.text.bm25 import BM25Index, tokenize
+from experiments.vectordb.base import SearchResult
+from experiments.vectordb.hnsw import HNSWStore
+from experiments.vectordb.hybrid import HybridSearch, reciprocal_rank_fusion
+
+PAPERS = [
+    {"id": "p0", "title": "Graph neural networks", "abstract": "Message passing on graphs.", "categories": "cs.LG"},
+    {"id": "p1", "title": "Transformers for language", "abstract": "Attention models.", "categories": "cs.CL cs.LG"},
+    {"id": "p2", "title": "The X-ray of h.264", "abstract": "Video coding with h.264.", "categories": "eess.IV"},
+    {"id": "p3", "title": "Graph transformers", "abstract": "Attention on graph nodes.", "categories": "cs.LG"},
+    {"id": "p4", "title": "Sparse attention", "abstract": "Attention attention attention.", "categories": "cs.CL"},
+]
+
+
+@pytest.fixture
+def index():
+    return BM25Index.from_records(PAPERS, batch_size=2)
+
+
+def test_tokenize():
+    assert tokenize("The X-ray of h.264, and GRAPHS!") == ["x-ray", "h.264", "graphs"]
+
+
+def test_bm25_ranking(index, tmp_path):
+    assert [hit.id for hit in index.search("graph")] == ["p3", "p0"]  # the shorter document first
+    assert [hit.id for hit in index.search("attention", limit=2)] == ["p4", "p1"]
+    assert [hit.id for hit in index.search("h.264")] == ["p2"]
+    assert index.search("nothing matches") == []
+    assert [hit.id for hit in index.search("attention", filters={"categories": "cs.LG"})] == ["p1", "p3"]
+    assert index.search("graph")[0].payload == {"id": "p3", "categories": "cs.LG"}
+
+    index.save(str(tmp_path / "bm25.json"))
+    loaded = BM25Index.load(str(tmp_path / "bm25.json"))
+    assert loaded.search_batch(["graph", "attention"]) == index.search_batch(["graph", "attention"])
+
+    version = index.version
+    index.add(["p3"], ["Cooking recipes"])  # replaced: the old text doesn't match anymore
+    assert [hit.id for hit in index.search("graph")] == ["p0"]
+    assert index.remove(["p0", "missing"]) == 1
+    assert index.search("graph") == [] and len(index) == 4
+    assert index.version > version
+
+
+def test_reciprocal_rank_fusion():
+    vector = [SearchResult("a", 0.9), SearchResult("b", 0.8), SearchResult("c", 0.7)]
+    keyword = [SearchResult("c", 12.0, {"id": "c"}), SearchResult("d", 3.0)]
+    fused = reciprocal_rank_fusion([vector, keyword], k=60)
+    assert [hit.id for hit in fused] == ["c", "a", "b", "d"]
+    assert fused[0].score == pytest.approx(1 / 63 + 1 / 61)
+    assert fused[0].payload == {"id": "c"}
+
+    weighted = reciprocal_rank_fusion([vector, keyword], k=60, weights=[1.0, 3.0], limit=2)
+    assert [hit.id for hit in weighted] == ["c", "d"]
+
+
+def test_hybrid_search(index):
+    store = HNSWStore()
+    # unit vectors at growing angles from the query vector: p2, p4, p0, p3, p1 by similarity
+    angles = np.radians([30, 90, 0, 60, 10])
+    store.upsert([paper["id"] for paper in PAPERS], np.stack([np.cos(angles), np.sin(angles)], axis=1), PAPERS)
+    hybrid = HybridSearch(store, index, embed_function=lambda queries: np.asarray([[1.0, 0.0]] * len(queries)))
+
+    # keywords: p4, p1, p3; the documents good in both the rankings come first
+    assert [hit.id for hit in hybrid.search_batch(["attention"], limit=5)[0]] == ["p4", "p1", "p3", "p2", "p0"]
+    filtered = hybrid.search("attention", limit=5, filters={"categories": "cs.LG"})
+    assert [hit.id for hit in filtered] == ["p1", "p3", "p0"]
+    assert filtered[0].score == pytest.approx(1 / 63 + 1 / 61)
+    with pytest.raises(ValueError, match="embed_function"):
+        HybridSearch(store, index).search("attention")
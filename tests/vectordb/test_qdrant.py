@@ -0,0 +1,67 @@
+import threading
+
+import numpy as np
+import pytest
+from qdrant_client import QdrantClient
+
+from experiments.vectordb import qdrant
+from experiments.vectordb.qdrant import content_point_id, insert_embeddings_to_qdrant, point_id
+
+COLLECTION = "papers"
+
+
+def test_point_ids_are_stable():
+    # uuid5 of the arxiv id: the same in every process and every run
+    assert point_id("0704.0001") == "0c9214d0-7c2d-533e-a1b8-ca6314ac26fa"
+    assert point_id("0704.0001") != point_id("0704.0002")
+
+    payload = {"title": "A paper", "year": 2020}
+    assert content_point_id(payload, [0.1]) == content_point_id({"year": 2020, "title": "A paper"}, [0.9])
+    assert content_point_id(None, [0.1, 0.2]) == content_point_id({}, np.asarray([0.1, 0.2]))
+    assert content_point_id(None, [0.1, 0.2]) != content_point_id(None, [0.1, 0.3])
+
+
+class LocalClient(QdrantClient):
+    """In memory qdrant recording the upserts; the local mode is not thread safe, the upserts are serialized."""
+
+    def __init__(self):
+        super().__init__(":memory:")
+        self.upserts = []
+        self._lock = threading.Lock()
+
+    def upsert(self, collection_name, points, wait=True, **kwargs):
+        with self._lock:
+            self.upserts.append((len(points), wait))
+            return super().upsert(collection_name, points, wait=wait, **kwargs)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = LocalClient()
+    monkeypatch.setattr(qdrant, "get_client", lambda: client)
+    qdrant.create_collection(COLLECTION, vector_size=4, quantization=None)
+    return client
+
+
+@pytest.mark.parametrize("wait", [True, False])
+def test_upserts_are_idempotent(client, wait):
+    vectors = np.random.default_rng(0).standard_normal((25, 4)).astype(np.float32)
+    payloads = [{"id": f"0704.{index:04d}"} for index in range(20)] + [
+        {"title": f"no id {index}"} for index in range(5)
+    ]
+
+    for _ in range(2):
+        assert insert_embeddings_to_qdrant(vectors, payloads, COLLECTION, batch_size=3, parallel=2, wait=wait) == 25
+        assert client.count(COLLECTION).count == 25
+    # batches of 3 points (sent concurrently) then, without waiting, a final barrier waiting for all of them
+    batches = [(3, wait)] * 8 + [(1, wait)]
+    assert sorted(client.upserts) == sorted((batches + ([] if wait else [(1, True)])) * 2)
+    assert wait or client.upserts[-1] == (1, True)
+
+    point = client.retrieve(COLLECTION, [point_id("0704.0007")], with_vectors=True)[0]
+    assert point.payload == {"id": "0704.0007"}
+    np.testing.assert_allclose(point.vector, vectors[7] / np.linalg.norm(vectors[7]), rtol=1e-5)
+
+    # a paper inserted again with another vector overwrites its point
+    insert_embeddings_to_qdrant(vectors[:1] * -1, payloads[:1], COLLECTION)
+    assert client.count(COLLECTION).count == 25
@@ -0,0 +1,115 @@
+import time
+
+import numpy as np
+
+from experiments.vectordb.hnsw import HNSWStore
+from experiments.vectordb.retrieval import Retriever, TTLCache, filters_key
+
+DIMENSION = 16
+
+
+def test_filters_key():
+    assert filters_key({"year": [2020]}) != filters_key({"year": ["2020"]})
+    assert filters_key({"year": 2020}) != filters_key({"year": "2020"})
+    assert filters_key({"year": [2021, 2020], "category": "cs.CL"}) == filters_key(
+        {"category": "cs.CL", "year": (2020, 2021)}
+    )
+    assert filters_key({"tags": {"b", "a"}}) == filters_key({"tags": ["a", "b"]})
+    assert filters_key(None) == filters_key({}) == ""
+
+
+def test_ttl_expiry():
+    cache = TTLCache(max_entries=10, max_bytes=10_000, ttl=0.1)
+    cache.put("old", 1)
+    time.sleep(0.15)
+    cache.put("new", 2)
+
+    assert cache.get("old") is None
+    assert cache.get("new") == 2
+    assert cache.stats() | {"hit_rate": None} == {
+        "entries": 1,
+        "bytes": 65,
+        "hits": 1,
+        "misses": 1,
+        "hit_rate": None,
+        "evictions": 0,
+        "expirations": 1,
+    }
+
+
+def test_byte_bound():
+    cache = TTLCache(max_entries=100, max_bytes=100, size_function=len)
+    cache.put("a", "x" * 40)
+    cache.put("b", "x" * 40)
+    assert cache.get("a") is not None  # b is now the least recently used
+    cache.put("c", "x" * 40)
+
+    assert cache.bytes == 80 and len(cache) == 2
+    assert cache.evictions == 1
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+    cache.put("d", "x" * 101)  # larger than the whole cache: not cached, nothing evicted
+    assert cache.get("d") is None
+    assert cache.bytes == 80 and cache.evictions == 1
+
+
+class StubEmbedding:
+    """One hot embedding of the first letter of the query, counting the calls."""
+
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts):
+        self.texts.extend(texts)
+        vectors = np.zeros((len(texts), DIMENSION), dtype=np.float32)
+        for row, text in enumerate(texts):
+            vectors[row, (ord(text.strip().lower()[0]) - ord("a")) % DIMENSION] = 1
+        return vectors
+
+
+def make_retriever():
+    store = HNSWStore()
+    vectors = np.eye(DIMENSION, dtype=np.float32) + 0.01
+    store.upsert([f"doc-{index}" for index in range(DIMENSION)], vectors, [{"letter": index} for index in range(8)] * 2)
+    embedding = StubEmbedding()
+    return Retriever(store, embedding), store, embedding
+
+
+def test_cached_results_and_invalidation():
+    retriever, store, embedding = make_retriever()
+    store_searches = []
+    search_batch = store.search_batch
+    store.search_batch = lambda *args, **kwargs: store_searches.append(1) or search_batch(*args, **kwargs)
+
+    first = retriever.search_batch(["apple", "Banana", "  APPLE "], limit=3)
+    assert [hits[0].id for hits in first] == ["doc-0", "doc-1", "doc-0"]
+    assert embedding.texts == ["apple", "Banana"]
+    assert retriever.search("apple", limit=3) == first[0]
+    assert len(store_searches) == 1
+    assert retriever.stats()["results"]["hits"] == 1
+
+    # another limit or other filters are other searches
+    assert [hit.payload["letter"] for hit in retriever.search("apple", limit=3, filters={"letter": 0})] == [0, 0]
+    assert len(store_searches) == 2
+
+    # a write changes the version of the store: the cached results are dropped
+    retriever.upsert(["doc-16"], np.eye(DIMENSION, dtype=np.float32)[:1], [{"letter": 0}])
+    assert [hit.id for hit in retriever.search("apple", limit=1)] == ["doc-16"]
+    assert len(store_searches) == 3
+    retriever.delete(["doc-16"])
+    assert [hit.id for hit in retriever.search("apple", limit=1)] == ["doc-0"]
+    assert len(store_searches) == 4
+    assert embedding.texts == ["apple", "Banana"]  # the query embeddings are still cached
+
+
+def test_the_callers_cannot_change_the_cached_results():
+    retriever, _, _ = make_retriever()
+    hits = retriever.search("apple", limit=2)
+    hits[0].payload["letter"] = "changed"
+    hits[0].score = -1.0
+    hits.clear()
+
+    cached = retriever.search("apple", limit=2)
+    assert len(cached) == 2
+    assert cached[0].payload == {"letter": 0} and cached[0].score > 0.9
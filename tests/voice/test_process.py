@@ -0,0 +1,76 @@
+import threading
+import wave
+
+import numpy as np
+import pytest
+
+from experiments.voice.process import WHISPER_SAMPLERATE, StreamingTranscriber, transcribe_stream, wav_blocks
+
+SAMPLERATE = 44_100
+SPEECH_START, SPEECH_SECONDS, SILENCE_SECONDS = 0.5, 5.0, 1.0
+
+
+@pytest.fixture
+def wav_file(tmp_path):
+    """Silence, 5 seconds of noise (the speech for the energy VAD) and silence, at 44.1kHz."""
+    rng = np.random.default_rng(0)
+    audio = np.concatenate(
+        [
+            np.zeros(int(SPEECH_START * SAMPLERATE)),
+            0.3 * rng.standard_normal(int(SPEECH_SECONDS * SAMPLERATE)),
+            np.zeros(int(SILENCE_SECONDS * SAMPLERATE)),
+        ]
+    )
+    path = tmp_path / "speech.wav"
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLERATE)
+        f.writeframes((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+    return str(path)
+
+
+class StubTranscribe:
+    """Return the next scripted text, keeping the audio of every chunk."""
+
+    def __init__(self, texts):
+        self.texts = list(texts)
+        self.chunks = []
+        self._lock = threading.Lock()
+
+    def __call__(self, audio: np.ndarray) -> str:
+        with self._lock:
+            self.chunks.append(audio)
+            return self.texts[len(self.chunks) - 1]
+
+
+def test_streaming_transcription_of_a_wav_file(wav_file):
+    stub = StubTranscribe(["one two three four", "three four five six", "five six seven"])
+    with StreamingTranscriber(stub, workers=1, chunk_seconds=2.0, overlap_seconds=0.5) as transcriber:
+        transcripts = list(transcribe_stream(wav_blocks(wav_file), transcriber))
+
+    # chunk boundaries: every 2 seconds of speech, the last one closed by the silence
+    assert len(transcripts) == 3
+    assert [transcript.final for transcript in transcripts] == [False, False, True]
+    assert transcripts[0].start == pytest.approx(SPEECH_START - 0.2, abs=0.1)
+    for previous, transcript in zip(transcripts, transcripts[1:]):
+        assert transcript.start == previous.end
+    for transcript in transcripts[:-1]:
+        assert transcript.end - transcript.start == pytest.approx(2.0, abs=0.05)
+    speech_end = SPEECH_START + SPEECH_SECONDS
+    assert speech_end < transcripts[-1].end <= speech_end + 0.6 + 0.2 + 0.05
+
+    # the chunks after the first one start 0.5 seconds earlier, the overlap
+    assert len(stub.chunks[0]) == round((transcripts[0].end - transcripts[0].start) * WHISPER_SAMPLERATE)
+    for audio, transcript in zip(stub.chunks[1:], transcripts[1:]):
+        assert len(audio) == round((transcript.end - transcript.start + 0.5) * WHISPER_SAMPLERATE)
+
+    # the words repeated by the overlap are removed
+    assert [transcript.text for transcript in transcripts] == ["one two three four", "five six", "seven"]
+
+    stats = transcriber.stats
+    assert stats.chunks == 3
+    assert stats.audio_seconds == pytest.approx(SPEECH_START + SPEECH_SECONDS + SILENCE_SECONDS)
+    assert stats.speech_seconds == pytest.approx(transcripts[-1].end - transcripts[0].start)
+    assert len(stats.latencies) == 3
+    assert 0 < stats.real_time_factor < 1
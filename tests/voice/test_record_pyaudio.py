@@ -0,0 +1,63 @@
+import wave
+
+import numpy as np
+import pytest
+
+from experiments.voice.record_pyaudio import BLOCK_SIZE, AudioRecorder, SyntheticSoundDevice
+
+SAMPLERATE = 44_100
+
+
+def read_wav(path):
+    with wave.open(str(path), "rb") as f:
+        return f.getnchannels(), f.getframerate(), np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+
+
+@pytest.mark.parametrize("system_index", [None, 1], ids=["microphone", "microphone-and-system"])
+def test_record_synthetic_device(tmp_path, system_index):
+    hooked = []
+    recorder = AudioRecorder(
+        0,
+        system_index,
+        device=SyntheticSoundDevice(samplerate=SAMPLERATE, speed=20),
+        on_audio=lambda samples, samplerate: hooked.append((len(samples), samplerate)),
+    )
+
+    frames = recorder.record(10, str(tmp_path / "meeting.wav"))
+
+    # 10 seconds of audio in half a second, without losing frames
+    assert sum(buffer.overruns for buffer in recorder.buffers) == 0
+    assert recorder.status_errors == 0
+    assert 9 * SAMPLERATE <= frames <= 12 * SAMPLERATE
+    channels, samplerate, samples = read_wav(tmp_path / "meeting.wav")
+    assert (channels, samplerate) == (1, SAMPLERATE)
+    assert len(samples) == frames == recorder.frames_written
+    assert sum(length for length, _ in hooked) == frames
+    assert {samplerate for _, samplerate in hooked} == {SAMPLERATE}
+    if system_index is None:
+        assert frames % BLOCK_SIZE == 0
+
+    # the 440Hz sine of the device, mixed to mono
+    spectrum = np.abs(np.fft.rfft(samples[: SAMPLERATE * 5]))
+    assert np.argmax(spectrum) / 5 == pytest.approx(440, abs=1)
+    assert np.abs(samples).max() == pytest.approx(0.5 * 32767, rel=0.01)
+
+
+def test_record_raises_the_error_of_the_hook(tmp_path):
+    calls = []
+
+    def hook(samples, samplerate):
+        calls.append(len(samples))
+        if len(calls) == 3:
+            raise ValueError("hook failed")
+
+    recorder = AudioRecorder(0, device=SyntheticSoundDevice(speed=20), on_audio=hook)
+    with pytest.raises(ValueError, match="hook failed"):
+        recorder.record(60, str(tmp_path / "failed.wav"))
+
+    # the recording stopped at the failure, not after the whole duration
+    assert len(calls) == 3
+    assert not recorder.is_recording
+    assert recorder.frames_written < 10 * SAMPLERATE
+    channels, samplerate, samples = read_wav(tmp_path / "failed.wav")
+    assert len(samples) == recorder.frames_written + calls[-1]  # the frames written before calling the hook